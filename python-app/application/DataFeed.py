@@ -2,13 +2,31 @@
 
 import paho.mqtt.client as mqtt
 from client import Client
-import sqlite3
+from latest_reading import create_latest_reading_table
+from partitions import create_rollup_table
+from river_geometry import create_river_geometry_table
+from completeness import create_completeness_tables
+from sequence_tracker import create_unique_reading_index
+from river_analytics import create_river_lag_table
+from placements import create_sensor_place_table
+from search import create_search_index
+import os
+import database
+from recent_buffer import RecentReadings, serve
+from alerts import create_alert_tables, AlertEngine, AlertDispatcher
+from freshness import create_freshness_tables, FreshnessTracker
+from time_tiles import create_tile_tables
+from mqtt_traffic import Recorder
 from constant import subscriber_name, sensor_location, topic, mqtt_broker, mqtt_broker_port, keepalive,database_file
+from constant import recent_hours, recent_address, recent_authkey, profile_dir, record_dir
 
 def create_tables():
-    conn = sqlite3.connect(database_file)
+    conn = database.connect(database_file)
     c = conn.cursor()
 
+    # WAL lets the API's read-only connections run alongside the ingest writer
+    c.execute('PRAGMA journal_mode=WAL')
+
     # Create riverData table
     c.execute('''
             CREATE TABLE IF NOT EXISTS riverData (
@@ -53,6 +71,9 @@ def create_tables():
                     FOREIGN KEY (SensorID) REFERENCES sensorInfo(sensorID),
                     FOREIGN KEY (riverID) REFERENCES riverData(riverID)
                 )''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sensordata_sensor_time ON SensorData(SensorID, created_at)')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_sensordata_created_at ON SensorData(created_at)')
+    create_unique_reading_index(c)
 
     # Create readingInfo table
     c.execute('''CREATE TABLE IF NOT EXISTS readingInfo (
@@ -64,6 +85,36 @@ def create_tables():
                     FOREIGN KEY (sensorDataID) REFERENCES SensorData(id)
                 )''')
 
+    # Create latest_reading table (one row per sensor, kept current by the ingest path)
+    create_latest_reading_table(c)
+
+    # Create SensorDataRollup table (hourly aggregates of archived partitions)
+    create_rollup_table(c)
+
+    # Create riverGeometry table (river outlines served by /river_geometry)
+    create_river_geometry_table(c)
+
+    # Create readingGap table and sensorInfo.readFrequency (see completeness.py)
+    create_completeness_tables(c)
+
+    # Create riverPairLag table (results of the river_analytics.py fleet run)
+    create_river_lag_table(c)
+
+    # Create sensorPlace table (placement history, seeded from sensorInfo)
+    create_sensor_place_table(c)
+
+    # Create searchIndex (FTS5 trigram index over river/sensor names and locations)
+    create_search_index(c)
+
+    # Create alertRule and alertEvent tables (see alerts.py)
+    create_alert_tables(c)
+
+    # Create sensorFreshness table and SensorData.received_at (see freshness.py)
+    create_freshness_tables(c)
+
+    # Create tileGeneration table (versions of the cached chart tiles, see time_tiles.py)
+    create_tile_tables(c)
+
     # Create counters table for sequence generation
     c.execute('''CREATE TABLE IF NOT EXISTS counters (
                     id TEXT PRIMARY KEY,
@@ -84,8 +135,33 @@ if __name__ == '__main__':
     create_tables()
 
     cc = Client(subscriber_name, sensor_location, topic)
+    if recent_address:
+        # Recent readings stay in memory here so the API can serve today's view without the database
+        cc.recent = RecentReadings(recent_hours)
+        conn = database.connect(database_file)
+        cc.recent.warm(conn)
+        conn.close()
+        serve(cc.recent, recent_address, recent_authkey, os.path.abspath(profile_dir))
+    # Alert rules run on every stored reading; fired alerts are recorded and notified off the ingest threads
+    cc.alerts = AlertEngine(database_file, AlertDispatcher(database_file).start().queue)
+    # Sensor -> broker -> ingest -> commit lag per sensor, saved to sensorFreshness for the API
+    cc.freshness = FreshnessTracker(database_file)
+    conn = database.connect(database_file)
+    cc.freshness.load(conn)
+    conn.close()
+    cc.freshness.start_flushing()
+    if record_dir:
+        # Raw traffic for `mqtt_traffic.py replay` load tests
+        cc.recorder = Recorder(record_dir).start_flushing()
     cc.mqtt_client = mqtt.Client()
     cc.mqtt_client.on_connect = cc.on_connect
     cc.mqtt_client.on_message = cc.on_message
     cc.mqtt_client.connect(mqtt_broker, mqtt_broker_port, keepalive)
-    cc.mqtt_client.loop_forever()
+    try:
+        cc.mqtt_client.loop_forever()
+    finally:
+        # Let the readings in flight commit, then save what they added to the histograms
+        cc.executor.shutdown(wait=True)
+        cc.freshness.flush()
+        if cc.recorder is not None:
+            cc.recorder.close()
@@ -0,0 +1,170 @@
+# admission.py
+# Keeps heavy history queries from starving the rest of the API.
+#
+# Every route belongs to a class (ROUTE_CLASSES, by Flask endpoint name; anything not
+# listed is 'registry') with:
+#   budget_seconds - wall-clock budget for the request's SQLite queries; the connection's
+#                    progress handler interrupts a query that runs past it (503)
+#   max_concurrent - requests of the class running at once in this process (None = no limit)
+#   max_queued     - requests allowed to wait for a slot; beyond that they get 429 at once
+#   queue_seconds  - how long a queued request waits for a slot before giving up with 503
+# and MAX_ROWS_PER_RESPONSE caps what any row-returning route sends back (the ?page= routes
+# send a longer page in parts, see page_window).
+#
+# Limits are per process: with gunicorn's threaded workers (gunicorn.conf.py) each worker
+# keeps threads free for the registry routes however many history requests arrive.
+
+import logging
+import threading
+import time
+from flask import g, has_request_context, jsonify, request
+
+MAX_ROWS_PER_RESPONSE = 50000
+# Default page stride of the ?page= routes, as before the row cap, so page N keeps addressing
+# the same rows for existing clients; a page is sent in parts of at most MAX_ROWS_PER_RESPONSE
+PAGE_ROWS = 100000
+# SQLite VM instructions between two budget checks (well under a millisecond)
+PROGRESS_INSTRUCTIONS = 10000
+
+
+class RoutePolicy:
+    def __init__(self, budget_seconds, max_concurrent=None, max_queued=0, queue_seconds=0.0):
+        self.budget_seconds = budget_seconds
+        self.max_concurrent = max_concurrent
+        self.max_queued = max_queued
+        self.queue_seconds = queue_seconds
+        self.slots = threading.BoundedSemaphore(max_concurrent) if max_concurrent else None
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+
+POLICIES = {
+    'registry': RoutePolicy(budget_seconds=2),
+    'history': RoutePolicy(budget_seconds=10, max_concurrent=2, max_queued=8, queue_seconds=2),
+    'analytics': RoutePolicy(budget_seconds=30, max_concurrent=1, max_queued=4, queue_seconds=5),
+    'bulk': RoutePolicy(budget_seconds=30, max_concurrent=1, max_queued=2, queue_seconds=5),
+}
+
+ROUTE_CLASSES = {
+    'get_data': 'history',
+    'get_sensor_data': 'history',
+    'get_todays_sensor_data': 'history',
+    'get_sensor_data_range': 'history',
+    'get_sensor_rollup': 'history',
+    'get_tile_info': 'history',
+    'get_chart_tile': 'history',
+    'get_reading_gaps': 'history',
+    'get_alerts': 'history',
+    'get_completeness': 'analytics',
+    'get_aligned_data': 'analytics',
+    'get_river_lags': 'analytics',
+    'get_river_divergence': 'analytics',
+    'bulk_ingest': 'bulk',
+}
+
+
+class RequestBudget:
+    __slots__ = ('deadline', 'budget_seconds', 'exceeded')
+
+    def __init__(self, budget_seconds):
+        self.budget_seconds = budget_seconds
+        self.deadline = time.monotonic() + budget_seconds
+        self.exceeded = False
+
+
+def policy_for(endpoint):
+    return POLICIES[ROUTE_CLASSES.get(endpoint, 'registry')]
+
+
+def limit_query_time(conn):
+    """Interrupt this connection's queries once the current request's budget is spent."""
+    budget = g.get('budget') if has_request_context() else None
+    if budget is None:
+        return conn
+
+    def check():
+        if time.monotonic() > budget.deadline:
+            budget.exceeded = True
+            return 1  # non-zero aborts the statement with OperationalError: interrupted
+        return 0
+
+    conn.set_progress_handler(check, PROGRESS_INSTRUCTIONS)
+    return conn
+
+
+def row_limit(default, cap=MAX_ROWS_PER_RESPONSE):
+    """The request's ?limit=, or default, never above cap."""
+    try:
+        limit = int(request.args.get('limit', default))
+    except ValueError:
+        limit = default
+    return max(0, min(limit, cap))
+
+
+def page_window(default=PAGE_ROWS):
+    """(offset, limit, next part) of a ?page=&part= request.
+
+    Pages keep their stride of ?limit= (default PAGE_ROWS) rows; each response carries at
+    most MAX_ROWS_PER_RESPONSE of them, ?part=1, 2, ... of the page. The next part is None
+    once the page is complete.
+    """
+    try:
+        stride = max(1, int(request.args.get('limit', default)))
+    except ValueError:
+        stride = default
+    page = max(1, int(request.args.get('page', 1)))
+    part = max(1, int(request.args.get('part', 1)))
+    skip = (part - 1) * MAX_ROWS_PER_RESPONSE
+    limit = max(0, min(MAX_ROWS_PER_RESPONSE, stride - skip))
+    next_part = part + 1 if skip + limit < stride else None
+    return (page - 1) * stride + skip, limit, next_part
+
+
+def admit():
+    """before_request hook: take a slot of the route's class or reject the request."""
+    policy = policy_for(request.endpoint)
+    if policy.slots is not None:
+        if not policy.slots.acquire(blocking=False):
+            with policy.lock:
+                if policy.waiting >= policy.max_queued:
+                    logging.debug(f"Rejecting {request.endpoint}: {policy.waiting} already queued")
+                    return busy(429, 'Too many requests of this kind are queued')
+                policy.waiting += 1
+            try:
+                acquired = policy.slots.acquire(timeout=policy.queue_seconds)
+            finally:
+                with policy.lock:
+                    policy.waiting -= 1
+            if not acquired:
+                return busy(503, 'Server busy, try again shortly')
+        g.admitted = policy
+    g.budget = RequestBudget(policy.budget_seconds)
+
+
+def busy(status, message):
+    response = jsonify({'status': 'error', 'message': message})
+    response.status_code = status
+    response.headers['Retry-After'] = '1'
+    return response
+
+
+def report_budget(response):
+    """after_request hook: an interrupted query surfaces from the route as a 500; report it as 503."""
+    budget = g.get('budget')
+    if budget is not None and budget.exceeded and response.status_code == 500:
+        logging.warning(f"{request.endpoint} exceeded its {budget.budget_seconds}s query budget")
+        return busy(503, f'Query exceeded its {budget.budget_seconds}s time budget; narrow the range or lower the limit')
+    return response
+
+
+def release(exc=None):
+    """teardown_request hook: give the slot back (after a streamed body has been sent)."""
+    policy = g.pop('admitted', None)
+    if policy is not None:
+        policy.slots.release()
+
+
+def init_admission(app):
+    app.before_request(admit)
+    app.after_request(report_budget)
+    app.teardown_request(release)
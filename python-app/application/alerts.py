@@ -0,0 +1,276 @@
+# alerts.py
+# Threshold alerts evaluated on the MQTT ingest path as each reading is stored.
+#
+# alertRule rows describe the conditions:
+#   below / above  - value beyond threshold continuously for duration_minutes (0 = at once)
+#   rise / fall    - value changing faster than threshold per hour, over a duration_minutes window
+# scoped to one sensor (sensorName), every sensor of a river (riverID) or the whole fleet.
+#
+# Rules are indexed by (sensor, metric), (river, metric) and (fleet, metric), so a reading
+# only looks at the rules that can apply to it. Each (rule, sensor) pair keeps a small state
+# machine (ok -> pending -> firing -> ok) and, for rate rules, a deque of the readings in its
+# window, so every check is O(1) amortised. Fired and cleared alerts are queued for a
+# background dispatcher that records them in alertEvent and passes them to the notifiers.
+# Events still open in alertEvent are resumed as firing when the engine starts, so a restart
+# neither fires them twice nor leaves them open for good.
+# LogNotifier is the local stand-in for e-mail/SMS/webhook delivery.
+
+import logging
+import queue
+import database
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from completeness import to_datetime
+
+METRICS = ('temperature', 'percent_dissolved_oxygen', 'mg_per_l_dissolved_oxygen')
+KINDS = ('below', 'above', 'rise', 'fall')
+RULE_REFRESH_SECONDS = 30
+DEFAULT_RATE_WINDOW_MINUTES = 60
+
+OK = 'ok'
+PENDING = 'pending'
+FIRING = 'firing'
+
+
+def create_alert_tables(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS alertRule (
+                    ruleID INTEGER PRIMARY KEY AUTOINCREMENT,
+                    name TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    kind TEXT NOT NULL,
+                    threshold REAL NOT NULL,
+                    duration_minutes REAL NOT NULL DEFAULT 0,
+                    riverID INTEGER,
+                    sensorName TEXT,
+                    enabled INTEGER NOT NULL DEFAULT 1,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (riverID) REFERENCES riverData(riverID)
+                )''')
+    cursor.execute('''CREATE TABLE IF NOT EXISTS alertEvent (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    ruleID INTEGER NOT NULL,
+                    SensorID TEXT NOT NULL,
+                    riverID INTEGER,
+                    metric TEXT NOT NULL,
+                    value REAL,
+                    started_at TIMESTAMP NOT NULL,
+                    fired_at TIMESTAMP NOT NULL,
+                    cleared_at TIMESTAMP,
+                    message TEXT,
+                    FOREIGN KEY (ruleID) REFERENCES alertRule(ruleID)
+                )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_alertevent_open ON alertEvent(cleared_at, fired_at)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_alertevent_sensor ON alertEvent(SensorID, fired_at)')
+
+
+def validate_rule(rule):
+    """Raise ValueError for a rule the engine cannot evaluate."""
+    if rule.get('metric') not in METRICS:
+        raise ValueError(f"metric must be one of {METRICS}")
+    if rule.get('kind') not in KINDS:
+        raise ValueError(f"kind must be one of {KINDS}")
+    float(rule['threshold'])
+    if float(rule.get('duration_minutes') or 0) < 0:
+        raise ValueError('duration_minutes must not be negative')
+
+
+class Rule:
+    __slots__ = ('ruleID', 'name', 'metric', 'kind', 'threshold', 'duration', 'riverID', 'sensorName')
+
+    def __init__(self, ruleID, name, metric, kind, threshold, duration_minutes, riverID, sensorName):
+        self.ruleID = ruleID
+        self.name = name
+        self.metric = metric
+        self.kind = kind
+        self.threshold = threshold
+        minutes = duration_minutes or (DEFAULT_RATE_WINDOW_MINUTES if kind in ('rise', 'fall') else 0)
+        self.duration = minutes * 60
+        self.riverID = riverID
+        self.sensorName = sensorName
+
+    def describe(self, sensor, value):
+        unit = '/h' if self.kind in ('rise', 'fall') else ''
+        return f"{self.name}: {sensor} {self.metric} {self.kind} {self.threshold}{unit} (now {value:.3f}{unit})"
+
+
+class RuleState:
+    __slots__ = ('state', 'since', 'last', 'window')
+
+    def __init__(self):
+        self.state = OK
+        self.since = None   # when the condition started to hold
+        self.last = None    # time of the last reading seen, older ones are ignored
+        self.window = None  # (time, value) pairs for rate rules
+
+
+class AlertEngine:
+    def __init__(self, db_file, alerts_queue=None):
+        self.db_file = db_file
+        self.queue = alerts_queue
+        self.index = {}
+        self.states = {}
+        self.signature = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def load_rules(self, conn):
+        rows = conn.execute('''SELECT ruleID, name, metric, kind, threshold, duration_minutes, riverID, sensorName
+                               FROM alertRule WHERE enabled = 1''').fetchall()
+        index = {}
+        for row in rows:
+            rule = Rule(*row)
+            if rule.sensorName is not None:
+                key = ('sensor', rule.sensorName, rule.metric)
+            elif rule.riverID is not None:
+                key = ('river', rule.riverID, rule.metric)
+            else:
+                key = ('fleet', None, rule.metric)
+            index.setdefault(key, []).append(rule)
+        with self.lock:
+            self.index = index
+            live = {rule.ruleID for rules in index.values() for rule in rules}
+            # Keep the state of rules that still exist, so a reload does not re-fire them
+            self.states = {key: state for key, state in self.states.items() if key[0] in live}
+        logging.debug(f"Alert engine loaded {len(rows)} rules")
+
+    def load_open_events(self, conn):
+        """Resume the alerts a previous run left firing (alertEvent rows not cleared yet).
+
+        Their (rule, sensor) pairs start out firing, so a condition still breaching after a
+        restart does not open a second event and the next good reading clears the first.
+        """
+        rows = conn.execute('''SELECT ruleID, SensorID, MIN(started_at) FROM alertEvent
+                               WHERE cleared_at IS NULL GROUP BY ruleID, SensorID''').fetchall()
+        with self.lock:
+            live = {rule.ruleID for rules in self.index.values() for rule in rules}
+            for ruleID, sensor, started_at in rows:
+                if ruleID not in live:
+                    continue
+                state = self.states[(ruleID, sensor)] = RuleState()
+                state.state = FIRING
+                state.since = to_datetime(started_at).replace(tzinfo=timezone.utc).timestamp()
+        logging.debug(f"Alert engine resumed {len(rows)} open alerts")
+
+    def refresh(self):
+        """Reload the rules if alertRule changed; checked at most every RULE_REFRESH_SECONDS."""
+        now = time.monotonic()
+        if now - self.checked_at < RULE_REFRESH_SECONDS:
+            return
+        self.checked_at = now
+        conn = database.connect(self.db_file)
+        try:
+            signature = conn.execute('SELECT COUNT(*), MAX(ruleID), MAX(updated_at) FROM alertRule').fetchone()
+            if signature != self.signature:
+                first = self.signature is None
+                self.load_rules(conn)
+                self.signature = signature
+                if first:
+                    self.load_open_events(conn)
+        finally:
+            conn.close()
+
+    def check_reading(self, sensor, riverID, created_at, values):
+        """Run the applicable rules for one stored reading; values maps metric -> value."""
+        self.refresh()
+        t = to_datetime(created_at).replace(tzinfo=timezone.utc).timestamp()
+        with self.lock:
+            for metric, value in values.items():
+                if value is None:
+                    continue
+                for key in (('sensor', sensor, metric), ('river', riverID, metric), ('fleet', None, metric)):
+                    for rule in self.index.get(key, ()):
+                        self.step(rule, sensor, riverID, t, value)
+
+    def step(self, rule, sensor, riverID, t, value):
+        state = self.states.get((rule.ruleID, sensor))
+        if state is None:
+            state = self.states[(rule.ruleID, sensor)] = RuleState()
+        if state.last is not None and t < state.last:
+            return
+        state.last = t
+
+        if rule.kind in ('below', 'above'):
+            measured = value
+            holds = value < rule.threshold if rule.kind == 'below' else value > rule.threshold
+        else:
+            if state.window is None:
+                state.window = deque()
+            window = state.window
+            window.append((t, value))
+            while window and window[0][0] < t - rule.duration:
+                window.popleft()
+            t0, v0 = window[0]
+            if t - t0 < rule.duration / 2:
+                # Not enough history in the window for a meaningful rate yet
+                return
+            measured = (value - v0) / (t - t0) * 3600
+            holds = measured > rule.threshold if rule.kind == 'rise' else measured < -rule.threshold
+
+        if not holds:
+            if state.state == FIRING:
+                self.emit('clear', rule, sensor, riverID, state.since, t, measured)
+            state.state, state.since = OK, None
+            return
+        if state.state == OK:
+            state.state, state.since = PENDING, t
+        if state.state == PENDING and (rule.kind in ('rise', 'fall') or t - state.since >= rule.duration):
+            state.state = FIRING
+            self.emit('fire', rule, sensor, riverID, state.since, t, measured)
+
+    def emit(self, event, rule, sensor, riverID, since, t, value):
+        alert = {'event': event, 'ruleID': rule.ruleID, 'SensorID': sensor, 'riverID': riverID,
+                 'metric': rule.metric, 'value': value, 'started_at': datetime.utcfromtimestamp(since),
+                 'at': datetime.utcfromtimestamp(t), 'message': rule.describe(sensor, value)}
+        if self.queue is not None:
+            self.queue.put(alert)
+
+
+class LogNotifier:
+    """Local stand-in for a real delivery channel: alerts go to the log."""
+
+    def notify(self, alert):
+        if alert['event'] == 'fire':
+            logging.warning(f"ALERT {alert['message']} since {alert['started_at']}")
+        else:
+            logging.warning(f"CLEARED {alert['message']}")
+
+
+class AlertDispatcher:
+    """Drains the alert queue on its own thread: records events, then hands them to the notifiers."""
+
+    def __init__(self, db_file, notifiers=None):
+        self.db_file = db_file
+        self.notifiers = notifiers if notifiers is not None else [LogNotifier()]
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True, name='alert-dispatcher')
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def run(self):
+        conn = database.connect(self.db_file)
+        while True:
+            alert = self.queue.get()
+            try:
+                self.record(conn, alert)
+                for notifier in self.notifiers:
+                    notifier.notify(alert)
+            except Exception as e:
+                logging.error(f"Error dispatching alert {alert}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def record(self, conn, alert):
+        if alert['event'] == 'fire':
+            conn.execute('''INSERT INTO alertEvent (ruleID, SensorID, riverID, metric, value, started_at, fired_at, message)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                         (alert['ruleID'], alert['SensorID'], alert['riverID'], alert['metric'], alert['value'],
+                          alert['started_at'], alert['at'], alert['message']))
+        else:
+            conn.execute('''UPDATE alertEvent SET cleared_at = ?
+                            WHERE ruleID = ? AND SensorID = ? AND cleared_at IS NULL''',
+                         (alert['at'], alert['ruleID'], alert['SensorID']))
+        conn.commit()
@@ -0,0 +1,113 @@
+# alignment.py
+# Resample several sensors onto one common time grid so their readings can be compared
+# row by row. Values are interpolated (linear) or picked (nearest) with NumPy per sensor,
+# and only within each sensor's own tolerance from its read frequency:
+#   nearest - the reading must be within half a period of the grid point
+#   linear  - the two readings around the grid point must be at most 1.5 periods apart
+# Anything further away is a gap and comes out as NaN (null in JSON).
+# The range is processed in chunks so a year of data never sits in memory as Python rows.
+
+import numpy as np
+from completeness import GAP_TOLERANCE_PERIODS, load_read_frequencies, period_seconds
+from partitions import query_sources
+
+METRICS = ('temperature', 'percent_dissolved_oxygen', 'mg_per_l_dissolved_oxygen')
+METHODS = ('linear', 'nearest')
+CHUNK_SECONDS = 14 * 86400
+
+
+def to_epoch(value):
+    return int(np.datetime64(value, 's').astype(np.int64))
+
+
+def epoch_to_text(seconds):
+    return np.datetime_as_string(np.asarray(seconds).astype('datetime64[s]'), unit='s')
+
+
+def resample(times, values, grid, period, method):
+    """One sensor's (times, values) on the grid, NaN where it is outside its tolerance."""
+    out = np.full(len(grid), np.nan)
+    valid = ~np.isnan(values)
+    times, values = times[valid], values[valid]
+    if len(times) == 0:
+        return out
+
+    right = np.searchsorted(times, grid)
+    left = right - 1
+    has_left = left >= 0
+    has_right = right < len(times)
+    left_c = np.clip(left, 0, len(times) - 1)
+    right_c = np.clip(right, 0, len(times) - 1)
+
+    if method == 'nearest':
+        d_left = np.where(has_left, grid - times[left_c], np.inf)
+        d_right = np.where(has_right, times[right_c] - grid, np.inf)
+        pick = np.where(d_left <= d_right, left_c, right_c)
+        ok = np.minimum(d_left, d_right) <= period / 2
+        out[ok] = values[pick[ok]]
+    else:
+        exact = has_right & (times[right_c] == grid)
+        out[exact] = values[right_c[exact]]
+        span = times[right_c] - times[left_c]
+        ok = has_left & has_right & ~exact & (span <= GAP_TOLERANCE_PERIODS * period) & (span > 0)
+        frac = (grid[ok] - times[left_c[ok]]) / span[ok]
+        out[ok] = values[left_c[ok]] + frac * (values[right_c[ok]] - values[left_c[ok]])
+    return out
+
+
+def iter_aligned_chunks(conn, sensor_ids, metrics, start, end, step, method='linear'):
+    """Yield (grid_times, matrix) per chunk; matrix columns are sensor-major, metric-minor."""
+    if method not in METHODS:
+        raise ValueError(f"method must be one of {METHODS}")
+    for metric in metrics:
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+
+    frequencies, _ = load_read_frequencies(conn)
+    periods = [period_seconds(frequencies.get(s)) for s in sensor_ids]
+    margin = int(max(periods) * GAP_TOLERANCE_PERIODS) + 1
+
+    start_s, end_s = to_epoch(start), to_epoch(end)
+    first = -(-start_s // step) * step
+    placeholders = ','.join('?' * len(sensor_ids))
+    query = f'''SELECT SensorID, created_at, {', '.join(metrics)} FROM {{table}}
+                WHERE SensorID IN ({placeholders}) AND created_at >= ? AND created_at < ?
+                ORDER BY SensorID, created_at'''
+
+    chunk_start = first
+    while chunk_start < end_s:
+        chunk_end = min(chunk_start + (CHUNK_SECONDS // step) * step, end_s)
+        grid = np.arange(chunk_start, chunk_end, step, dtype=np.int64)
+        # Read a little either side so grid points at the chunk edges still have neighbours
+        lo = epoch_to_text(chunk_start - margin).item().replace('T', ' ')
+        hi = epoch_to_text(chunk_end + margin).item().replace('T', ' ')
+        rows = query_sources(conn, query, (*sensor_ids, lo, hi), lo, hi)
+        # Each source is sorted; rolled months and the hot window are merged back in order
+        rows.sort(key=lambda row: (row[0], row[1]))
+
+        matrix = np.full((len(grid), len(sensor_ids) * len(metrics)), np.nan)
+        if rows:
+            columns = list(zip(*rows))
+            ids = np.array(columns[0], dtype=object)
+            times = np.array(columns[1], dtype='datetime64[s]').astype(np.int64)
+            values = np.array(columns[2:], dtype=float)
+            for i, sensor in enumerate(sensor_ids):
+                lo_i, hi_i = np.searchsorted(ids, sensor, 'left'), np.searchsorted(ids, sensor, 'right')
+                if lo_i == hi_i:
+                    continue
+                for j in range(len(metrics)):
+                    matrix[:, i * len(metrics) + j] = resample(times[lo_i:hi_i], values[j, lo_i:hi_i],
+                                                               grid, periods[i], method)
+        yield grid, matrix
+        chunk_start = chunk_end
+
+
+def align(conn, sensor_ids, metrics, start, end, step, method='linear'):
+    """The whole aligned range as one (grid_times, matrix) pair."""
+    grids, matrices = [], []
+    for grid, matrix in iter_aligned_chunks(conn, sensor_ids, metrics, start, end, step, method):
+        grids.append(grid)
+        matrices.append(matrix)
+    if not grids:
+        return np.empty(0, dtype=np.int64), np.empty((0, len(sensor_ids) * len(metrics)))
+    return np.concatenate(grids), np.vstack(matrices)
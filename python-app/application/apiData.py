@@ -3,6 +3,9 @@ import pandas as pd
 from io import StringIO
 from datetime import datetime
 import sqlite3
+import database
+from latest_reading import refresh_latest_reading
+from completeness import record_reading
 
 # Constants
 API_URL = "https://api.aquasensor.co.uk/aq.php"
@@ -24,7 +27,7 @@ class SensorDataClient:
     def connect_db(self):
         """Establish a connection to the SQLite database."""
         try:
-            conn = sqlite3.connect(self.db_file)
+            conn = database.connect(self.db_file)
             return conn
         except sqlite3.Error as e:
             print(f"Database connection error: {e}")
@@ -40,7 +43,7 @@ class SensorDataClient:
         try:
             cursor.execute('''
                 SELECT sensorInfo.sensorID, sensorInfo.riverID, riverData.riverName, 
-                sensorInfo.lat || ',' || sensorInfo.long AS latlong
+                sensorInfo.lat || ',' || sensorInfo.long AS latlong, sensorInfo.readFrequency
                 FROM sensorInfo
                 LEFT JOIN riverData ON sensorInfo.riverID = riverData.riverID
                 WHERE sensorInfo.sensorName = ? AND sensorInfo.status = 'active'
@@ -60,7 +63,7 @@ class SensorDataClient:
             print(f"Sensor {sensor_name} is not registered or inactive.")
             return
 
-        sensorID, riverID, river, latlong = sensor_info
+        sensorID, riverID, river, latlong, read_frequency = sensor_info
         created_at = datetime.strptime(f"{date} {time}", "%d-%m-%y %H:%M:%S")
 
         conn = self.connect_db()
@@ -70,12 +73,18 @@ class SensorDataClient:
         cursor = conn.cursor()
         try:
             cursor.execute('''
-                INSERT INTO SensorData (
+                INSERT OR IGNORE INTO SensorData (
                     SensorID, created_at, updated_at, riverID, river, latlong, 
                     message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen
                 ) 
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (sensorID, created_at, datetime.utcnow(), riverID, river, latlong, message_ctr, temperature, per_do, ml_do))
+            if cursor.rowcount == 0:
+                print(f"Reading {message_ctr} of {sensor_name} already stored, skipping.")
+                return
+            data_id = cursor.lastrowid
+            record_reading(cursor, sensorID, riverID, created_at, read_frequency)
+            refresh_latest_reading(cursor, data_id)
             conn.commit()
             self.insert_counter += 1
             print(f"Data inserted successfully. Total inserts: {inseself.insert_counter}")
@@ -1,22 +1,61 @@
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, Response, stream_with_context, g
+import hashlib
+import json
+import numpy as np
 import sqlite3
+import time
+import database
 from datetime import datetime, timezone
 import logging
-from constant import database_file
+from pathlib import Path
+from constant import database_file, recent_address, recent_authkey
+from constant import profile_dir, profile_secret, profile_slow_seconds, tile_dir
+from response_encoding import init_compression, compact_rows
+from admission import init_admission, limit_query_time, page_window, row_limit, MAX_ROWS_PER_RESPONSE
+from partitions import query_range
+from river_geometry import get_encoded_geometry, store_geometry, create_river_geometry_table
+from completeness import completeness_report
+from alignment import iter_aligned_chunks, epoch_to_text
+from river_analytics import analyse_river
+from placements import record_placement, get_placement_index
+from search import search, index_river, index_sensor
+from recent_buffer import fetch_recent, invalidate_recent, profile_ingest, ingest_sql_stats
+from alerts import validate_rule
+from freshness import sensor_freshness, river_freshness
+from bulk_ingest import ingest
+from time_tiles import TileCache, tile_body, tile_info, OPEN_TILE_MAX_AGE
+from profiling import init_profiling, start_window, valid_token, list_profiles, profile_path, PROFILE_HEADER
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG)
 
 app = Flask(__name__)
-CORS(app)
+CORS(app, expose_headers=['X-Next-Part'])
+init_compression(app)
+init_admission(app)
+init_profiling(app, profile_dir, profile_secret, profile_slow_seconds)
+tile_cache = TileCache(tile_dir)
 
 def get_db_connection():
-    conn = sqlite3.connect(database_file)
+    conn = database.connect(database_file)
     conn.row_factory = sqlite3.Row
     return conn
 
+def get_read_connection():
+    """ Read-only connection for the query routes, so they never take the write lock. """
+    conn = database.connect(Path(database_file).resolve().as_uri() + '?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    return limit_query_time(conn)
+
+def page_part(rows, limit, next_part):
+    """ One part of a ?page= response; X-Next-Part names the part that continues the page. """
+    response = jsonify(compact_rows(rows) if request.args.get('format') == 'compact' else rows)
+    if next_part is not None and len(rows) == limit:
+        response.headers['X-Next-Part'] = str(next_part)
+    return response
+
 def get_next_sequence_value(sequence_name):
     try:
         conn = get_db_connection()
@@ -36,6 +75,41 @@ def get_next_sequence_value(sequence_name):
         logging.error(f"Error getting next sequence value: {e}")
         return None
 
+def reserve_sequence_block(cursor, sequence_name, count):
+    """ Reserve `count` consecutive sequence values on the caller's transaction; returns the first. """
+    cursor.execute('''INSERT INTO counters (id, sequence_value) VALUES (?, ?)
+                      ON CONFLICT(id) DO UPDATE SET sequence_value=sequence_value+? WHERE id=?''',
+                   (sequence_name, count, count, sequence_name))
+    cursor.execute('SELECT sequence_value FROM counters WHERE id=?', (sequence_name,))
+    return cursor.fetchone()[0] - count + 1
+
+def apply_batch(cursor, items, apply_item):
+    """ Run apply_item(cursor, index, item) for every item inside its own savepoint.
+
+    A failing item is rolled back on its own and reported; the others still go
+    through when the caller commits the surrounding transaction, which is opened
+    here if the caller has not already (an outermost RELEASE would commit each item).
+    """
+    if not cursor.connection.in_transaction:
+        cursor.execute('BEGIN IMMEDIATE')
+    results = []
+    for index, item in enumerate(items):
+        cursor.execute('SAVEPOINT batch_item')
+        try:
+            result = apply_item(cursor, index, item)
+            cursor.execute('RELEASE SAVEPOINT batch_item')
+            results.append({'index': index, 'status': 'success', 'data': result})
+        except Exception as e:
+            cursor.execute('ROLLBACK TO SAVEPOINT batch_item')
+            cursor.execute('RELEASE SAVEPOINT batch_item')
+            results.append({'index': index, 'status': 'error', 'message': str(e)})
+    return results
+
+def batch_response(results):
+    failed = sum(1 for result in results if result['status'] == 'error')
+    status = 'success' if failed == 0 else ('error' if failed == len(results) else 'partial')
+    return jsonify({'status': status, 'succeeded': len(results) - failed, 'failed': failed, 'results': results}), 200
+
 @app.route('/submit_river_data', methods=['POST'])
 def submit_river_data():
     try:
@@ -52,6 +126,7 @@ def submit_river_data():
             INSERT INTO riverData (riverName, location, latitude, longitude, status, created_at, updated_at)
             VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
         ''', (riverName, location, latitude, longitude, status))
+        index_river(cursor, cursor.lastrowid)
         conn.commit()
         conn.close()
 
@@ -76,6 +151,7 @@ def update_river_info(riverID):
             SET riverName = ?, location = ?, latitude = ?, longitude = ?, status = ?, updated_at = CURRENT_TIMESTAMP
             WHERE riverID = ?
         ''', (riverName, location, latitude, longitude, status, riverID))
+        index_river(cursor, riverID)
         conn.commit()
         conn.close()
 
@@ -85,7 +161,7 @@ def update_river_info(riverID):
 
 @app.route('/get_rivers', methods=['GET'])
 def get_rivers():
-    conn = get_db_connection()
+    conn = get_read_connection()
     rivers = conn.execute('SELECT * FROM riverData').fetchall()
     conn.close()
     return jsonify({'rivers': [dict(ix) for ix in rivers]}), 200
@@ -103,9 +179,12 @@ def submit_sensor_info():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''INSERT INTO sensorInfo (sensorID, sensorName, location, lat, long, created_at, updatedAt, riverID, status)
-                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
-                       (sensor_data['sensorID'], sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['created_at'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status']))
+        cursor.execute('''INSERT INTO sensorInfo (sensorID, sensorName, location, lat, long, created_at, updatedAt, riverID, status, readFrequency)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (sensor_data['sensorID'], sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['created_at'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status'], sensor_data.get('readFrequency')))
+        record_placement(cursor, sensor_data['sensorID'], sensor_data['riverID'], sensor_data['location'], sensor_data['lat'], sensor_data['long'],
+                         sensor_data['created_at'], sensor_data.get('notes'), sensor_data.get('movedBy'))
+        index_sensor(cursor, sensor_data['sensorID'])
         
         conn.commit()
         conn.close()
@@ -128,9 +207,14 @@ def update_sensor_info(sensorID):
         cursor = conn.cursor()
         
         cursor.execute('''UPDATE sensorInfo 
-                          SET sensorName = ?, location = ?, lat = ?, long = ?, updatedAt = ?, riverID = ?, status = ?
+                          SET sensorName = ?, location = ?, lat = ?, long = ?, updatedAt = ?, riverID = ?, status = ?,
+                              readFrequency = COALESCE(?, readFrequency)
                           WHERE sensorID = ?''',
-                       (sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status'], sensorID))
+                       (sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status'], sensor_data.get('readFrequency'), sensorID))
+        # A change of river or position closes the old placement, so earlier readings keep their place
+        record_placement(cursor, sensorID, sensor_data['riverID'], sensor_data['location'], sensor_data['lat'], sensor_data['long'],
+                         sensor_data.get('movedAt', sensor_data['updatedAt']), sensor_data.get('notes'), sensor_data.get('movedBy'))
+        index_sensor(cursor, sensorID)
         
         conn.commit()
         conn.close()
@@ -141,10 +225,109 @@ def update_sensor_info(sensorID):
         logging.error(f"Error updating sensor info: {e}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/submit_river_data_batch', methods=['POST'])
+def submit_river_data_batch():
+    try:
+        rivers = request.json
+        if not isinstance(rivers, list):
+            return jsonify({'status': 'error', 'message': 'Expected a JSON array of rivers'}), 400
+        logging.debug(f"Received {len(rivers)} rivers")
+
+        def insert_river(cursor, index, data):
+            cursor.execute('''
+                INSERT INTO riverData (riverName, location, latitude, longitude, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP, CURRENT_TIMESTAMP)
+            ''', (data['riverName'], data['location'], data['latitude'], data['longitude'], data['status']))
+            riverID = cursor.lastrowid
+            index_river(cursor, riverID)
+            return dict(data, riverID=riverID)
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        results = apply_batch(cursor, rivers, insert_river)
+        conn.commit()
+        conn.close()
+
+        return batch_response(results)
+    except Exception as e:
+        logging.error(f"Error storing river batch: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/submit_sensor_info_batch', methods=['POST'])
+def submit_sensor_info_batch():
+    try:
+        sensors = request.json
+        if not isinstance(sensors, list):
+            return jsonify({'status': 'error', 'message': 'Expected a JSON array of sensors'}), 400
+        logging.debug(f"Received {len(sensors)} sensors")
+
+        now = datetime.now(timezone.utc)
+        conn = get_db_connection()
+        cursor = conn.cursor()
+
+        # One counters update for the whole batch instead of one connection and commit per sensor
+        first_id = reserve_sequence_block(cursor, 'sensorID', len(sensors)) if sensors else None
+
+        def insert_sensor(cursor, index, sensor_data):
+            sensor_data = dict(sensor_data, sensorID=first_id + index, created_at=now, updatedAt=now)
+            cursor.execute('''INSERT INTO sensorInfo (sensorID, sensorName, location, lat, long, created_at, updatedAt, riverID, status, readFrequency)
+                              VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                           (sensor_data['sensorID'], sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['created_at'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status'], sensor_data.get('readFrequency')))
+            record_placement(cursor, sensor_data['sensorID'], sensor_data['riverID'], sensor_data['location'], sensor_data['lat'], sensor_data['long'],
+                             now, sensor_data.get('notes'), sensor_data.get('movedBy'))
+            index_sensor(cursor, sensor_data['sensorID'])
+            return sensor_data
+
+        results = apply_batch(cursor, sensors, insert_sensor)
+        conn.commit()
+        conn.close()
+
+        logging.debug(f"Sensor batch stored: {len(results)} items")
+        return batch_response(results)
+    except Exception as e:
+        logging.error(f"Error storing sensor batch: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/update_sensor_info_batch', methods=['PUT'])
+def update_sensor_info_batch():
+    try:
+        sensors = request.json
+        if not isinstance(sensors, list):
+            return jsonify({'status': 'error', 'message': 'Expected a JSON array of sensors'}), 400
+        logging.debug(f"Received {len(sensors)} sensor updates")
+
+        now = datetime.now(timezone.utc)
+
+        def update_sensor(cursor, index, sensor_data):
+            sensor_data = dict(sensor_data, updatedAt=now)
+            cursor.execute('''UPDATE sensorInfo
+                              SET sensorName = ?, location = ?, lat = ?, long = ?, updatedAt = ?, riverID = ?, status = ?,
+                                  readFrequency = COALESCE(?, readFrequency)
+                              WHERE sensorID = ?''',
+                           (sensor_data['sensorName'], sensor_data['location'], sensor_data['lat'], sensor_data['long'], sensor_data['updatedAt'], sensor_data['riverID'], sensor_data['status'], sensor_data.get('readFrequency'), sensor_data['sensorID']))
+            if cursor.rowcount == 0:
+                raise ValueError(f"Unknown sensorID {sensor_data['sensorID']}")
+            record_placement(cursor, sensor_data['sensorID'], sensor_data['riverID'], sensor_data['location'], sensor_data['lat'], sensor_data['long'],
+                             sensor_data.get('movedAt', now), sensor_data.get('notes'), sensor_data.get('movedBy'))
+            index_sensor(cursor, sensor_data['sensorID'])
+            return sensor_data
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        results = apply_batch(cursor, sensors, update_sensor)
+        conn.commit()
+        conn.close()
+
+        logging.debug(f"Sensor update batch applied: {len(results)} items")
+        return batch_response(results)
+    except Exception as e:
+        logging.error(f"Error updating sensor batch: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/get_locations', methods=['GET'])
 def get_locations():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
 
         cursor.execute('SELECT riverID, location FROM riverData')
@@ -156,10 +339,28 @@ def get_locations():
         logging.error(f"Error fetching locations: {e}", exc_info=True)
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/search', methods=['GET'])
+def search_sites():
+    try:
+        text = request.args.get('q', '')
+        kind = request.args.get('kind')
+        riverID = request.args.get('riverID')
+        limit = min(int(request.args.get('limit', 20)), 100)
+
+        conn = get_read_connection()
+        results = search(conn, text, kind, int(riverID) if riverID else None, limit)
+        conn.close()
+        return jsonify(results)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error searching for {request.args.get('q')}: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/get_sensors', methods=['GET'])
 def get_sensors():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
 
         cursor.execute('SELECT sensorID, sensorName, status, location, lat, long FROM sensorInfo')
@@ -178,7 +379,7 @@ def get_sensor_names():
         riverID = request.args.get('riverID')
         riverID = int(riverID)
         #logging.debug(f"Received riverID: {riverID}")
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
 
         cursor.execute('SELECT sensorName FROM sensorInfo WHERE riverID =?',(riverID,))
@@ -198,7 +399,7 @@ def get_river_name():
         riverID = request.args.get('riverID')
         riverID = int(riverID)
         logging.debug(f"Received riverID: {riverID}")
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
 
         cursor.execute('SELECT riverName FROM riverData WHERE riverID = ?',(riverID,))
@@ -215,26 +416,13 @@ def get_sensor_data():
     try:
         sensor_id = request.args.get('SensorID')
         app.logger.debug(f'Received sensor_id: {sensor_id}')
-        page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 100000))
-        offset = (page - 1) * limit
-
-        conn = get_db_connection()
-        cursor = conn.cursor()
-
-        cursor.execute('''
-            SELECT * FROM SensorData WHERE SensorID = ?
-            LIMIT ? OFFSET ?
-        ''', (sensor_id,limit, offset))
-        sensors = [dict(row) for row in cursor.fetchall()]
+        offset, limit, next_part = page_window()
 
-        cursor.execute('SELECT COUNT(*) FROM SensorData')
-        total_records = cursor.fetchone()[0]
-        total_pages = (total_records + limit - 1) // limit
+        # The sensor's whole history: rolled monthly partitions first, then the hot months
+        sensors = query_range(sensor_id, max_rows=limit, offset=offset, on_connect=limit_query_time)
 
-        conn.close()
         #app.logger.debug(f'Received:{sensors}')
-        return jsonify(sensors)
+        return page_part(sensors, limit, next_part)
         '''return jsonify({
             'sensors': sensors,
             'page': page,
@@ -248,11 +436,16 @@ def get_todays_sensor_data():
     try:
         sensor_id = request.args.get('SensorID')
         app.logger.debug(f'Received sensor_id: {sensor_id}')
-        page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 100000))
-        offset = (page - 1) * limit
+        offset, limit, next_part = page_window()
 
-        conn = get_db_connection()
+        # Today's readings are normally still held by the ingest process, and always fall in
+        # the hot window of the main database (partitions.py only rolls closed months)
+        today = datetime.now(timezone.utc).strftime('%Y-%m-%d')
+        sensors = fetch_recent(recent_address, recent_authkey, sensor_id, today, '9999-12-31')
+        if sensors is not None:
+            return page_part(sensors[offset:offset + limit], limit, next_part)
+
+        conn = get_read_connection()
         cursor = conn.cursor()
     
         cursor.execute('''
@@ -262,12 +455,8 @@ def get_todays_sensor_data():
         ''', (sensor_id,limit, offset))
         sensors = [dict(row) for row in cursor.fetchall()]
 
-        cursor.execute('SELECT COUNT(*) FROM SensorData WHERE date(created_at) = date(\'now\')')
-        total_records = cursor.fetchone()[0]
-        total_pages = (total_records + limit - 1) // limit
-
         conn.close()
-        return jsonify(sensors)
+        return page_part(sensors, limit, next_part)
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
     
@@ -275,10 +464,12 @@ def get_todays_sensor_data():
 def get_data():
     try:
         page = int(request.args.get('page', 1))
-        limit = int(request.args.get('limit', 10,000))
+        limit = row_limit(10000)
         offset = (page - 1) * limit
 
-        conn = get_db_connection()
+        # Hot window only: a raw dump of every sensor in the main database; rolled months
+        # are read per sensor through /get_sensor_data or /get_sensor_data_range
+        conn = get_read_connection()
         cursor = conn.cursor()
     
         cursor.execute('''
@@ -292,15 +483,582 @@ def get_data():
         total_pages = (total_records + limit - 1) // limit
 
         conn.close()
+        if request.args.get('format') == 'compact':
+            return jsonify(compact_rows(sensors))
         return jsonify(sensors)
        
     except Exception as e:
         return jsonify({'status': 'error', 'message': str(e)}), 500
 
+@app.route('/get_sensor_data_range', methods=['GET'])
+def get_sensor_data_range():
+    try:
+        sensor_id = request.args.get('SensorID')
+        start = request.args.get('from')
+        end = request.args.get('to', datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S'))
+        app.logger.debug(f'Received sensor_id: {sensor_id}, range: {start} - {end}')
+        if not sensor_id or not start:
+            return jsonify({'status': 'error', 'message': 'SensorID and from are required'}), 400
+
+        # Recent windows come from the ingest process; otherwise fan out to the monthly
+        # partitions overlapping the range, then the hot months
+        sensors = fetch_recent(recent_address, recent_authkey, sensor_id, start, end)
+        if sensors is not None:
+            sensors = sensors[:MAX_ROWS_PER_RESPONSE]
+        else:
+            sensors = query_range(sensor_id, start, end, max_rows=MAX_ROWS_PER_RESPONSE, on_connect=limit_query_time)
+        if request.args.get('placement') == 'history':
+            # River and position where the sensor was at each reading, not what was copied at insert
+            conn = get_read_connection()
+            get_placement_index(conn).place_rows(sensors)
+            conn.close()
+
+        if request.args.get('format') == 'compact':
+            return jsonify(compact_rows(sensors))
+        return jsonify(sensors)
+    except Exception as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_sensor_rollup', methods=['GET'])
+def get_sensor_rollup():
+    try:
+        sensor_id = request.args.get('SensorID')
+        start = request.args.get('from', '0000-00-00')
+        end = request.args.get('to', '9999-12-31')
+
+        conn = get_read_connection()
+        cursor = conn.cursor()
+
+        cursor.execute('''
+            SELECT * FROM SensorDataRollup
+            WHERE SensorID = ? AND hour >= ? AND hour < ?
+            ORDER BY hour LIMIT ?
+        ''', (sensor_id, start, end, MAX_ROWS_PER_RESPONSE))
+        rollup = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return jsonify(rollup)
+    except Exception as e:
+        logging.error(f"Error fetching rollup: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def sensor_registered(conn, sensor_id):
+    return conn.execute('SELECT 1 FROM sensorInfo WHERE sensorName = ?', (sensor_id,)).fetchone() is not None
+
+@app.route('/tiles/<sensor_id>', methods=['GET'])
+def get_tile_info(sensor_id):
+    try:
+        conn = get_read_connection()
+        try:
+            if not sensor_registered(conn, sensor_id):
+                return jsonify({'status': 'error', 'message': 'Sensor not found'}), 404
+            info = tile_info(conn, sensor_id, on_connect=limit_query_time)
+        finally:
+            conn.close()
+        response = jsonify(info)
+        # The generation changes when history is rewritten; clients must see that at once
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    except Exception as e:
+        logging.error(f"Error fetching tile info: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/tiles/<sensor_id>/<metric>/<int:level>/<int:index>', methods=['GET'])
+def get_chart_tile(sensor_id, metric, level, index):
+    try:
+        conn = get_read_connection()
+        try:
+            if not sensor_registered(conn, sensor_id):
+                return jsonify({'status': 'error', 'message': 'Sensor not found'}), 404
+            body, finished, generation = tile_body(conn, tile_cache, sensor_id, metric, level, index,
+                                                   on_connect=limit_query_time)
+        finally:
+            conn.close()
+        response = Response(body, mimetype='application/json')
+        if finished and request.args.get('g') == str(generation):
+            # ?g= names the generation, so this URL's content never changes
+            response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        elif finished:
+            response.headers['Cache-Control'] = 'no-cache'
+        else:
+            response.headers['Cache-Control'] = f'public, max-age={OPEN_TILE_MAX_AGE}'
+        response.set_etag(f'{sensor_id}-{generation}-{metric}-{level}-{index}' if finished
+                          else hashlib.md5(body).hexdigest(), weak=True)
+        return response.make_conditional(request)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error fetching chart tile: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_completeness', methods=['GET'])
+def get_completeness():
+    try:
+        start = request.args.get('from', datetime.now(timezone.utc).strftime('%Y-%m-%d'))
+        end = request.args.get('to', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        riverID = request.args.get('riverID')
+        riverID = int(riverID) if riverID else None
+
+        conn = get_read_connection()
+        report = completeness_report(conn, start, end, riverID,
+                                     include_days=request.args.get('days') == '1',
+                                     include_gaps=request.args.get('gaps') == '1')
+        conn.close()
+        return jsonify(report)
+    except Exception as e:
+        logging.error(f"Error computing completeness: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_reading_gaps', methods=['GET'])
+def get_reading_gaps():
+    try:
+        sensor_id = request.args.get('SensorID')
+        riverID = request.args.get('riverID')
+        start = request.args.get('from', '0000-00-00')
+
+        conn = get_read_connection()
+        cursor = conn.cursor()
+
+        if sensor_id:
+            cursor.execute('SELECT * FROM readingGap WHERE SensorID = ? AND gap_start >= ? ORDER BY gap_start LIMIT ?',
+                           (sensor_id, start, MAX_ROWS_PER_RESPONSE))
+        elif riverID:
+            cursor.execute('SELECT * FROM readingGap WHERE riverID = ? AND gap_start >= ? ORDER BY gap_start LIMIT ?',
+                           (int(riverID), start, MAX_ROWS_PER_RESPONSE))
+        else:
+            cursor.execute('SELECT * FROM readingGap WHERE gap_start >= ? ORDER BY gap_start LIMIT ?',
+                           (start, MAX_ROWS_PER_RESPONSE))
+        gaps = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return jsonify(gaps)
+    except Exception as e:
+        logging.error(f"Error fetching reading gaps: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_freshness', methods=['GET'])
+def get_freshness():
+    try:
+        sensor_id = request.args.get('SensorID')
+        riverID = request.args.get('riverID')
+
+        conn = get_read_connection()
+        try:
+            if sensor_id:
+                sensors = sensor_freshness(conn, sensor_name=sensor_id)
+                if not sensors:
+                    return jsonify({'status': 'error', 'message': 'Sensor not found'}), 404
+                return jsonify(sensors[0])
+            if riverID:
+                return jsonify(river_freshness(conn, int(riverID)))
+            return jsonify(sensor_freshness(conn))
+        finally:
+            conn.close()
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error fetching freshness: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_aligned_data', methods=['GET'])
+def get_aligned_data():
+    try:
+        sensor_ids = [s for s in request.args.get('SensorID', '').split(',') if s]
+        riverID = request.args.get('riverID')
+        metrics = request.args.get('metrics', 'percent_dissolved_oxygen').split(',')
+        start = request.args.get('from')
+        end = request.args.get('to', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        step = int(request.args.get('step', 900))
+        method = request.args.get('method', 'linear')
+
+        conn = get_read_connection()
+        if riverID and not sensor_ids:
+            sensor_ids = [row['sensorName'] for row in conn.execute(
+                'SELECT sensorName FROM sensorInfo WHERE riverID = ? ORDER BY sensorName', (int(riverID),))]
+        if not sensor_ids or not start or step <= 0:
+            conn.close()
+            return jsonify({'status': 'error', 'message': 'SensorID or riverID, from and a positive step are required'}), 400
+        chunks = iter_aligned_chunks(conn, sensor_ids, metrics, start, end, step, method)
+        # Validate arguments before the response starts streaming
+        first_chunk = next(chunks, None)
+
+        budget = g.get('budget')
+
+        def generate():
+            header = {'sensors': sensor_ids, 'metrics': metrics, 'step': step, 'method': method,
+                      'columns': [f'{s}.{m}' for s in sensor_ids for m in metrics]}
+            yield json.dumps(header)[:-1] + ', "rows": ['
+            separator = ''
+            error = None
+            try:
+                chunk = first_chunk
+                while chunk is not None:
+                    grid, matrix = chunk
+                    if len(grid):
+                        yield separator + encode_rows(grid, matrix)
+                        separator = ','
+                    if budget is not None and time.monotonic() > budget.deadline:
+                        budget.exceeded = True
+                        raise TimeoutError('aligned data time budget')
+                    chunk = next(chunks, None)
+            except Exception as e:
+                # The 200 is already sent: end the document well-formed and say why the rows stop
+                logging.error(f"Aligned data stream stopped: {e}", exc_info=True)
+                error = str(e)
+                if budget is not None and budget.exceeded:
+                    error = f'Query exceeded its {budget.budget_seconds}s time budget; narrow the range'
+            finally:
+                conn.close()
+            yield ']' + (f', "error": {json.dumps(error)}' if error else '') + '}'
+
+        return Response(stream_with_context(generate()), mimetype='application/json')
+    except Exception as e:
+        logging.error(f"Error aligning sensor data: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def encode_rows(grid, matrix):
+    """ JSON rows [time, value, ...] of one aligned chunk, without the enclosing brackets. """
+    values = np.round(matrix, 3).astype(object)
+    values[np.isnan(matrix)] = None
+    times = [t.replace('T', ' ') for t in epoch_to_text(grid).tolist()]
+    return json.dumps([[t] + v for t, v in zip(times, values.tolist())])[1:-1]
+
+@app.route('/get_river_lags', methods=['GET'])
+def get_river_lags():
+    try:
+        riverID = request.args.get('riverID')
+        metric = request.args.get('metric', 'percent_dissolved_oxygen')
+        start = request.args.get('from')
+        end = request.args.get('to', datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+        if not riverID or not start:
+            return jsonify({'status': 'error', 'message': 'riverID and from are required'}), 400
+        riverID = int(riverID)
+        window_hours = float(request.args.get('window_hours', 24))
+        max_lag_hours = float(request.args.get('max_lag_hours', 6))
+
+        conn = get_read_connection()
+        sensor_ids = [row['sensorName'] for row in conn.execute(
+            "SELECT sensorName FROM sensorInfo WHERE riverID = ? AND status = 'active' ORDER BY sensorName", (riverID,))]
+        conn.close()
+
+        result = analyse_river(database_file, riverID, sensor_ids, metric, start, end,
+                               window_hours=window_hours, max_lag_hours=max_lag_hours, on_connect=limit_query_time)
+        return jsonify(result)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error analysing river lags: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_river_divergence', methods=['GET'])
+def get_river_divergence():
+    try:
+        riverID = request.args.get('riverID')
+        start = request.args.get('from', '0000-00-00')
+
+        conn = get_read_connection()
+        cursor = conn.cursor()
+
+        # Filled in by the nightly `python river_analytics.py` fleet run
+        if riverID:
+            cursor.execute('''SELECT * FROM riverPairLag WHERE divergent = 1 AND window_start >= ? AND riverID = ?
+                              ORDER BY window_start''', (start, int(riverID)))
+        else:
+            cursor.execute('SELECT * FROM riverPairLag WHERE divergent = 1 AND window_start >= ? ORDER BY window_start',
+                           (start,))
+        windows = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return jsonify(windows)
+    except Exception as e:
+        logging.error(f"Error fetching river divergence: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_sensor_placements', methods=['GET'])
+def get_sensor_placements():
+    try:
+        sensor_id = request.args.get('sensorID')
+        at = request.args.get('at')
+
+        conn = get_read_connection()
+        cursor = conn.cursor()
+
+        if at:
+            # Where every sensor was at one moment, answered from the in-memory interval index
+            index = get_placement_index(conn)
+            sensors = [row['sensorID'] for row in cursor.execute('SELECT sensorID FROM sensorInfo ORDER BY sensorID')]
+            riverIDs, riverNames, locations, latlongs = index.locate(sensors, [at] * len(sensors))
+            placements = [{'sensorID': s, 'riverID': r, 'riverName': n, 'location': l, 'latlong': ll}
+                          for s, r, n, l, ll in zip(sensors, riverIDs, riverNames, locations, latlongs) if r is not None]
+        elif sensor_id:
+            cursor.execute('SELECT * FROM sensorPlace WHERE sensorID = ? ORDER BY date_from', (int(sensor_id),))
+            placements = [dict(row) for row in cursor.fetchall()]
+        else:
+            cursor.execute('SELECT * FROM sensorPlace ORDER BY sensorID, date_from')
+            placements = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return jsonify(placements)
+    except Exception as e:
+        logging.error(f"Error fetching sensor placements: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/alert_rules', methods=['GET'])
+def get_alert_rules():
+    try:
+        conn = get_read_connection()
+        rules = [dict(row) for row in conn.execute('SELECT * FROM alertRule ORDER BY ruleID').fetchall()]
+        conn.close()
+        return jsonify(rules)
+    except Exception as e:
+        logging.error(f"Error fetching alert rules: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/alert_rules', methods=['POST'])
+def submit_alert_rule():
+    try:
+        rule = request.json
+        try:
+            validate_rule(rule)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': f'Invalid rule: {e}'}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute('''INSERT INTO alertRule (name, metric, kind, threshold, duration_minutes, riverID, sensorName, enabled)
+                          VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                       (rule.get('name', f"{rule['metric']} {rule['kind']} {rule['threshold']}"), rule['metric'], rule['kind'],
+                        rule['threshold'], rule.get('duration_minutes', 0), rule.get('riverID'), rule.get('sensorName'),
+                        int(rule.get('enabled', True))))
+        rule['ruleID'] = cursor.lastrowid
+        conn.commit()
+        conn.close()
+
+        logging.debug(f"Alert rule {rule['ruleID']} stored")
+        return jsonify({'status': 'success', 'data': rule}), 200
+    except Exception as e:
+        logging.error(f"Error storing alert rule: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/alert_rules/<int:ruleID>', methods=['PUT'])
+def update_alert_rule(ruleID):
+    try:
+        rule = request.json
+        try:
+            validate_rule(rule)
+        except (ValueError, KeyError, TypeError) as e:
+            return jsonify({'status': 'error', 'message': f'Invalid rule: {e}'}), 400
+
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        # updated_at changes the rule signature, which makes the ingest reload its rules
+        cursor.execute('''UPDATE alertRule
+                          SET name = COALESCE(?, name), metric = ?, kind = ?, threshold = ?, duration_minutes = ?,
+                              riverID = ?, sensorName = ?, enabled = ?, updated_at = ?
+                          WHERE ruleID = ?''',
+                       (rule.get('name'), rule['metric'], rule['kind'], rule['threshold'], rule.get('duration_minutes', 0),
+                        rule.get('riverID'), rule.get('sensorName'), int(rule.get('enabled', True)),
+                        datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f'), ruleID))
+        updated = cursor.rowcount
+        conn.commit()
+        conn.close()
+
+        if not updated:
+            return jsonify({'status': 'error', 'message': f'Unknown ruleID {ruleID}'}), 404
+        return jsonify({'status': 'success', 'data': dict(rule, ruleID=ruleID)}), 200
+    except Exception as e:
+        logging.error(f"Error updating alert rule: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_alerts', methods=['GET'])
+def get_alerts():
+    try:
+        sensor_id = request.args.get('SensorID')
+        riverID = request.args.get('riverID')
+        start = request.args.get('from', '0000-00-00')
+
+        query = 'SELECT * FROM alertEvent WHERE fired_at >= ?'
+        params = [start]
+        if request.args.get('active') == '1':
+            query += ' AND cleared_at IS NULL'
+        if sensor_id:
+            query += ' AND SensorID = ?'
+            params.append(sensor_id)
+        if riverID:
+            query += ' AND riverID = ?'
+            params.append(int(riverID))
+
+        conn = get_read_connection()
+        alerts = [dict(row) for row in conn.execute(query + ' ORDER BY fired_at DESC LIMIT ?',
+                                                    params + [MAX_ROWS_PER_RESPONSE]).fetchall()]
+        conn.close()
+        return jsonify(alerts)
+    except Exception as e:
+        logging.error(f"Error fetching alerts: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+def admin_authorized():
+    """The admin routes need the same signed token as a profiled request."""
+    return valid_token(request.headers.get(PROFILE_HEADER), profile_secret)
+
+@app.route('/admin/profile', methods=['POST'])
+def start_profile():
+    if not admin_authorized():
+        return jsonify({'status': 'error', 'message': 'A valid X-Profile token is required'}), 403
+    try:
+        data = request.get_json(silent=True) or {}
+        target = data.get('target', 'api')
+        seconds = float(data.get('seconds', 10))
+        if target == 'api':
+            seconds = start_window(profile_dir, seconds, 'api')
+        elif target == 'ingest':
+            seconds = profile_ingest(recent_address, recent_authkey, seconds)
+            if seconds is None:
+                return jsonify({'status': 'error', 'message': 'The ingest process is not reachable'}), 503
+        else:
+            return jsonify({'status': 'error', 'message': "target must be 'api' or 'ingest'"}), 400
+        return jsonify({'status': 'success', 'target': target, 'seconds': seconds}), 202
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error starting profile: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/admin/profiles', methods=['GET'])
+def get_profiles():
+    if not admin_authorized():
+        return jsonify({'status': 'error', 'message': 'A valid X-Profile token is required'}), 403
+    try:
+        return jsonify(list_profiles(profile_dir))
+    except Exception as e:
+        logging.error(f"Error listing profiles: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/admin/profiles/<name>', methods=['GET'])
+def download_profile(name):
+    if not admin_authorized():
+        return jsonify({'status': 'error', 'message': 'A valid X-Profile token is required'}), 403
+    try:
+        path = profile_path(profile_dir, name)
+        if path is None:
+            return jsonify({'status': 'error', 'message': 'Profile not found'}), 404
+        with open(path) as f:
+            body = f.read()
+        # Collapsed stacks: flamegraph.pl name.folded > name.svg, or drop the file on speedscope
+        return Response(body, mimetype='text/plain',
+                        headers={'Content-Disposition': f'attachment; filename={name}.folded'})
+    except Exception as e:
+        logging.error(f"Error downloading profile: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/admin/sql', methods=['GET', 'DELETE'])
+def sql_stats():
+    if not admin_authorized():
+        return jsonify({'status': 'error', 'message': 'A valid X-Profile token is required'}), 403
+    try:
+        target = request.args.get('target', 'api')
+        sort = request.args.get('sort', 'total')
+        limit = min(int(request.args.get('limit', 50)), 500)
+        if target == 'api':
+            if request.method == 'DELETE':
+                database.STATS.reset()
+                return jsonify({'status': 'success'})
+            return jsonify(database.STATS.snapshot(sort, limit))
+        if target != 'ingest':
+            return jsonify({'status': 'error', 'message': "target must be 'api' or 'ingest'"}), 400
+        stats = ingest_sql_stats(recent_address, recent_authkey, 'reset' if request.method == 'DELETE' else sort, limit)
+        if stats is None:
+            return jsonify({'status': 'error', 'message': 'The ingest process is not reachable'}), 503
+        if isinstance(stats, str):
+            return jsonify({'status': 'error', 'message': stats}), 400
+        return jsonify(stats)
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error fetching SQL statistics: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/bulk_ingest', methods=['POST'])
+def bulk_ingest():
+    try:
+        fmt = request.args.get('format') or ('ndjson' if 'json' in request.mimetype else 'csv')
+        conn = get_db_connection()
+        try:
+            # request.stream: the body is parsed as it arrives, never read into memory
+            summary = ingest(conn, request.stream, fmt, request.args.get('SensorID'))
+        finally:
+            conn.close()
+        for sensor, newest in summary['newest'].items():
+            invalidate_recent(recent_address, recent_authkey, sensor, newest)
+        return jsonify({'status': 'success', **summary})
+    except ValueError as e:
+        return jsonify({'status': 'error', 'message': str(e)}), 400
+    except Exception as e:
+        logging.error(f"Error in bulk ingest: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/get_latest_readings', methods=['GET'])
+def get_latest_readings():
+    try:
+        riverID = request.args.get('riverID')
+
+        conn = get_read_connection()
+        cursor = conn.cursor()
+
+        if riverID:
+            cursor.execute('SELECT * FROM latest_reading WHERE riverID = ?', (int(riverID),))
+        else:
+            cursor.execute('SELECT * FROM latest_reading')
+        readings = [dict(row) for row in cursor.fetchall()]
+
+        conn.close()
+        return jsonify(readings)
+    except Exception as e:
+        logging.error(f"Error fetching latest readings: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/river_geometry/<int:riverID>', methods=['GET'])
+def get_river_geometry(riverID):
+    try:
+        zoom = request.args.get('zoom', 12)
+
+        conn = get_read_connection()
+        result = get_encoded_geometry(conn, riverID, zoom)
+        conn.close()
+        if result is None:
+            return jsonify({'status': 'error', 'message': f'No geometry stored for river {riverID}'}), 404
+
+        etag, body = result
+        # Geometry only changes when it is re-uploaded, which changes the ETag
+        headers = {'ETag': f'"{etag}"', 'Cache-Control': 'public, max-age=86400'}
+        if request.if_none_match.contains(etag):
+            return Response(status=304, headers=headers)
+        return Response(body, mimetype='application/geo+json', headers=headers)
+    except Exception as e:
+        logging.error(f"Error fetching river geometry: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
+@app.route('/river_geometry/<int:riverID>', methods=['PUT'])
+def update_river_geometry(riverID):
+    try:
+        geojson = request.json
+
+        conn = get_db_connection()
+        create_river_geometry_table(conn.cursor())
+        etag = store_geometry(conn, riverID, geojson)
+        conn.commit()
+        conn.close()
+
+        logging.debug(f"Stored geometry for river {riverID}")
+        return jsonify({'status': 'success', 'riverID': riverID, 'etag': etag}), 200
+    except Exception as e:
+        logging.error(f"Error storing river geometry: {e}", exc_info=True)
+        return jsonify({'status': 'error', 'message': str(e)}), 500
+
 @app.route('/get_sensors_for_map', methods=['GET'])
 def get_sensors_for_map():
     try:
-        conn = get_db_connection()
+        conn = get_read_connection()
         cursor = conn.cursor()
         
         cursor.execute('SELECT * FROM sensorInfo')
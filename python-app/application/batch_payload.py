@@ -0,0 +1,80 @@
+# batch_payload.py
+# Batched MQTT payloads: many readings of one sensor in a single message, for gateways
+# that buffer readings while offline and catch up afterwards.
+#
+#   byte 0        format version, BATCH_VERSION (a single-reading payload starts with '{')
+#   byte 1        length n of the sensor name
+#   n bytes       sensor name, UTF-8
+#   uint16        number of readings
+#   readings      RECORD (20 bytes each, little-endian): sensor time as Unix seconds (UTC,
+#                 0 = unknown), message counter, temperature, % DO, mg/L DO as float32
+#                 (NaN = not measured)
+#
+# decode_batch() checks the framing and reads all the readings with one np.frombuffer.
+#
+# $python batch_payload.py sensor022 < readings.csv > batch.bin  (date,time,counter,temp,%DO,mg/L rows)
+
+import struct
+import sys
+from datetime import datetime, timezone
+import numpy as np
+
+BATCH_VERSION = 1
+MAX_READINGS = 65535
+RECORD = np.dtype([('time', '<u4'), ('counter', '<u4'), ('temperature', '<f4'),
+                   ('percent_dissolved_oxygen', '<f4'), ('mg_per_l_dissolved_oxygen', '<f4')])
+# float32 keeps ~7 significant digits; round back to what the sensor sent
+VALUE_DECIMALS = 4
+
+
+def is_batch(payload):
+    return payload[:1] == bytes((BATCH_VERSION,))
+
+
+def encode_batch(sensor_name, readings):
+    """Payload for (unix_seconds, counter, temperature, %DO, mg/L) tuples of one sensor."""
+    name = sensor_name.encode('utf-8')
+    if not name or len(name) > 255:
+        raise ValueError('sensor name must be 1-255 bytes')
+    records = np.array([tuple(r) for r in readings], dtype=RECORD)
+    if len(records) > MAX_READINGS:
+        raise ValueError(f'at most {MAX_READINGS} readings per batch')
+    return bytes((BATCH_VERSION, len(name))) + name + struct.pack('<H', len(records)) + records.tobytes()
+
+
+def decode_batch(payload):
+    """(sensor_name, records) from a batched payload; raises ValueError if it is malformed."""
+    if len(payload) < 4 or payload[0] != BATCH_VERSION:
+        raise ValueError(f'not a version {BATCH_VERSION} batch')
+    name_end = 2 + payload[1]
+    sensor_name = bytes(payload[2:name_end]).decode('utf-8')
+    if not sensor_name or len(payload) < name_end + 2:
+        raise ValueError('truncated batch header')
+    (count,) = struct.unpack_from('<H', payload, name_end)
+    body = name_end + 2
+    if len(payload) != body + count * RECORD.itemsize:
+        raise ValueError(f'batch of {count} readings should be {body + count * RECORD.itemsize} bytes, got {len(payload)}')
+    return sensor_name, np.frombuffer(payload, dtype=RECORD, count=count, offset=body)
+
+
+def reading_values(records):
+    """The three measurements as float64 columns, rounded back from float32; NaN stays NaN."""
+    return [np.round(records[name].astype(np.float64), VALUE_DECIMALS)
+            for name in ('temperature', 'percent_dissolved_oxygen', 'mg_per_l_dissolved_oxygen')]
+
+
+def sensor_times(records):
+    """created_at text (as SQLite stores a naive UTC datetime) per reading; None where the time is 0."""
+    text = records['time'].astype('datetime64[s]').astype(str)
+    text = np.char.replace(text, 'T', ' ')
+    return [None if t == 0 else s for t, s in zip(records['time'].tolist(), text.tolist())]
+
+
+if __name__ == '__main__':
+    sensor = sys.argv[1]
+    readings = []
+    for line in sys.stdin:
+        date, time, counter, temperature, per_do, ml_do = line.strip().split(',')
+        when = datetime.strptime(f"{date} {time}", "%d-%m-%y %H:%M:%S").replace(tzinfo=timezone.utc)
+        readings.append((int(when.timestamp()), int(counter), float(temperature), float(per_do), float(ml_do)))
+    sys.stdout.buffer.write(encode_batch(sensor, readings))
@@ -0,0 +1,267 @@
+# bulk_ingest.py
+# Bulk upload of readings over HTTP (POST /bulk_ingest), for logger files downloaded in
+# the field and gateways that post instead of publishing to MQTT.
+#
+# The body is CSV with a header row, or NDJSON (one JSON object per line). Columns/keys:
+#   SensorID (or sensor)             sensorName; may instead be given once as ?SensorID=
+#   created_at, or date + time       UTC, in any layout client.py accepts from sensors
+#   temperature, percent_dissolved_oxygen (or percent), mg_per_l_dissolved_oxygen (or mg/l)
+#   message_counter (or counter)     optional; without it a row is skipped when the sensor already
+#                                    has a reading at that created_at (MQTT, an earlier upload)
+#
+# The body is read in CHUNK_BYTES pieces and parsed line by line, never held in memory.
+# Rows of registered, active sensors are inserted BATCH_ROWS at a time, each batch in its
+# own transaction with gap logging and one latest_reading refresh; the response lists
+# what every batch stored, skipped as already present (duplicates in the main database,
+# archived for months already rolled into a partition) or rejected.
+
+import csv
+import json
+import logging
+from datetime import datetime
+from client import SENSOR_DATETIME_FORMATS
+from completeness import record_readings
+from latest_reading import refresh_latest_reading
+from partitions import attach, detach, existing_partitions
+from time_tiles import note_history_change
+
+CHUNK_BYTES = 1 << 16
+BATCH_ROWS = 20000
+MAX_ERRORS = 20
+FORMATS = ('csv', 'ndjson')
+
+ALIASES = {
+    'sensor': 'SensorID', 'sensorid': 'SensorID', 'sensorname': 'SensorID',
+    'created_at': 'created_at', 'date': 'date', 'time': 'time',
+    'temperature': 'temperature', 'temp': 'temperature',
+    'percent_dissolved_oxygen': 'percent_dissolved_oxygen', 'percent': 'percent_dissolved_oxygen', '%do': 'percent_dissolved_oxygen',
+    'mg_per_l_dissolved_oxygen': 'mg_per_l_dissolved_oxygen', 'mg/l': 'mg_per_l_dissolved_oxygen',
+    'message_counter': 'message_counter', 'counter': 'message_counter',
+}
+
+
+def iter_lines(stream, chunk_bytes=CHUNK_BYTES):
+    """Decoded lines of a binary stream, read chunk by chunk."""
+    pending = b''
+    while True:
+        chunk = stream.read(chunk_bytes)
+        if not chunk:
+            break
+        lines = (pending + chunk).split(b'\n')
+        pending = lines.pop()
+        for line in lines:
+            yield line.rstrip(b'\r').decode('utf-8')
+    if pending.strip():
+        yield pending.rstrip(b'\r').decode('utf-8')
+
+
+def iter_records(stream, fmt):
+    """(line number, dict) for each record of the body; a line that is not a record gives (n, ValueError)."""
+    lines = iter_lines(stream)
+    if fmt == 'csv':
+        reader = csv.reader(lines)
+        header = next(reader, None)
+        if header is None:
+            return
+        keys = [ALIASES.get(name.strip().lower(), name.strip()) for name in header]
+        for number, fields in enumerate(reader, start=2):
+            if not fields:
+                continue
+            if len(fields) != len(keys):
+                yield number, ValueError(f'{len(fields)} fields, header has {len(keys)}')
+                continue
+            yield number, dict(zip(keys, fields))
+    else:
+        for number, line in enumerate(lines, start=1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('not a JSON object')
+            except ValueError as e:
+                yield number, ValueError(f'invalid JSON: {e}')
+                continue
+            yield number, {ALIASES.get(key.lower(), key): value for key, value in record.items()}
+
+
+class TimeParser:
+    """created_at text from a record; remembers the layout that worked last, as files use one throughout."""
+
+    def __init__(self):
+        self.formats = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M:%S') + SENSOR_DATETIME_FORMATS
+        self.last = self.formats[0]
+
+    def parse(self, record):
+        text = record.get('created_at')
+        if text is None:
+            if record.get('date') is None or record.get('time') is None:
+                raise ValueError('created_at or date and time required')
+            text = f"{str(record['date']).strip()} {str(record['time']).strip()}"
+        text = str(text).strip().rstrip('Z')
+        for fmt in (self.last,) + self.formats:
+            try:
+                value = datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+            self.last = fmt
+            return str(value)
+        raise ValueError(f"unrecognised date/time '{text}'")
+
+
+def optional_float(value):
+    if value is None or (isinstance(value, str) and value.strip() in ('', 'NaN', 'nan', 'null')):
+        return None
+    return float(value)
+
+
+class SensorRegistry:
+    """Active sensors by name, looked up once per upload."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.sensors = {}
+
+    def get(self, sensor_name):
+        if sensor_name not in self.sensors:
+            self.sensors[sensor_name] = self.conn.execute('''
+                SELECT sensorInfo.riverID, riverData.riverName, sensorInfo.lat || ',' || sensorInfo.long AS latlong,
+                       sensorInfo.readFrequency
+                FROM sensorInfo
+                LEFT JOIN riverData ON sensorInfo.riverID = riverData.riverID
+                WHERE sensorInfo.sensorName = ? AND sensorInfo.status = 'active'
+            ''', (sensor_name,)).fetchone()
+        return self.sensors[sensor_name]
+
+
+def split_rolled(conn, rows):
+    """Split off the rows a monthly partition already holds; returns (rows to insert, rows held).
+
+    A row matches the sensor's reading at the same created_at, with the same counter when the
+    row has one. Months moved out by partitions.py roll are invisible to the main database's
+    unique index, so a logger file covering them would otherwise be stored a second time.
+    """
+    by_month = {}
+    for index, row in enumerate(rows):
+        by_month.setdefault((int(row[1][0:4]), int(row[1][5:7])), []).append(index)
+    rolled = set(existing_partitions()) & set(by_month)
+    if not rolled:
+        return rows, []
+    held = set()
+    for year, month in sorted(rolled):
+        attach(conn, year, month)
+        try:
+            for index in by_month[(year, month)]:
+                sensor, created_at, counter = rows[index][0:3]
+                if conn.execute('''SELECT 1 FROM part.SensorData WHERE SensorID = ? AND created_at = ?
+                                      AND (? IS NULL OR message_counter = ?)''',
+                                (sensor, created_at, counter, counter)).fetchone():
+                    held.add(index)
+        finally:
+            detach(conn)
+    return ([row for index, row in enumerate(rows) if index not in held],
+            [row for index, row in enumerate(rows) if index in held])
+
+
+def store_batch(conn, registry, rows):
+    """Insert one batch of (sensor, created_at, counter, temp, %DO, mg/L) rows in one transaction.
+
+    Rows with a counter are deduplicated by the unique reading index; rows without one (None)
+    are stored with counter 0 unless the sensor already has a reading at that time.
+    Returns (rows stored, {sensor: newest created_at stored}).
+    """
+    updated_at = datetime.utcnow()
+    # Holding the write lock from the start makes every id above `before` one of ours
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        before = conn.execute('SELECT MAX(id) FROM SensorData').fetchone()[0] or 0
+        counted, uncounted = [], []
+        for sensor, created_at, counter, temperature, per_do, ml_do in rows:
+            riverID, river, latlong, _ = registry.get(sensor)
+            (counted if counter is not None else uncounted).append(
+                (sensor, created_at, updated_at, riverID, river, latlong, counter or 0, temperature, per_do, ml_do))
+        conn.executemany('''INSERT OR IGNORE INTO SensorData (SensorID, created_at, updated_at, riverID, river, latlong,
+                                message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''', counted)
+        # A logger file has no counters, so the readings MQTT already stored (with theirs) are
+        # recognised by sensor and time instead
+        conn.executemany('''INSERT INTO SensorData (SensorID, created_at, updated_at, riverID, river, latlong,
+                                message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
+                            SELECT ?1, ?2, ?3, ?4, ?5, ?6, ?7, ?8, ?9, ?10
+                            WHERE NOT EXISTS (SELECT 1 FROM SensorData WHERE SensorID = ?1 AND created_at = ?2)''',
+                         uncounted)
+        stored = conn.execute('SELECT id, SensorID, created_at FROM SensorData WHERE id > ? ORDER BY id',
+                              (before,)).fetchall()
+        by_sensor = {}
+        for _, sensor, created_at in stored:
+            by_sensor.setdefault(sensor, []).append(created_at)
+        cursor = conn.cursor()
+        for sensor, times in by_sensor.items():
+            riverID, _, _, read_frequency = registry.get(sensor)
+            record_readings(cursor, sensor, riverID, times, read_frequency)
+            note_history_change(cursor, sensor, min(times))
+        if stored:
+            refresh_latest_reading(cursor, stored[0][0], stored[-1][0])
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return len(stored), {sensor: max(times) for sensor, times in by_sensor.items()}
+
+
+def ingest(conn, stream, fmt, default_sensor=None, batch_rows=BATCH_ROWS):
+    """Parse, validate and store an uploaded body; returns the per-batch summary."""
+    if fmt not in FORMATS:
+        raise ValueError(f'format must be one of {FORMATS}')
+    registry = SensorRegistry(conn)
+    times = TimeParser()
+    summary = {'rows': 0, 'stored': 0, 'duplicates': 0, 'archived': 0, 'rejected': 0, 'batches': [], 'errors': [],
+               'newest': {}}
+    batch, rejected = [], 0
+
+    def reject(number, message):
+        nonlocal rejected
+        rejected += 1
+        if len(summary['errors']) < MAX_ERRORS:
+            summary['errors'].append({'line': number, 'error': message})
+
+    def flush():
+        nonlocal batch, rejected
+        # Checked before store_batch's transaction: ATTACH is refused inside one
+        fresh, archived = split_rolled(conn, batch)
+        stored, newest = store_batch(conn, registry, fresh) if fresh else (0, {})
+        summary['batches'].append({'batch': len(summary['batches']) + 1, 'rows': len(batch) + rejected,
+                                   'stored': stored, 'duplicates': len(fresh) - stored,
+                                   'archived': len(archived), 'rejected': rejected})
+        summary['stored'] += stored
+        summary['duplicates'] += len(fresh) - stored
+        summary['archived'] += len(archived)
+        summary['rejected'] += rejected
+        for sensor, created_at in newest.items():
+            summary['newest'][sensor] = max(created_at, summary['newest'].get(sensor, created_at))
+        logging.debug(f"Bulk ingest batch {len(summary['batches'])}: {stored} stored, {rejected} rejected")
+        batch, rejected = [], 0
+
+    for number, record in iter_records(stream, fmt):
+        summary['rows'] += 1
+        if isinstance(record, Exception):
+            reject(number, str(record))
+        else:
+            try:
+                sensor = str(record.get('SensorID') or default_sensor or '').strip()
+                if not sensor:
+                    raise ValueError('SensorID required')
+                if registry.get(sensor) is None:
+                    raise ValueError(f'sensor {sensor} is not registered or not active')
+                counter = record.get('message_counter')
+                batch.append((sensor, times.parse(record), int(counter) if counter not in (None, '') else None,
+                              optional_float(record.get('temperature')),
+                              optional_float(record.get('percent_dissolved_oxygen')),
+                              optional_float(record.get('mg_per_l_dissolved_oxygen'))))
+            except (ValueError, TypeError) as e:
+                reject(number, str(e))
+        if len(batch) + rejected >= batch_rows:
+            flush()
+    if batch or rejected:
+        flush()
+    return summary
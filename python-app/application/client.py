@@ -4,12 +4,21 @@ from datetime import datetime
 import json
 import logging
 from concurrent.futures import ThreadPoolExecutor
-import sqlite3
+import database
 from constant import database_file
+from latest_reading import refresh_latest_reading
+from completeness import record_reading, record_readings, to_datetime
+from batch_payload import is_batch, decode_batch, sensor_times, reading_values
+from sequence_tracker import SequenceTracker, DUPLICATE
+from time_tiles import note_history_change
 
 # Configure logging
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Date/time layouts seen in sensor payloads (the Aquasensor API uses the first)
+SENSOR_DATETIME_FORMATS = ("%d-%m-%y %H:%M:%S", "%d/%m/%y %H:%M:%S", "%d-%m-%Y %H:%M:%S",
+                           "%d/%m/%Y %H:%M:%S", "%Y-%m-%d %H:%M:%S", "%d-%m-%y %H:%M", "%d/%m/%y %H:%M")
+
 class Client:
     topic_interested = None
     message_counter = 0
@@ -19,6 +28,12 @@ class Client:
         self.subscriber_client_location = location
         self.topic_interested = topic_interested
         self.executor = ThreadPoolExecutor(max_workers=10)
+        self.sequence_tracker = SequenceTracker()
+        self.recent = None  # RecentReadings, when the ingest serves recent windows to the API
+        self.alerts = None  # AlertEngine checking each stored reading against the alert rules
+        self.freshness = None  # FreshnessTracker timing each reading through the pipeline
+        self.recorder = None  # mqtt_traffic.Recorder keeping the raw traffic for replays
+        self.database_file = database_file  # replays point this at a copy
         logging.debug(f"Client initialized for topic: {topic_interested}")
 
     def mydatetime(self):
@@ -40,11 +55,29 @@ class Client:
             return False
         return True
 
+    def parse_sensor_timestamp(self, date, time):
+        """The reading's own date/time (UTC), or None if it is in no known layout."""
+        text = f"{date.strip()} {time.strip()}"
+        for fmt in SENSOR_DATETIME_FORMATS:
+            try:
+                return datetime.strptime(text, fmt)
+            except ValueError:
+                continue
+        return None
+
     def on_message(self, client, userdata, msg):
-        self.executor.submit(self.process_message, msg)
+        # Receipt time: MQTT carries no broker timestamp, this is when the message reached us
+        received_at = datetime.utcnow()
+        if self.recorder is not None:
+            self.recorder.write(msg.topic, msg.payload)
+        self.executor.submit(self.process_message, msg, received_at)
 
-    def process_message(self, msg):
+    def process_message(self, msg, received_at=None):
+        started_at = datetime.utcnow()
         try:
+            if is_batch(msg.payload):
+                self.process_batch(msg, received_at, started_at)
+                return
             topicfrmPub = msg.topic
             msg_data = str(msg.payload.decode('utf-8'))
             logging.debug(f"Received message: {msg_data} on topic: {topicfrmPub}")
@@ -71,35 +104,166 @@ class Client:
             logging.debug(f"Total messages received so far: {self.message_counter}")
             logging.debug(f"{self.mydatetime()}: Waiting for message....")
 
-            self.save_to_db(sensor_name, message_ctr, temperature, per_do, ml_do)
+            # The sensor's own time tells a restarted counter from a redelivery
+            sensor_time = self.parse_sensor_timestamp(date, time)
+            if self.sequence_tracker.check(sensor_name, message_ctr, sensor_time) == DUPLICATE:
+                logging.debug(f"Duplicate message {message_ctr} from {sensor_name}, skipping")
+                return
+
+            created_at = sensor_time
+            if created_at is None:
+                logging.debug(f"Unrecognised date/time '{date} {time}', using receipt time")
+                created_at = datetime.utcnow()
+
+            # Only a committed reading counts as seen, so a redelivery after a failed insert is stored
+            if self.save_to_db(sensor_name, created_at, message_ctr, temperature, per_do, ml_do, received_at, started_at):
+                self.sequence_tracker.record(sensor_name, message_ctr, sensor_time)
         except Exception as e:
             logging.error(f"Error processing message: {e}")
 
-    def save_to_db(self, sensor_name, message_ctr, temperature, per_do, ml_do):
+    def process_batch(self, msg, received_at, started_at):
+        """A batched payload (batch_payload.py): all its readings are stored in one transaction."""
+        sensor_name, records = decode_batch(msg.payload)
+        logging.debug(f"Received batch of {len(records)} readings from {sensor_name} on topic: {msg.topic}")
+        self.message_counter += len(records)
+
+        fallback = str(received_at or started_at)
+        readings, counters = [], []
+        for created_at, message_ctr, temperature, per_do, ml_do in zip(
+                sensor_times(records), records['counter'].tolist(), *(v.tolist() for v in reading_values(records))):
+            if self.sequence_tracker.check(sensor_name, message_ctr, created_at) == DUPLICATE:
+                continue
+            # NaN marks a value the sensor did not measure
+            readings.append((created_at or fallback, message_ctr, *(None if v != v else v for v in (temperature, per_do, ml_do))))
+            counters.append((message_ctr, created_at))
+        if not readings:
+            logging.debug(f"Batch from {sensor_name} only had duplicates, skipping")
+            return
+        if self.save_batch(sensor_name, readings, received_at, started_at):
+            for message_ctr, created_at in counters:
+                self.sequence_tracker.record(sensor_name, message_ctr, created_at)
+
+    def save_batch(self, sensor_name, readings, received_at=None, started_at=None):
+        """Store (created_at, message_counter, temperature, %DO, mg/L DO) readings of one sensor together.
+
+        Returns True once the batch is committed (or was already stored), False otherwise.
+        """
         try:
-            conn = sqlite3.connect(database_file)
+            conn = database.connect(self.database_file)
+            cursor = conn.cursor()
+            cursor.execute('''
+                SELECT sensorInfo.riverID, riverData.riverName, sensorInfo.lat || ',' || sensorInfo.long AS latlong,
+                       sensorInfo.readFrequency
+                FROM sensorInfo
+                LEFT JOIN riverData ON sensorInfo.riverID = riverData.riverID
+                WHERE sensorInfo.sensorName = ? AND sensorInfo.status = 'active'
+            ''', (sensor_name,))
+            result = cursor.fetchone()
+            if not result:
+                logging.debug(f"Sensor {sensor_name} is not registered or not active, skipping batch")
+                conn.close()
+                return False
+            riverID, river, latlong, read_frequency = result
+
+            updated_at = datetime.utcnow()
+            # Holding the write lock from the start makes every id above `before` one of ours,
+            # not a reading another writer committed between the two statements
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                before = cursor.execute('SELECT MAX(id) FROM SensorData').fetchone()[0] or 0
+                cursor.executemany('''
+                    INSERT OR IGNORE INTO SensorData (SensorID, created_at, updated_at, received_at, riverID, river, latlong, message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [(sensor_name, created_at, updated_at, received_at, riverID, river, latlong, *reading)
+                      for created_at, *reading in readings])
+                # The rows this batch actually added (replayed readings were ignored by the unique index)
+                stored = cursor.execute('''SELECT id, created_at, message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen
+                                           FROM SensorData WHERE id > ? AND SensorID = ? ORDER BY id''', (before, sensor_name)).fetchall()
+                if stored:
+                    record_readings(cursor, sensor_name, riverID, [row[1] for row in stored], read_frequency)
+                    refresh_latest_reading(cursor, stored[0][0], stored[-1][0])
+                    # A gateway catching up can store readings into chart tiles that were already cached
+                    note_history_change(cursor, sensor_name, min(row[1] for row in stored))
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                conn.close()
+                raise
+            conn.close()
+            if not stored:
+                logging.debug(f"Batch of {len(readings)} readings from {sensor_name} already stored, skipping")
+                return True
+
+            committed_at = datetime.utcnow()
+            for data_id, created_at, message_ctr, temperature, per_do, ml_do in sorted(stored, key=lambda row: row[1]):
+                if self.freshness is not None:
+                    self.freshness.record(sensor_name, riverID, to_datetime(created_at), received_at,
+                                          started_at or updated_at, committed_at)
+                if self.recent is not None:
+                    self.recent.add(sensor_name, riverID, river, latlong, created_at, updated_at, data_id, message_ctr,
+                                    temperature, per_do, ml_do)
+                if self.alerts is not None:
+                    self.alerts.check_reading(sensor_name, riverID, created_at, {'temperature': temperature,
+                                                                                 'percent_dissolved_oxygen': per_do,
+                                                                                 'mg_per_l_dissolved_oxygen': ml_do})
+            logging.debug(f"Batch of {len(stored)} readings from {sensor_name} inserted successfully")
+            return True
+        except Exception as e:
+            logging.error(f"Error inserting batch into SQLite: {e}")
+            return False
+
+    def save_to_db(self, sensor_name, created_at, message_ctr, temperature, per_do, ml_do,
+                   received_at=None, started_at=None):
+        """Store one reading; returns True once it is committed (or was already stored), False otherwise."""
+        try:
+            conn = database.connect(self.database_file)
             cursor = conn.cursor()
 
             # Fetch riverID, river, and latlong from sensorInfo based on sensor_name and check if sensor is active
             cursor.execute('''
-                SELECT sensorInfo.riverID, riverData.riverName, sensorInfo.lat || ',' || sensorInfo.long AS latlong
+                SELECT sensorInfo.riverID, riverData.riverName, sensorInfo.lat || ',' || sensorInfo.long AS latlong,
+                       sensorInfo.readFrequency
                 FROM sensorInfo
                 LEFT JOIN riverData ON sensorInfo.riverID = riverData.riverID
                 WHERE sensorInfo.sensorName = ? AND sensorInfo.status = 'active'
             ''', (sensor_name,))
             result = cursor.fetchone()
             if result:
-                riverID, river, latlong = result
+                riverID, river, latlong, read_frequency = result
             else:
                 logging.debug(f"Sensor {sensor_name} is not registered or not active, skipping")
-                return
+                conn.close()
+                return False
 
+            # The unique (SensorID, created_at, message_counter) index turns replays into no-ops
+            updated_at = datetime.utcnow()
             cursor.execute('''
-                INSERT INTO SensorData (SensorID, created_at, updated_at, riverID, river, latlong, message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            ''', (sensor_name, datetime.utcnow(), datetime.utcnow(), riverID, river, latlong, message_ctr, temperature, per_do, ml_do))
+                INSERT OR IGNORE INTO SensorData (SensorID, created_at, updated_at, received_at, riverID, river, latlong, message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (sensor_name, created_at, updated_at, received_at, riverID, river, latlong, message_ctr, temperature, per_do, ml_do))
+            if cursor.rowcount == 0:
+                logging.debug(f"Reading {message_ctr} from {sensor_name} already stored, skipping")
+                conn.close()
+                return True
+            data_id = cursor.lastrowid
+            # record_reading needs the previous latest_reading, which the insert has not touched yet
+            record_reading(cursor, sensor_name, riverID, created_at, read_frequency)
+            refresh_latest_reading(cursor, data_id)
+            note_history_change(cursor, sensor_name, created_at)
             conn.commit()
             conn.close()
+            if self.freshness is not None:
+                self.freshness.record(sensor_name, riverID, created_at, received_at, started_at or updated_at,
+                                      datetime.utcnow())
+            if self.recent is not None:
+                self.recent.add(sensor_name, riverID, river, latlong, created_at, updated_at, data_id, message_ctr,
+                                temperature, per_do, ml_do)
+            if self.alerts is not None:
+                self.alerts.check_reading(sensor_name, riverID, created_at, {'temperature': temperature,
+                                                                             'percent_dissolved_oxygen': per_do,
+                                                                             'mg_per_l_dissolved_oxygen': ml_do})
             logging.debug("Data inserted successfully")
+            return True
         except Exception as e:
             logging.error(f"Error inserting data into SQLite: {e}")
+            return False
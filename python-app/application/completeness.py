@@ -0,0 +1,217 @@
+# completeness.py
+# Data completeness from each sensor's read frequency (readings per hour, as in the
+# Oracle Sensor.ReadFrequency column). A reading is on time within half a period, so a
+# gap starts when two consecutive readings are more than 1.5 periods apart.
+#
+# completeness_report() computes expected vs received counts, uptime and gap intervals
+# for the whole fleet at once with NumPy; record_reading() logs gaps into readingGap
+# as readings arrive so recent gaps are available without recomputing anything.
+
+import logging
+from datetime import datetime, timezone
+import numpy as np
+from constant import default_read_frequency
+from partitions import query_sources
+
+GAP_TOLERANCE_PERIODS = 1.5
+SECONDS_PER_DAY = 86400
+
+
+def create_completeness_tables(cursor):
+    """readingGap table, plus the readFrequency column on sensorInfo for older databases."""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(sensorInfo)')]
+    if 'readFrequency' not in columns:
+        cursor.execute('ALTER TABLE sensorInfo ADD COLUMN readFrequency INTEGER')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS readingGap (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    SensorID TEXT NOT NULL,
+                    riverID INTEGER,
+                    gap_start TIMESTAMP NOT NULL,
+                    gap_end TIMESTAMP NOT NULL,
+                    missing INTEGER NOT NULL
+                )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_readinggap_sensor ON readingGap(SensorID, gap_start)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_readinggap_river ON readingGap(riverID, gap_start)')
+
+
+def period_seconds(read_frequency):
+    frequency = read_frequency or default_read_frequency
+    return 3600.0 / frequency
+
+
+def to_datetime(value):
+    return value if isinstance(value, datetime) else datetime.fromisoformat(str(value))
+
+
+def record_reading(cursor, sensor_id, riverID, created_at, read_frequency):
+    """Log a gap if this reading arrives more than 1.5 periods after the sensor's previous one.
+
+    Must run before refresh_latest_reading(), which it reads the previous reading from.
+    """
+    row = cursor.execute('SELECT created_at FROM latest_reading WHERE SensorID = ?', (sensor_id,)).fetchone()
+    if row is None or row[0] is None:
+        return
+    previous = to_datetime(row[0])
+    elapsed = (to_datetime(created_at) - previous).total_seconds()
+    period = period_seconds(read_frequency)
+    if elapsed > GAP_TOLERANCE_PERIODS * period:
+        missing = int(round(elapsed / period)) - 1
+        cursor.execute('''INSERT INTO readingGap (SensorID, riverID, gap_start, gap_end, missing)
+                          VALUES (?, ?, ?, ?, ?)''', (sensor_id, riverID, previous, created_at, missing))
+        logging.debug(f"Sensor {sensor_id}: gap of {missing} readings since {previous}")
+
+
+def record_readings(cursor, sensor_id, riverID, times, read_frequency):
+    """record_reading() for a batch of one sensor's readings (created_at values).
+
+    Each reading is compared with the one before it, the first with latest_reading.
+    """
+    row = cursor.execute('SELECT created_at FROM latest_reading WHERE SensorID = ?', (sensor_id,)).fetchone()
+    previous = to_datetime(row[0]) if row and row[0] else None
+    period = period_seconds(read_frequency)
+    gaps = []
+    for current in sorted(to_datetime(t) for t in times):
+        if previous is not None and current <= previous:
+            continue
+        if previous is not None and (current - previous).total_seconds() > GAP_TOLERANCE_PERIODS * period:
+            missing = int(round((current - previous).total_seconds() / period)) - 1
+            gaps.append((sensor_id, riverID, previous, current, missing))
+        previous = current
+    if gaps:
+        cursor.executemany('''INSERT INTO readingGap (SensorID, riverID, gap_start, gap_end, missing)
+                              VALUES (?, ?, ?, ?, ?)''', gaps)
+        logging.debug(f"Sensor {sensor_id}: {len(gaps)} gaps in a batch of {len(times)} readings")
+
+
+def load_read_frequencies(conn):
+    """Read frequency by the identifiers SensorData uses: sensorName (MQTT) and sensorID (API import)."""
+    frequencies = {}
+    registered = {}
+    for sensorID, sensorName, riverID, frequency, status in conn.execute(
+            'SELECT sensorID, sensorName, riverID, readFrequency, status FROM sensorInfo'):
+        frequencies[str(sensorID)] = frequency
+        frequencies[sensorName] = frequency
+        if status == 'active':
+            registered[sensorName] = riverID
+    return frequencies, registered
+
+
+def completeness_report(conn, start, end, riverID=None, include_days=False, include_gaps=False):
+    """Expected vs received readings, uptime and gaps per sensor and per river for [start, end)."""
+    query = 'SELECT SensorID, riverID, created_at FROM {table} WHERE created_at >= ? AND created_at < ?'
+    params = [start, end]
+    if riverID is not None:
+        query += ' AND riverID = ?'
+        params.append(riverID)
+    # Rolled months live in the partitions; merge them with the hot window in sensor, time order
+    rows = query_sources(conn, query, params, start, end)
+    rows.sort(key=lambda row: (row[0], row[2]))
+
+    frequencies, registered = load_read_frequencies(conn)
+    window_start = np.datetime64(start, 's').astype(np.int64)
+    window_end = np.datetime64(end, 's').astype(np.int64)
+    window_end = max(window_start, min(window_end, np.int64(datetime.now(timezone.utc).timestamp())))
+
+    if rows:
+        sensor_col, river_col, time_col = zip(*rows)
+    else:
+        sensor_col, river_col, time_col = (), (), ()
+    # Active sensors that sent nothing in the window are 0% complete, not absent from the report
+    silent = sorted(s for s, r in registered.items()
+                    if s not in set(sensor_col) and (riverID is None or r == riverID))
+
+    sensors, codes = np.unique(np.array(sensor_col + tuple(silent), dtype=object), return_inverse=True)
+    codes = codes[:len(rows)]
+    times = np.array(time_col, dtype='datetime64[s]').astype(np.int64)
+    n = len(sensors)
+
+    rivers = np.empty(n, dtype=object)
+    rivers[codes] = np.array(river_col, dtype=object)
+    for s in silent:
+        rivers[np.searchsorted(sensors, s)] = registered[s]
+    frequency = np.array([frequencies.get(s) or default_read_frequency for s in sensors], dtype=float)
+    period = 3600.0 / frequency
+    row_period = period[codes]
+
+    # Received = distinct expected slots filled, so duplicates never push uptime over 100%
+    slot = (times - window_start) // row_period
+    new_slot = np.ones(len(rows), dtype=bool)
+    new_slot[1:] = (codes[1:] != codes[:-1]) | (slot[1:] != slot[:-1])
+    received = np.bincount(codes[new_slot], minlength=n)
+    expected = np.floor((window_end - window_start) / period).astype(np.int64)
+
+    # Gaps between consecutive readings of the same sensor, plus the window edges
+    same_sensor = codes[1:] == codes[:-1]
+    diffs = np.diff(times)
+    inner = np.nonzero(same_sensor & (diffs > GAP_TOLERANCE_PERIODS * row_period[1:]))[0]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = ~same_sensor
+    last = np.ones(len(rows), dtype=bool)
+    last[:-1] = ~same_sensor
+    gap_sensor = np.concatenate([codes[inner], codes[first], codes[last]])
+    gap_start = np.concatenate([times[inner], np.full(first.sum(), window_start), times[last]])
+    gap_end = np.concatenate([times[inner + 1], times[first], np.full(last.sum(), window_end)])
+    silent_codes = np.searchsorted(sensors, silent).astype(np.int64)
+    gap_sensor = np.concatenate([gap_sensor, silent_codes])
+    gap_start = np.concatenate([gap_start, np.full(len(silent), window_start)])
+    gap_end = np.concatenate([gap_end, np.full(len(silent), window_end)])
+    keep = (gap_end - gap_start) > GAP_TOLERANCE_PERIODS * period[gap_sensor]
+    gap_sensor, gap_start, gap_end = gap_sensor[keep], gap_start[keep], gap_end[keep]
+    gap_seconds = np.bincount(gap_sensor, weights=gap_end - gap_start, minlength=n)
+    gap_count = np.bincount(gap_sensor, minlength=n)
+
+    uptime = np.divide(np.minimum(received, expected), expected,
+                       out=np.zeros(n), where=expected > 0)
+
+    report_sensors = []
+    for i, sensor in enumerate(sensors):
+        report_sensors.append({
+            'SensorID': sensor,
+            'riverID': rivers[i],
+            'readFrequency': frequency[i],
+            'expected': int(expected[i]),
+            'received': int(received[i]),
+            'uptime': round(float(uptime[i]), 4),
+            'gap_count': int(gap_count[i]),
+            'gap_seconds': int(gap_seconds[i]),
+        })
+
+    if include_days:
+        day0 = window_start - window_start % SECONDS_PER_DAY
+        n_days = int((window_end - day0 + SECONDS_PER_DAY - 1) // SECONDS_PER_DAY)
+        day_starts = day0 + np.arange(n_days) * SECONDS_PER_DAY
+        overlap = np.minimum(day_starts + SECONDS_PER_DAY, window_end) - np.maximum(day_starts, window_start)
+        day_expected = np.floor(overlap[None, :] / period[:, None]).astype(np.int64)
+        day_index = (times - day0) // SECONDS_PER_DAY
+        day_received = np.bincount(codes[new_slot] * n_days + day_index[new_slot],
+                                   minlength=n * n_days).reshape(n, n_days)
+        day_labels = np.datetime_as_string(day_starts.astype('datetime64[s]'), unit='D')
+        for i, entry in enumerate(report_sensors):
+            entry['days'] = [
+                {'day': day_labels[d], 'expected': int(day_expected[i, d]), 'received': int(day_received[i, d]),
+                 'uptime': round(min(1.0, day_received[i, d] / day_expected[i, d]), 4) if day_expected[i, d] else None}
+                for d in range(n_days)
+            ]
+
+    report_rivers = {}
+    for entry in report_sensors:
+        river = report_rivers.setdefault(entry['riverID'], {'riverID': entry['riverID'], 'sensors': 0,
+                                                            'expected': 0, 'received': 0})
+        river['sensors'] += 1
+        river['expected'] += entry['expected']
+        river['received'] += min(entry['received'], entry['expected'])
+    for river in report_rivers.values():
+        river['uptime'] = round(river['received'] / river['expected'], 4) if river['expected'] else None
+
+    report = {'from': start, 'to': end, 'sensors': report_sensors, 'rivers': list(report_rivers.values())}
+    if include_gaps:
+        as_text = lambda seconds: np.datetime_as_string(seconds.astype('datetime64[s]'), unit='s')
+        order = np.lexsort((gap_start, gap_sensor))
+        report['gaps'] = [
+            {'SensorID': sensors[s], 'start': a.replace('T', ' '), 'end': b.replace('T', ' '),
+             'missing': int(round((e - st) / period[s])) - 1}
+            for s, a, b, st, e in zip(gap_sensor[order], as_text(gap_start[order]), as_text(gap_end[order]),
+                                      gap_start[order], gap_end[order])
+        ]
+    return report
@@ -25,3 +25,30 @@ API_TOKEN = "token"
 
 # SQLite settings
 database_file = 'aqua_sensor_data.db'
+
+# Monthly SensorData partitions (see partitions.py)
+partition_dir = 'partitions'
+hot_months = 2          # current month plus the previous one stay in the main database
+retention_months = 24   # partitions older than this are compacted into hourly rollups
+
+# Readings per hour assumed for sensors without sensorInfo.readFrequency (see completeness.py)
+default_read_frequency = 4
+
+# Rendered daily/weekly charts and summaries (see reports.py)
+report_dir = 'reports'
+
+# In-memory recent readings held by DataFeed.py and queried by the API (see recent_buffer.py)
+recent_hours = 48       # window kept per sensor; covers "today" whatever the time of day
+recent_address = None   # e.g. ('127.0.0.1', 6010) to enable, with a secret recent_authkey
+recent_authkey = b'change-me'   # DataFeed.py refuses to serve with this value
+
+# Cached chart tiles of historical readings (see time_tiles.py)
+tile_dir = 'tiles'
+
+# Raw MQTT traffic recorded by DataFeed.py for replays (see mqtt_traffic.py); None to disable
+record_dir = None
+
+# Profiling (see profiling.py)
+profile_dir = 'profiles'
+profile_secret = None       # set to accept X-Profile tokens and enable the /admin/profile routes
+profile_slow_seconds = None  # e.g. 2.0: requests still running after this long are profiled
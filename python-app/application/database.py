@@ -0,0 +1,304 @@
+# database.py
+# The one way the application opens SQLite: connect() is sqlite3.connect() with a
+# connection class that traces every statement into a per-process QueryStats.
+#
+# For each statement fingerprint (the SQL with literals replaced by ?, IN lists and
+# multi-row VALUES collapsed) it keeps call count, total / max / p99 time, rows returned
+# or changed, and SQLite VM steps. Time and rows cover execute() and the fetches that
+# follow it, until the cursor is exhausted, re-executed or closed. VM steps come from the
+# progress handler (every PROGRESS_STEP instructions) and grow with the rows a statement
+# scans, so a missing index shows up as a statement with many steps for few rows.
+# The trace callback supplies the statements SQLite actually ran (with the bound values
+# expanded, implicit BEGINs, each row of an executemany), used for the slow-query log.
+# Python's sqlite3 has no profile callback, so timing is taken around the cursor calls.
+#
+# Calls slower than SLOW_QUERY_SECONDS go to a bounded slow-query log together with
+# their EXPLAIN QUERY PLAN. The API serves both at /admin/sql; scripts can log a summary
+# at exit by setting RIVERSENSE_SQL_SUMMARY=1.
+
+import atexit
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+
+SLOW_QUERY_SECONDS = 0.25
+SLOW_LOG_SIZE = 100
+TIMINGS_KEPT = 1000         # recent call times per fingerprint, for the p99
+PROGRESS_STEP = 1000        # VM instructions between two progress callbacks
+FINGERPRINT_CACHE_SIZE = 4096
+
+COMMENTS = re.compile(r'--[^\n]*|/\*.*?\*/', re.S)
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b[Xx]'[0-9A-Fa-f]*'|\b\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+SPACES = re.compile(r'\s+')
+PLACEHOLDER_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)+\s*\)')
+REPEATED_ROWS = re.compile(r'(\(\?\+?\))(?:, \(\?\+?\))+')
+EXPLAINABLE = ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE')
+
+_fingerprints = {}
+
+
+def fingerprint(sql):
+    """The statement with comments, literals and list lengths normalised away."""
+    cached = _fingerprints.get(sql)
+    if cached is not None:
+        return cached
+    text = COMMENTS.sub(' ', sql)
+    text = LITERALS.sub('?', text)
+    text = SPACES.sub(' ', text).strip().rstrip(';').strip()
+    text = re.sub(r'\?\d+|[:@$]\w+', '?', text)
+    text = PLACEHOLDER_LIST.sub('(?+)', text)
+    text = REPEATED_ROWS.sub(r'\1, ...', text)
+    if len(_fingerprints) >= FINGERPRINT_CACHE_SIZE:
+        _fingerprints.clear()
+    _fingerprints[sql] = text
+    return text
+
+
+class StatementStats:
+    __slots__ = ('calls', 'total', 'max', 'rows', 'steps', 'statements', 'timings')
+
+    def __init__(self):
+        self.calls = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.rows = 0
+        self.steps = 0
+        self.statements = 0
+        self.timings = deque(maxlen=TIMINGS_KEPT)
+
+
+class QueryStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+        self.slow = deque(maxlen=SLOW_LOG_SIZE)
+        self.since = time.time()
+
+    def record(self, fp, seconds, rows, steps, statements):
+        with self.lock:
+            stats = self.statements.get(fp)
+            if stats is None:
+                stats = self.statements[fp] = StatementStats()
+            stats.calls += 1
+            stats.total += seconds
+            stats.max = max(stats.max, seconds)
+            stats.rows += max(rows, 0)
+            stats.steps += steps
+            stats.statements += statements
+            stats.timings.append(seconds)
+
+    def record_slow(self, entry):
+        with self.lock:
+            self.slow.append(entry)
+
+    def reset(self):
+        with self.lock:
+            self.statements = {}
+            self.slow.clear()
+            self.since = time.time()
+
+    def snapshot(self, sort='total', limit=50):
+        """Statements ordered by sort (total, calls, p99, max, rows, steps) and the slow-query log."""
+        with self.lock:
+            items = [(fp, s.calls, s.total, s.max, s.rows, s.steps, s.statements, sorted(s.timings))
+                     for fp, s in self.statements.items()]
+            slow = list(self.slow)
+            since = self.since
+        statements = []
+        for fp, calls, total, longest, rows, steps, executed, timings in items:
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            statements.append({'fingerprint': fp, 'calls': calls, 'statements': executed,
+                               'total_ms': round(total * 1000, 3), 'mean_ms': round(total / calls * 1000, 3),
+                               'p99_ms': round(p99 * 1000, 3), 'max_ms': round(longest * 1000, 3),
+                               'rows': rows, 'rows_per_call': round(rows / calls, 1),
+                               'steps': steps * PROGRESS_STEP, 'steps_per_call': round(steps * PROGRESS_STEP / calls)})
+        key = {'total': 'total_ms', 'calls': 'calls', 'p99': 'p99_ms', 'max': 'max_ms',
+               'rows': 'rows', 'steps': 'steps'}.get(sort)
+        if key is None:
+            raise ValueError('sort must be one of total, calls, p99, max, rows, steps')
+        statements.sort(key=lambda s: s[key], reverse=True)
+        return {'pid': os.getpid(), 'since': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(since)),
+                'statements': statements[:limit], 'slow': slow[::-1]}
+
+
+STATS = QueryStats()
+
+
+class Call:
+    """One execute() and the fetches that follow it."""
+    __slots__ = ('sql', 'parameters', 'seconds', 'rows', 'steps', 'statements', 'expanded')
+
+    def __init__(self, sql, parameters):
+        self.sql = sql
+        self.parameters = parameters
+        self.seconds = 0.0
+        self.rows = 0
+        self.steps = 0
+        self.statements = 0
+        self.expanded = None
+
+
+class TracedCursor(sqlite3.Cursor):
+    call = None
+
+    def timed(self, method, *args):
+        conn = self.connection
+        steps, statements = conn.steps, conn.statements
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            call = self.call
+            if call is not None:
+                call.seconds += time.perf_counter() - start
+                call.steps += conn.steps - steps
+                call.statements += conn.statements - statements
+                if conn.statements != statements:
+                    call.expanded = conn.traced_sql
+
+    def execute(self, sql, parameters=()):
+        self.finish()
+        self.call = Call(sql, parameters)
+        self.timed(super().execute, sql, parameters)
+        if self.description is None:
+            self.call.rows = self.rowcount
+            self.finish()
+        return self
+
+    def executemany(self, sql, seq_of_parameters):
+        self.finish()
+        self.call = Call(sql, None)
+        self.timed(super().executemany, sql, seq_of_parameters)
+        self.call.rows = self.rowcount
+        self.finish()
+        return self
+
+    def fetchone(self):
+        row = self.timed(super().fetchone)
+        if self.call is not None:
+            if row is None:
+                self.finish()
+            else:
+                self.call.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        rows = self.timed(super().fetchmany, self.arraysize if size is None else size)
+        if self.call is not None:
+            self.call.rows += len(rows)
+            if not rows:
+                self.finish()
+        return rows
+
+    def fetchall(self):
+        rows = self.timed(super().fetchall)
+        if self.call is not None:
+            self.call.rows += len(rows)
+            self.finish()
+        return rows
+
+    def __next__(self):
+        row = self.fetchone()
+        if row is None:
+            raise StopIteration
+        return row
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        try:
+            self.finish()
+        except Exception:
+            pass  # interpreter shutdown, or the connection is already gone
+
+    def finish(self):
+        call = self.call
+        if call is None:
+            return
+        self.call = None
+        fp = fingerprint(call.sql)
+        STATS.record(fp, call.seconds, call.rows, call.steps, call.statements)
+        if call.seconds >= SLOW_QUERY_SECONDS:
+            STATS.record_slow({'at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime()),
+                               'ms': round(call.seconds * 1000, 3), 'rows': call.rows,
+                               'steps': call.steps * PROGRESS_STEP, 'fingerprint': fp,
+                               'sql': call.expanded or call.sql,
+                               'plan': self.connection.explain(call.sql, call.parameters)})
+
+
+class TracedConnection(sqlite3.Connection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.steps = 0
+        self.statements = 0
+        self.traced_sql = None
+        self.progress = None
+        super().set_trace_callback(self.trace)
+        super().set_progress_handler(self.on_progress, PROGRESS_STEP)
+
+    def trace(self, sql):
+        self.statements += 1
+        self.traced_sql = sql
+
+    def on_progress(self):
+        self.steps += 1
+        progress = self.progress
+        return progress() if progress is not None else 0
+
+    def set_progress_handler(self, handler, n):
+        """Keep the step counter; handler (e.g. a query budget) is checked every PROGRESS_STEP instructions."""
+        self.progress = handler
+
+    def set_trace_callback(self, callback):
+        raise sqlite3.NotSupportedError('database.connect() connections use the trace callback themselves')
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        start = time.perf_counter()
+        super().commit()
+        STATS.record('COMMIT', time.perf_counter() - start, 0, 0, 1)
+
+    def explain(self, sql, parameters):
+        """EXPLAIN QUERY PLAN lines for a slow statement (not traced itself), or None."""
+        if not sql.lstrip().upper().startswith(EXPLAINABLE) or parameters is None:
+            return None
+        try:
+            cursor = sqlite3.Cursor(self)
+            rows = cursor.execute('EXPLAIN QUERY PLAN ' + sql, parameters).fetchall()
+            cursor.close()
+            return [row[-1] for row in rows]
+        except sqlite3.Error as e:
+            logging.debug(f"EXPLAIN QUERY PLAN failed: {e}")
+            return None
+
+
+def connect(database, **kwargs):
+    """sqlite3.connect() with statement tracing."""
+    return sqlite3.connect(database, factory=TracedConnection, **kwargs)
+
+
+def log_summary(limit=10):
+    snapshot = STATS.snapshot('total', limit)
+    for s in snapshot['statements']:
+        logging.info(f"SQL {s['calls']} calls, {s['total_ms']} ms total, p99 {s['p99_ms']} ms, "
+                     f"{s['rows_per_call']} rows/call, {s['steps_per_call']} steps/call: {s['fingerprint'][:200]}")
+    for entry in snapshot['slow'][:limit]:
+        logging.info(f"Slow SQL {entry['ms']} ms: {entry['sql'][:200]} plan={entry['plan']}")
+
+
+if os.environ.get('RIVERSENSE_SQL_SUMMARY'):
+    atexit.register(log_summary)
@@ -0,0 +1,211 @@
+# freshness.py
+# How far behind each sensor's data is, and at which stage of the pipeline.
+#
+# Every MQTT reading keeps three times: the sensor's own timestamp (SensorData.created_at),
+# when the message reached the ingest's MQTT callback (SensorData.received_at) and when it
+# was committed. FreshnessTracker, in DataFeed.py, turns them into per-sensor histograms of
+#   sensor_broker  - created_at -> received_at: sensor clock, gateway buffering, broker
+#   broker_ingest  - received_at -> processing start: waiting in the ingest worker pool
+#   ingest_commit  - processing start -> commit: lookups, insert and commit
+# and writes them, with the last times seen, to sensorFreshness every FLUSH_SECONDS.
+# sensor_freshness() / river_freshness() add the current age of each sensor's newest
+# reading and whether it is overdue for its readFrequency.
+
+import bisect
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+import database
+from completeness import period_seconds, to_datetime
+
+STAGES = ('sensor_broker', 'broker_ingest', 'ingest_commit')
+# Histogram bucket upper bounds in seconds; one more bucket holds anything longer
+BUCKETS = (0.001, 0.01, 0.1, 1, 5, 15, 60, 300, 900, 3600, 21600, 86400)
+FLUSH_SECONDS = 30
+STALE_PERIODS = 3  # a sensor is stale once this many read periods pass without a reading
+
+
+def create_freshness_tables(cursor):
+    """sensorFreshness table, plus the received_at column on SensorData for older databases."""
+    columns = [row[1] for row in cursor.execute('PRAGMA table_info(SensorData)')]
+    if 'received_at' not in columns:
+        cursor.execute('ALTER TABLE SensorData ADD COLUMN received_at TIMESTAMP')
+
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sensorFreshness (
+                    SensorID TEXT PRIMARY KEY,
+                    riverID INTEGER,
+                    sensor_at TIMESTAMP,
+                    received_at TIMESTAMP,
+                    committed_at TIMESTAMP,
+                    histograms TEXT,
+                    updated_at TIMESTAMP,
+                    FOREIGN KEY (riverID) REFERENCES riverData(riverID)
+                )''')
+
+
+def empty_histograms():
+    return {stage: [0] * (len(BUCKETS) + 1) for stage in STAGES}
+
+
+def percentile(counts, q):
+    """Upper bound (seconds) of the bucket holding the q-th percentile; None for no data."""
+    total = sum(counts)
+    if total == 0:
+        return None
+    rank = q * total
+    seen = 0
+    for bound, count in zip(BUCKETS + (None,), counts):
+        seen += count
+        if seen >= rank:
+            return bound
+    return None
+
+
+def summarise(histograms):
+    return {stage: {'count': sum(counts), 'p50': percentile(counts, 0.5), 'p95': percentile(counts, 0.95),
+                    'p99': percentile(counts, 0.99)}
+            for stage, counts in histograms.items()}
+
+
+class SensorLag:
+    __slots__ = ('riverID', 'sensor_at', 'received_at', 'committed_at', 'histograms')
+
+    def __init__(self, riverID=None, sensor_at=None, received_at=None, committed_at=None, histograms=None):
+        self.riverID = riverID
+        self.sensor_at = sensor_at
+        self.received_at = received_at
+        self.committed_at = committed_at
+        self.histograms = histograms or empty_histograms()
+
+
+class FreshnessTracker:
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.sensors = {}
+        self.dirty = set()
+        self.flushed_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def load(self, conn):
+        """Carry on from the histograms stored by the previous run."""
+        for sensor, riverID, sensor_at, received_at, committed_at, histograms in conn.execute(
+                'SELECT SensorID, riverID, sensor_at, received_at, committed_at, histograms FROM sensorFreshness'):
+            stored = json.loads(histograms) if histograms else {}
+            merged = empty_histograms()
+            for stage, counts in stored.items():
+                if stage in merged and len(counts) == len(merged[stage]):
+                    merged[stage] = counts
+            self.sensors[sensor] = SensorLag(riverID, sensor_at, received_at, committed_at, merged)
+
+    def record(self, sensor, riverID, sensor_at, received_at, started_at, committed_at):
+        """Add one committed reading; times are naive UTC datetimes, received/started may be None."""
+        lags = {'ingest_commit': (committed_at - started_at).total_seconds() if started_at else None}
+        if received_at is not None:
+            lags['sensor_broker'] = (received_at - sensor_at).total_seconds()
+            lags['broker_ingest'] = (started_at - received_at).total_seconds() if started_at else None
+        with self.lock:
+            lag = self.sensors.get(sensor)
+            if lag is None:
+                lag = self.sensors[sensor] = SensorLag()
+            lag.riverID = riverID
+            if lag.sensor_at is None or str(sensor_at) >= str(lag.sensor_at):
+                lag.sensor_at = sensor_at
+            lag.received_at, lag.committed_at = received_at, committed_at
+            for stage, seconds in lags.items():
+                if seconds is not None:
+                    # A sensor clock ahead of ours gives a negative lag, counted in the first bucket
+                    lag.histograms[stage][bisect.bisect_left(BUCKETS, seconds)] += 1
+            self.dirty.add(sensor)
+        if time.monotonic() - self.flushed_at >= FLUSH_SECONDS:
+            self.flush()
+
+    def start_flushing(self, interval=FLUSH_SECONDS):
+        """Save pending histograms every interval seconds from a daemon thread.
+
+        record() only flushes when a reading arrives, so an idle spell would otherwise
+        leave the last updates unsaved.
+        """
+        def run():
+            while True:
+                time.sleep(interval)
+                if self.dirty:
+                    self.flush()
+        threading.Thread(target=run, daemon=True, name='freshness-flush').start()
+        return self
+
+    def flush(self):
+        with self.lock:
+            self.flushed_at = time.monotonic()
+            rows = [(sensor, lag.riverID, str(lag.sensor_at), none_or_text(lag.received_at), none_or_text(lag.committed_at),
+                     json.dumps(lag.histograms), datetime.utcnow())
+                    for sensor, lag in ((s, self.sensors[s]) for s in self.dirty)]
+            self.dirty = set()
+        if not rows:
+            return
+        conn = database.connect(self.db_file)
+        try:
+            conn.executemany('''INSERT INTO sensorFreshness (SensorID, riverID, sensor_at, received_at, committed_at, histograms, updated_at)
+                                VALUES (?, ?, ?, ?, ?, ?, ?)
+                                ON CONFLICT(SensorID) DO UPDATE SET
+                                    riverID = excluded.riverID, sensor_at = excluded.sensor_at,
+                                    received_at = excluded.received_at, committed_at = excluded.committed_at,
+                                    histograms = excluded.histograms, updated_at = excluded.updated_at''', rows)
+            conn.commit()
+        except Exception as e:
+            logging.error(f"Error saving freshness: {e}")
+        finally:
+            conn.close()
+        logging.debug(f"Freshness saved for {len(rows)} sensors")
+
+
+def none_or_text(value):
+    return None if value is None else str(value)
+
+
+def sensor_freshness(conn, sensor_name=None, riverID=None, now=None):
+    """Freshness of the registered sensors, optionally of one sensor or one river."""
+    now = now or datetime.utcnow()
+    query = '''SELECT sensorInfo.sensorID, sensorInfo.sensorName, sensorInfo.riverID, sensorInfo.status,
+                      sensorInfo.readFrequency, latest_reading.created_at,
+                      sensorFreshness.received_at, sensorFreshness.committed_at, sensorFreshness.histograms
+               FROM sensorInfo
+               LEFT JOIN latest_reading ON latest_reading.SensorID = sensorInfo.sensorName
+               LEFT JOIN sensorFreshness ON sensorFreshness.SensorID = sensorInfo.sensorName'''
+    params = []
+    if sensor_name is not None:
+        query += ' WHERE sensorInfo.sensorName = ?'
+        params.append(sensor_name)
+    elif riverID is not None:
+        query += ' WHERE sensorInfo.riverID = ?'
+        params.append(riverID)
+
+    sensors = []
+    for sensorID, name, river, status, read_frequency, last, received_at, committed_at, histograms in conn.execute(
+            query + ' ORDER BY sensorInfo.sensorName', params):
+        period = period_seconds(read_frequency)
+        age = (now - to_datetime(last)).total_seconds() if last else None
+        sensors.append({'sensorID': sensorID, 'sensorName': name, 'riverID': river, 'status': status,
+                        'last_reading': last, 'received_at': received_at, 'committed_at': committed_at,
+                        'age_seconds': None if age is None else round(age, 1),
+                        'expected_interval_seconds': period,
+                        'stale': age is None or age > STALE_PERIODS * period,
+                        'lag': summarise(json.loads(histograms)) if histograms else None,
+                        'histograms': json.loads(histograms) if histograms else None})
+    return sensors
+
+
+def river_freshness(conn, riverID, now=None):
+    """Per-sensor freshness of one river, plus the river's oldest data and combined stage histograms."""
+    sensors = sensor_freshness(conn, riverID=riverID, now=now)
+    combined = empty_histograms()
+    for sensor in sensors:
+        for stage, counts in (sensor['histograms'] or {}).items():
+            if stage in combined and len(counts) == len(combined[stage]):
+                combined[stage] = [a + b for a, b in zip(combined[stage], counts)]
+    ages = [s['age_seconds'] for s in sensors if s['age_seconds'] is not None and s['status'] == 'active']
+    return {'riverID': riverID, 'sensors': sensors,
+            'stale_sensors': sum(1 for s in sensors if s['stale'] and s['status'] == 'active'),
+            'oldest_age_seconds': max(ages) if ages else None,
+            'lag': summarise(combined), 'buckets': list(BUCKETS)}
@@ -0,0 +1,29 @@
+# gunicorn.conf.py
+# Production serve mode for app.py: a pre-fork pool of worker processes.
+# $gunicorn -c gunicorn.conf.py app:app
+# app.run(debug=True) in app.py stays the development entrypoint.
+
+import multiprocessing
+import os
+
+bind = os.environ.get('RIVERSENSE_BIND', '0.0.0.0:5000')
+
+# One worker per core plus one, so a worker blocked on SQLite I/O does not idle a core
+workers = int(os.environ.get('RIVERSENSE_WORKERS', multiprocessing.cpu_count() + 1))
+# Threaded workers: admission.py caps the history routes per worker, so a few threads
+# always remain for the cheap registry routes while long queries run
+worker_class = 'gthread'
+threads = int(os.environ.get('RIVERSENSE_THREADS', 8))
+timeout = 60
+graceful_timeout = 30
+
+# Import app.py once in the master and fork the workers from it; each worker then
+# opens its own SQLite connections per request, so nothing database-related is shared
+preload_app = True
+
+# Recycle workers now and then to keep long-lived memory growth in check
+max_requests = 10000
+max_requests_jitter = 1000
+
+accesslog = '-'
+loglevel = os.environ.get('RIVERSENSE_LOG_LEVEL', 'info')
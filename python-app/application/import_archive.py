@@ -0,0 +1,194 @@
+# import_archive.py
+# Offline import of Aquasensor CSV exports (date,time,temperature,percent,mg/l - the layout
+# apiData.py downloads) into SensorData, for loading years of history at once.
+#
+# Worker processes read the files CHUNK_ROWS at a time with fixed dtypes and convert the
+# date/time columns with one vectorised pd.to_datetime per chunk; the main process is the
+# only writer and inserts what they return in transactions of TRANSACTION_ROWS rows.
+# SensorData's indexes are dropped for the duration and rebuilt at the end, removing any
+# imported reading the sensor already had at the same created_at (whatever its counter),
+# in the main database or in the monthly partition it was rolled into, then latest_reading
+# is brought up to date. Stop DataFeed.py while importing: without
+# the unique index its replays are not caught.
+#
+# Each file belongs to the sensor its name starts with (sensor022.csv, sensor022_2023.csv)
+# unless --sensor is given; files of unregistered sensors are skipped. Readings are stored
+# under the sensorName with message_counter 0, like /bulk_ingest uploads.
+#
+# $python import_archive.py archive_dir [--sensor NAME] [--workers 4] [--date-format '%d-%m-%y %H:%M:%S']
+
+import argparse
+import glob
+import logging
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import database
+from latest_reading import refresh_latest_reading
+from partitions import attach, detach, month_start, next_month, partitions_between
+from sequence_tracker import create_unique_reading_index
+from time_tiles import note_history_change
+
+CHUNK_ROWS = 100000
+TRANSACTION_ROWS = 500000
+DATE_FORMAT = '%d-%m-%y %H:%M:%S'
+CSV_COLUMNS = {'date': str, 'time': str, 'temperature': 'float64', 'percent': 'float64', 'mg/l': 'float64'}
+
+
+def sensor_for_file(path):
+    return re.split(r'[_.\s]', os.path.basename(path), maxsplit=1)[0]
+
+
+def read_archive_file(path, date_format=DATE_FORMAT):
+    """Parse one export into columns: (path, created_at as 'S19' text, temperature, %DO, mg/L, rows rejected)."""
+    times, values, rejected = [], [], 0
+    for chunk in pd.read_csv(path, usecols=list(CSV_COLUMNS), dtype=CSV_COLUMNS, chunksize=CHUNK_ROWS,
+                             skipinitialspace=True):
+        stamps = pd.to_datetime(chunk['date'].str.strip() + ' ' + chunk['time'].str.strip(),
+                                format=date_format, errors='coerce')
+        valid = stamps.notna().to_numpy()
+        rejected += int((~valid).sum())
+        text = np.datetime_as_string(stamps.to_numpy()[valid].astype('datetime64[s]'), unit='s')
+        times.append(np.char.replace(text, 'T', ' ').astype('S19'))
+        values.append(chunk[['temperature', 'percent', 'mg/l']].to_numpy()[valid])
+    if not times:
+        return path, np.empty(0, 'S19'), np.empty((0, 3)), rejected
+    return path, np.concatenate(times), np.concatenate(values), rejected
+
+
+def drop_indexes(conn):
+    """Drop SensorData's indexes; returns the SQL to recreate the ones other than the unique index."""
+    indexes = conn.execute("""SELECT name, sql FROM sqlite_master
+                              WHERE type = 'index' AND tbl_name = 'SensorData' AND sql IS NOT NULL""").fetchall()
+    for name, _ in indexes:
+        conn.execute(f'DROP INDEX {name}')
+    conn.commit()
+    return [sql for name, sql in indexes if name != 'idx_sensordata_unique_reading']
+
+
+def drop_rolled_duplicates(conn, first_id):
+    """Delete imported rows (id >= first_id) whose sensor and time are already in a monthly partition.
+
+    Closed months live in partition files once partitions.py roll has run, where the main
+    database's unique index cannot see them; without this a re-imported month would be
+    rolled into its partition a second time.
+    """
+    oldest, newest = conn.execute('SELECT MIN(created_at), MAX(created_at) FROM SensorData WHERE id >= ?',
+                                  (first_id,)).fetchone()
+    if oldest is None:
+        return 0
+    removed = 0
+    for year, month in partitions_between(oldest, newest):
+        attach(conn, year, month)
+        try:
+            with conn:
+                removed += conn.execute('''DELETE FROM main.SensorData
+                                          WHERE id >= ? AND created_at >= ? AND created_at < ? AND EXISTS (
+                                              SELECT 1 FROM part.SensorData AS stored
+                                              WHERE stored.SensorID = main.SensorData.SensorID
+                                                AND stored.created_at = main.SensorData.created_at)''',
+                                        (first_id, month_start(year, month), month_start(*next_month(year, month)))).rowcount
+        finally:
+            detach(conn)
+    return removed
+
+
+def import_archive(db_file, files, sensor=None, workers=None, date_format=DATE_FORMAT):
+    """Load the files into SensorData; returns counts of files, rows stored, rejected and skipped."""
+    conn = database.connect(db_file)
+    conn.execute('PRAGMA cache_size = -200000')
+    registry = {name: (riverID, river, latlong) for name, riverID, river, latlong in conn.execute('''
+        SELECT sensorInfo.sensorName, sensorInfo.riverID, riverData.riverName, sensorInfo.lat || ',' || sensorInfo.long
+        FROM sensorInfo LEFT JOIN riverData ON sensorInfo.riverID = riverData.riverID''')}
+    summary = {'files': 0, 'rows': 0, 'rejected': 0, 'skipped_files': []}
+    todo = []
+    for path in files:
+        name = sensor or sensor_for_file(path)
+        if name in registry:
+            todo.append(path)
+        else:
+            logging.warning(f"{path}: sensor {name} is not registered, skipping")
+            summary['skipped_files'].append(path)
+    if not todo:
+        conn.close()
+        return summary
+
+    first_id = (conn.execute('SELECT MAX(id) FROM SensorData').fetchone()[0] or 0) + 1
+    recreate = drop_indexes(conn)
+    updated_at = datetime.utcnow()
+    pending = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(read_archive_file, path, date_format) for path in todo]
+            for future in as_completed(futures):
+                path, times, values, rejected = future.result()
+                name = sensor or sensor_for_file(path)
+                riverID, river, latlong = registry[name]
+                values = values.tolist()
+                conn.executemany('''INSERT INTO SensorData (SensorID, created_at, updated_at, riverID, river, latlong,
+                                        message_counter, temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen)
+                                    VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?, ?)''',
+                                 ((name, t.decode(), updated_at, riverID, river, latlong, *(None if x != x else x for x in v))
+                                  for t, v in zip(times.tolist(), values)))
+                summary['files'] += 1
+                summary['rows'] += len(values)
+                summary['rejected'] += rejected
+                pending += len(values)
+                if pending >= TRANSACTION_ROWS:
+                    conn.commit()
+                    pending = 0
+                logging.info(f"{path}: {len(values)} readings of {name}, {rejected} rejected")
+        conn.commit()
+    finally:
+        # Rebuild the indexes even after a failure, the API depends on them
+        started = time.monotonic()
+        cursor = conn.cursor()
+        before = conn.execute('SELECT COUNT(*) FROM SensorData WHERE id >= ?', (first_id,)).fetchone()[0]
+        conn.commit()  # ATTACH is refused inside a transaction
+        drop_rolled_duplicates(conn, first_id)
+        create_unique_reading_index(cursor)
+        # Archive rows have no counter of their own, so a reading already stored with its MQTT
+        # counter (or by an earlier import) is recognised by sensor and time; the unique index
+        # just built serves the lookup
+        cursor.execute('''DELETE FROM SensorData WHERE id >= ? AND EXISTS (
+                              SELECT 1 FROM SensorData AS stored
+                              WHERE stored.SensorID = SensorData.SensorID AND stored.created_at = SensorData.created_at
+                                AND stored.id < SensorData.id)''', (first_id,))
+        for sql in recreate:
+            cursor.execute(sql)
+        last_id = conn.execute('SELECT MAX(id) FROM SensorData').fetchone()[0] or 0
+        if last_id >= first_id:
+            refresh_latest_reading(cursor, first_id, last_id)
+            for name, oldest in conn.execute('''SELECT SensorID, MIN(created_at) FROM SensorData
+                                                WHERE id >= ? GROUP BY SensorID''', (first_id,)).fetchall():
+                note_history_change(cursor, name, oldest)
+        conn.commit()
+        after = conn.execute('SELECT COUNT(*) FROM SensorData WHERE id >= ?', (first_id,)).fetchone()[0]
+        summary['duplicates'] = before - after
+        summary['rows'] -= before - after
+        logging.info(f"Indexes rebuilt in {time.monotonic() - started:.1f}s, {before - after} duplicate readings removed")
+        conn.close()
+    return summary
+
+
+if __name__ == '__main__':
+    from constant import database_file
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Import a directory of Aquasensor CSV exports into SensorData')
+    parser.add_argument('archive', help='directory of CSV files (searched recursively)')
+    parser.add_argument('--sensor', default=None, help='sensorName for every file (default: from each file name)')
+    parser.add_argument('--workers', type=int, default=None, help='parser processes (default: one per CPU)')
+    parser.add_argument('--date-format', default=DATE_FORMAT, help='strftime layout of "date time"')
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.archive, '**', '*.csv'), recursive=True))
+    started = time.monotonic()
+    summary = import_archive(database_file, files, args.sensor, args.workers, args.date_format)
+    print(f"{summary['files']} files, {summary['rows']} readings stored, {summary.get('duplicates', 0)} already present, "
+          f"{summary['rejected']} rows rejected, {len(summary['skipped_files'])} files skipped "
+          f"in {time.monotonic() - started:.1f}s")
@@ -1,11 +1,25 @@
 # init_db.py
-import sqlite3
+import database
+from latest_reading import create_latest_reading_table
+from partitions import create_rollup_table
+from river_geometry import create_river_geometry_table
+from completeness import create_completeness_tables
+from sequence_tracker import create_unique_reading_index
+from river_analytics import create_river_lag_table
+from placements import create_sensor_place_table
+from search import create_search_index
+from alerts import create_alert_tables
+from freshness import create_freshness_tables
+from time_tiles import create_tile_tables
 
 database_file = 'aqua_sensor_data.db'
 
-conn = sqlite3.connect(database_file)
+conn = database.connect(database_file)
 c = conn.cursor()
 
+# WAL lets the API's read-only connections run alongside the ingest writer
+c.execute('PRAGMA journal_mode=WAL')
+
 # Create riverData table
 c.execute('''
             CREATE TABLE IF NOT EXISTS riverData (
@@ -50,6 +64,9 @@ c.execute('''CREATE TABLE IF NOT EXISTS SensorData (
                     FOREIGN KEY (SensorID) REFERENCES sensorInfo(sensorID),
                     FOREIGN KEY (riverID) REFERENCES riverData(riverID)
                 )''')
+c.execute('CREATE INDEX IF NOT EXISTS idx_sensordata_sensor_time ON SensorData(SensorID, created_at)')
+c.execute('CREATE INDEX IF NOT EXISTS idx_sensordata_created_at ON SensorData(created_at)')
+create_unique_reading_index(c)
 
     # Create readingInfo table
 c.execute('''CREATE TABLE IF NOT EXISTS readingInfo (
@@ -61,6 +78,36 @@ c.execute('''CREATE TABLE IF NOT EXISTS readingInfo (
                     FOREIGN KEY (sensorDataID) REFERENCES SensorData(id)
                 )''')
 
+    # Create latest_reading table (one row per sensor, kept current by the ingest path)
+create_latest_reading_table(c)
+
+    # Create SensorDataRollup table (hourly aggregates of archived partitions)
+create_rollup_table(c)
+
+    # Create riverGeometry table (river outlines served by /river_geometry)
+create_river_geometry_table(c)
+
+    # Create readingGap table and sensorInfo.readFrequency (see completeness.py)
+create_completeness_tables(c)
+
+    # Create riverPairLag table (results of the river_analytics.py fleet run)
+create_river_lag_table(c)
+
+    # Create sensorPlace table (placement history, seeded from sensorInfo)
+create_sensor_place_table(c)
+
+    # Create searchIndex (FTS5 trigram index over river/sensor names and locations)
+create_search_index(c)
+
+    # Create alertRule and alertEvent tables (see alerts.py)
+create_alert_tables(c)
+
+    # Create sensorFreshness table and SensorData.received_at (see freshness.py)
+create_freshness_tables(c)
+
+    # Create tileGeneration table (versions of the cached chart tiles, see time_tiles.py)
+create_tile_tables(c)
+
     # Create counters table for sequence generation
 c.execute('''CREATE TABLE IF NOT EXISTS counters (
                     id TEXT PRIMARY KEY,
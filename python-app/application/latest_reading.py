@@ -0,0 +1,68 @@
+# latest_reading.py
+# Keeps the latest_reading table (one row per sensor) in step with SensorData,
+# so fleet status views read one small indexed table instead of scanning history.
+
+import logging
+
+LATEST_READING_COLUMNS = '''SensorID, data_id, created_at, riverID, river, latlong, message_counter,
+                    temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen'''
+
+
+def create_latest_reading_table(cursor):
+    """Create the latest_reading table and seed it from the existing SensorData rows."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS latest_reading (
+                    SensorID TEXT PRIMARY KEY,
+                    data_id INTEGER,
+                    created_at TIMESTAMP,
+                    riverID INTEGER,
+                    river TEXT,
+                    latlong TEXT,
+                    message_counter INTEGER,
+                    temperature REAL,
+                    percent_dissolved_oxygen REAL,
+                    mg_per_l_dissolved_oxygen REAL,
+                    FOREIGN KEY (data_id) REFERENCES SensorData(id),
+                    FOREIGN KEY (riverID) REFERENCES riverData(riverID)
+                )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_latest_reading_riverID ON latest_reading(riverID)')
+
+    # Seed from history the first time the table is created on an existing database
+    if cursor.execute('SELECT 1 FROM latest_reading LIMIT 1').fetchone() is None:
+        cursor.execute(f'''
+            INSERT INTO latest_reading ({LATEST_READING_COLUMNS})
+            SELECT SensorID, id, created_at, riverID, river, latlong, message_counter,
+                   temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen
+            FROM SensorData
+            WHERE id IN (SELECT id FROM (SELECT id, MAX(created_at) FROM SensorData GROUP BY SensorID))
+        ''')
+
+
+def refresh_latest_reading(cursor, first_id, last_id=None):
+    """Upsert latest_reading from the SensorData rows with ids first_id..last_id.
+
+    Runs on the caller's cursor so it commits in the same transaction as the insert.
+    A row only replaces the stored one if it is not older, so late or replayed
+    readings never move a sensor's status backwards.
+    """
+    if last_id is None:
+        last_id = first_id
+    cursor.execute(f'''
+        INSERT INTO latest_reading ({LATEST_READING_COLUMNS})
+        SELECT SensorID, id, created_at, riverID, river, latlong, message_counter,
+               temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen
+        FROM SensorData
+        WHERE id BETWEEN ? AND ?
+        ORDER BY id
+        ON CONFLICT(SensorID) DO UPDATE SET
+            data_id = excluded.data_id,
+            created_at = excluded.created_at,
+            riverID = excluded.riverID,
+            river = excluded.river,
+            latlong = excluded.latlong,
+            message_counter = excluded.message_counter,
+            temperature = excluded.temperature,
+            percent_dissolved_oxygen = excluded.percent_dissolved_oxygen,
+            mg_per_l_dissolved_oxygen = excluded.mg_per_l_dissolved_oxygen
+        WHERE excluded.created_at >= latest_reading.created_at
+    ''', (first_id, last_id))
+    logging.debug(f"latest_reading refreshed from SensorData ids {first_id}..{last_id}")
@@ -0,0 +1,98 @@
+# loadtest.py
+# Throughput of the production serve mode (gunicorn.conf.py) for increasing worker counts.
+# $python loadtest.py --workers 1 2 4 --path "/get_sensor_data?SensorID=sensor022&limit=500"
+
+import argparse
+import http.client
+import os
+import subprocess
+import sys
+import time
+from multiprocessing import Pool
+
+
+def wait_until_ready(host, port, path, deadline=30):
+    end = time.time() + deadline
+    while time.time() < end:
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=2)
+            conn.request('GET', path)
+            conn.getresponse().read()
+            conn.close()
+            return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+
+def hammer(args):
+    """Send requests back to back for `duration` seconds; return (ok, errors, latencies)."""
+    host, port, path, duration = args
+    ok, errors, latencies = 0, 0, []
+    end = time.time() + duration
+    while time.time() < end:
+        start = time.perf_counter()
+        try:
+            conn = http.client.HTTPConnection(host, port, timeout=30)
+            conn.request('GET', path)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            if response.status == 200:
+                ok += 1
+            else:
+                errors += 1
+        except OSError:
+            errors += 1
+        latencies.append(time.perf_counter() - start)
+    return ok, errors, latencies
+
+
+def run_level(workers, args):
+    env = dict(os.environ, RIVERSENSE_WORKERS=str(workers),
+               RIVERSENSE_BIND=f'{args.host}:{args.port}', RIVERSENSE_LOG_LEVEL='warning')
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                               '--access-logfile', '/dev/null', 'app:app'],
+                              env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        if not wait_until_ready(args.host, args.port, args.path):
+            print(f"workers={workers}: server did not start")
+            return None
+
+        with Pool(args.clients) as pool:
+            results = pool.map(hammer, [(args.host, args.port, args.path, args.duration)] * args.clients)
+
+        ok = sum(r[0] for r in results)
+        errors = sum(r[1] for r in results)
+        latencies = sorted(l for r in results for l in r[2])
+        p50 = latencies[len(latencies) // 2] * 1000 if latencies else 0
+        p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else 0
+        rps = ok / args.duration
+        print(f"workers={workers:3d}  req/s={rps:9.1f}  errors={errors:5d}  p50={p50:7.1f}ms  p99={p99:7.1f}ms")
+        return rps
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Throughput of the gunicorn serve mode per worker count')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, os.cpu_count() + 1])
+    parser.add_argument('--clients', type=int, default=16, help='concurrent client processes')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per worker count')
+    parser.add_argument('--path', default='/get_rivers')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5099)
+    args = parser.parse_args()
+
+    baseline = None
+    for workers in args.workers:
+        rps = run_level(workers, args)
+        if rps and baseline is None:
+            baseline = rps
+        elif rps and baseline:
+            print(f"             speed-up vs first level: {rps / baseline:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,3 @@
-import sqlite3
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
@@ -7,19 +6,7 @@ from sklearn.model_selection import train_test_split, KFold
 from sklearn.utils import shuffle
 from sklearn.metrics import confusion_matrix, f1_score, classification_report, accuracy_score, precision_score, recall_score
 import seaborn as sns
-
-# 1: Connect to the SQLite database and retrieve the data
-def fetch_data_from_db(db_file):
-    try:
-        conn = sqlite3.connect(db_file)
-        cursor = conn.cursor()
-        cursor.execute('SELECT created_at, temperature, percent_dissolved_oxygen FROM SensorData')  # Fetch created_at
-        rows = cursor.fetchall()
-        conn.close()
-        return np.array(rows)
-    except sqlite3.Error as e:
-        print(f"Database error: {e}")
-        return None
+from training_dataset import load_training_data
 
 # 2: Label data as 'fine' or 'defected' based on the logic
 def label_data(temperature, percent_do):
@@ -107,15 +94,14 @@ def main():
         # Generate synthetic data
         created_at, temperature, percent_do = generate_synthetic_data(samples=1000)
     else:
-        # Fetch created_at, temperature, and dissolved oxygen data from the database
-        data = fetch_data_from_db(db_file)
-        if data is None:
-            return
+        # Fetch created_at, temperature, and dissolved oxygen data from the memory-mapped
+        # training dataset (training_dataset.py), which only reads rows added since the last run
+        data = load_training_data(db_file)
         
         # Split the data into created_at, temperature, and percent_dissolved_oxygen arrays
-        created_at = data[:, 0]
-        temperature = data[:, 1].astype(float)  # Ensure temperature is in float format
-        percent_do = data[:, 2].astype(float)  # Ensure percent dissolved oxygen is in float format
+        created_at = data['created_at']
+        temperature = data['temperature']
+        percent_do = data['percent_dissolved_oxygen']
     
     # Label the data as 'fine' or 'defected' based on the logic
     labels = label_data(temperature, percent_do)
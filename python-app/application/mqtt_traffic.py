@@ -0,0 +1,262 @@
+# mqtt_traffic.py
+# Record raw MQTT traffic and replay it, for load tests from real bursts without the live broker.
+#
+# A recording is a directory of segment files, mqtt-<first message time>-<n>.seg, each
+# MAGIC followed by records of
+#   float64 receipt time (Unix seconds), uint16 topic length, uint32 payload length,
+#   topic (UTF-8), payload (raw bytes)
+# A segment is closed after SEGMENT_BYTES or SEGMENT_SECONDS, so a long recording can be
+# trimmed or copied by the hour. DataFeed.py records what it receives when record_dir is
+# set in constant.py; `record` subscribes on its own.
+#
+# `replay` sends the messages, in order, at their recorded pace divided by --speed
+# (0 = as fast as possible), either straight into a client.Client - which stores them in
+# the --db database, a copy: the database of constant.py is refused - or to a broker. Into the
+# client it reports the achieved rate and the latency from hand-off to commit (p50/p95/p99/max).
+#
+# $python mqtt_traffic.py record DIR [--topic sensor/#]
+# $python mqtt_traffic.py replay DIR --db copy.db [--speed 10]
+# $python mqtt_traffic.py replay DIR --broker localhost [--port 1883] [--speed 10]
+# $python mqtt_traffic.py info DIR
+
+import argparse
+import glob
+import logging
+import os
+import struct
+import threading
+import time
+import numpy as np
+
+MAGIC = b'RSMQTT1\n'
+RECORD = struct.Struct('<dHI')
+SEGMENT_BYTES = 64 * 1024 * 1024
+SEGMENT_SECONDS = 3600
+# At most this many seconds of traffic sit in the write buffer, lost if the process dies
+FLUSH_SECONDS = 5
+
+
+class Recorder:
+    """Appends messages to the current segment of a recording directory; thread-safe."""
+
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, segment_seconds=SEGMENT_SECONDS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.segment_seconds = segment_seconds
+        self.file = None
+        self.opened_at = 0.0
+        self.sequence = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def open_segment(self, now):
+        self.close_segment()
+        self.sequence += 1
+        stamp = time.strftime('%Y%m%dT%H%M%S', time.gmtime(now))
+        path = os.path.join(self.directory, f'mqtt-{stamp}-{self.sequence:04d}.seg')
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.opened_at = now
+        logging.debug(f"Recording MQTT traffic to {path}")
+
+    def close_segment(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def write(self, topic, payload, received=None):
+        received = time.time() if received is None else received
+        topic = topic.encode('utf-8')
+        with self.lock:
+            if (self.file is None or self.file.tell() >= self.segment_bytes
+                    or received - self.opened_at >= self.segment_seconds):
+                self.open_segment(received)
+            self.file.write(RECORD.pack(received, len(topic), len(payload)) + topic + bytes(payload))
+
+    def flush(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def start_flushing(self, interval=FLUSH_SECONDS):
+        """Flush the current segment every interval seconds from a daemon thread."""
+        def run():
+            while True:
+                time.sleep(interval)
+                self.flush()
+        threading.Thread(target=run, daemon=True, name='recorder-flush').start()
+        return self
+
+    def close(self):
+        with self.lock:
+            self.close_segment()
+
+
+def read_segment(path):
+    """(received, topic, payload) for each message of one segment; a torn last record is ignored."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError(f'{path} is not an MQTT recording segment')
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        received, topic_length, payload_length = RECORD.unpack_from(data, offset)
+        start = offset + RECORD.size
+        end = start + topic_length + payload_length
+        if end > len(data):
+            break
+        yield received, data[start:start + topic_length].decode('utf-8'), data[start + topic_length:end]
+        offset = end
+
+
+def read_recording(directory):
+    """All messages of a recording, oldest segment first."""
+    for path in sorted(glob.glob(os.path.join(directory, 'mqtt-*.seg'))):
+        yield from read_segment(path)
+
+
+class ReplayMessage:
+    """What paho hands to on_message, plus when the replayer handed it over."""
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'sent')
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+        self.qos = 0
+        self.retain = False
+        self.sent = 0.0
+
+
+def paced(messages, speed):
+    """Yield messages at their recorded spacing divided by speed (speed 0: no waiting)."""
+    first = start = None
+    for received, topic, payload in messages:
+        if speed > 0:
+            if first is None:
+                first, start = received, time.perf_counter()
+            delay = start + (received - first) / speed - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+        yield topic, payload
+
+
+def percentiles_ms(latencies):
+    if not latencies:
+        return {}
+    values = np.array(latencies) * 1000
+    return {'p50': round(float(np.percentile(values, 50)), 3), 'p95': round(float(np.percentile(values, 95)), 3),
+            'p99': round(float(np.percentile(values, 99)), 3), 'max': round(float(values.max()), 3)}
+
+
+def replay_to_client(messages, db_file, speed=1.0):
+    """Feed messages into a client.Client storing into db_file; returns rate and hand-off-to-commit latency."""
+    from client import Client
+    from constant import database_file
+
+    if os.path.realpath(db_file) == os.path.realpath(database_file):
+        raise ValueError(f"{db_file} is the live database of constant.py; replay into a copy")
+
+    latencies = []
+    lock = threading.Lock()
+
+    class TimedClient(Client):
+        def process_message(self, msg, received_at=None):
+            try:
+                return super().process_message(msg, received_at)
+            finally:
+                with lock:
+                    latencies.append(time.perf_counter() - msg.sent)
+
+    client = TimedClient('replay', 'local', '#')
+    client.database_file = db_file
+    count = 0
+    started = time.perf_counter()
+    for topic, payload in paced(messages, speed):
+        msg = ReplayMessage(topic, payload)
+        msg.sent = time.perf_counter()
+        client.on_message(None, None, msg)
+        count += 1
+    client.executor.shutdown(wait=True)
+    elapsed = time.perf_counter() - started
+    return {'messages': count, 'seconds': round(elapsed, 3), 'rate': round(count / elapsed, 1) if elapsed else None,
+            'latency_ms': percentiles_ms(latencies)}
+
+
+def replay_to_broker(messages, speed, host, port):
+    """Publish messages to a broker; returns the achieved publish rate."""
+    import paho.mqtt.client as mqtt
+
+    publisher = mqtt.Client()
+    publisher.connect(host, port)
+    publisher.loop_start()
+    count = 0
+    started = time.perf_counter()
+    for topic, payload in paced(messages, speed):
+        publisher.publish(topic, payload)
+        count += 1
+    publisher.loop_stop()
+    publisher.disconnect()
+    elapsed = time.perf_counter() - started
+    return {'messages': count, 'seconds': round(elapsed, 3), 'rate': round(count / elapsed, 1) if elapsed else None}
+
+
+def record(directory, broker, port, topic, keepalive=60):
+    import paho.mqtt.client as mqtt
+
+    recorder = Recorder(directory).start_flushing()
+    subscriber = mqtt.Client()
+    subscriber.on_connect = lambda client, userdata, flags, rc: client.subscribe(topic)
+    subscriber.on_message = lambda client, userdata, msg: recorder.write(msg.topic, msg.payload)
+    subscriber.connect(broker, port, keepalive)
+    try:
+        subscriber.loop_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        recorder.close()
+
+
+if __name__ == '__main__':
+    from constant import mqtt_broker, mqtt_broker_port, topic
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Record and replay MQTT traffic')
+    sub = parser.add_subparsers(dest='command', required=True)
+    rec = sub.add_parser('record', help='subscribe and record until interrupted')
+    rec.add_argument('directory')
+    rec.add_argument('--topic', default=topic)
+    rep = sub.add_parser('replay', help='replay a recording into client.Client or a broker')
+    rep.add_argument('directory')
+    rep.add_argument('--speed', type=float, default=1.0, help='1 = recorded pace, 10 = ten times faster, 0 = no waiting')
+    rep.add_argument('--db', default=None, help='database copy client.Client stores into (not the one of constant.py)')
+    rep.add_argument('--broker', default=None, help='publish to this broker instead of calling client.Client')
+    rep.add_argument('--port', type=int, default=1883)
+    info = sub.add_parser('info', help='summarise a recording')
+    info.add_argument('directory')
+    args = parser.parse_args()
+
+    if args.command == 'record':
+        record(args.directory, mqtt_broker, mqtt_broker_port, args.topic)
+    elif args.command == 'replay':
+        messages = read_recording(args.directory)
+        if args.broker:
+            print(replay_to_broker(messages, args.speed, args.broker, args.port))
+        elif not args.db:
+            parser.error('replay needs --db (a copy of the database) or --broker')
+        else:
+            # client.py logs every message at DEBUG; keep the replay's own cost out of the measurement
+            logging.getLogger().setLevel(logging.WARNING)
+            print(replay_to_client(messages, args.db, args.speed))
+    else:
+        times, size, topics = [], 0, set()
+        for received, message_topic, payload in read_recording(args.directory):
+            times.append(received)
+            size += len(payload)
+            topics.add(message_topic)
+        if times:
+            span = times[-1] - times[0]
+            print(f"{len(times)} messages on {len(topics)} topics, {size} payload bytes, "
+                  f"{time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(times[0]))} + {span:.0f}s "
+                  f"({len(times) / span if span else 0:.1f} msg/s)")
+        else:
+            print('empty recording')
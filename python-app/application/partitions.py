@@ -0,0 +1,309 @@
+# partitions.py
+# Monthly partitioning of SensorData.
+# The main database keeps only the recent (hot) months. Closed months are moved into one
+# SQLite file per month under partition_dir, attached only when a query needs them.
+# Past the retention horizon a partition is compacted into hourly rollups in the main
+# database (and optionally a compressed Parquet archive) and its file is removed.
+#
+# $python partitions.py roll     (move closed months out of the main database)
+# $python partitions.py retain   (roll up and archive partitions older than retention_months)
+
+import argparse
+import logging
+import os
+import sqlite3
+import database
+from datetime import datetime
+from pathlib import Path
+from constant import database_file, partition_dir, hot_months, retention_months
+
+SENSOR_DATA_SCHEMA = '''CREATE TABLE IF NOT EXISTS {schema}.SensorData (
+                    id INTEGER PRIMARY KEY,
+                    SensorID TEXT NOT NULL,
+                    created_at TIMESTAMP,
+                    updated_at TIMESTAMP,
+                    riverID INTEGER,
+                    river TEXT,
+                    latlong TEXT,
+                    message_counter INTEGER,
+                    temperature REAL,
+                    percent_dissolved_oxygen REAL,
+                    mg_per_l_dissolved_oxygen REAL,
+                    received_at TIMESTAMP
+                )'''
+
+SENSOR_DATA_COLUMNS = '''id, SensorID, created_at, updated_at, riverID, river, latlong, message_counter,
+                    temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen, received_at'''
+
+
+def month_start(year, month):
+    return f"{year:04d}-{month:02d}-01 00:00:00"
+
+
+def next_month(year, month):
+    return (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def add_months(year, month, count):
+    index = year * 12 + (month - 1) + count
+    return index // 12, index % 12 + 1
+
+
+def months_between(start, end):
+    """(year, month) pairs overlapping [start, end); start/end are 'YYYY-MM-DD...' strings."""
+    year, month = int(start[0:4]), int(start[5:7])
+    months = []
+    while month_start(year, month) < end:
+        months.append((year, month))
+        year, month = next_month(year, month)
+    return months
+
+
+def partition_path(year, month):
+    return os.path.join(partition_dir, f"SensorData_{year:04d}_{month:02d}.db")
+
+
+def existing_partitions():
+    """All (year, month) partitions on disk, oldest first."""
+    if not os.path.isdir(partition_dir):
+        return []
+    months = []
+    for name in os.listdir(partition_dir):
+        if name.startswith('SensorData_') and name.endswith('.db'):
+            year, month = name[len('SensorData_'):-len('.db')].split('_')
+            months.append((int(year), int(month)))
+    return sorted(months)
+
+
+def create_rollup_table(cursor):
+    """Hourly aggregates of archived months, kept in the main database."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS SensorDataRollup (
+                    SensorID TEXT NOT NULL,
+                    hour TIMESTAMP NOT NULL,
+                    riverID INTEGER,
+                    readings INTEGER,
+                    avg_temperature REAL,
+                    min_temperature REAL,
+                    max_temperature REAL,
+                    avg_percent_dissolved_oxygen REAL,
+                    min_percent_dissolved_oxygen REAL,
+                    max_percent_dissolved_oxygen REAL,
+                    avg_mg_per_l_dissolved_oxygen REAL,
+                    min_mg_per_l_dissolved_oxygen REAL,
+                    max_mg_per_l_dissolved_oxygen REAL,
+                    PRIMARY KEY (SensorID, hour)
+                )''')
+
+
+def attach(conn, year, month, alias='part'):
+    conn.execute('ATTACH DATABASE ? AS ' + alias, (partition_path(year, month),))
+
+
+def detach(conn, alias='part'):
+    conn.execute('DETACH DATABASE ' + alias)
+
+
+def add_received_at(conn, schema):
+    """Add SensorData.received_at (freshness.py) where an older main database or partition lacks it."""
+    columns = [row[1] for row in conn.execute(f'PRAGMA {schema}.table_info(SensorData)')]
+    if 'received_at' not in columns:
+        conn.execute(f'ALTER TABLE {schema}.SensorData ADD COLUMN received_at TIMESTAMP')
+
+
+def roll_partitions(now=None, vacuum=True):
+    """Move every month older than the hot window from the main SensorData into its partition."""
+    now = now or datetime.utcnow()
+    cutoff_year, cutoff_month = add_months(now.year, now.month, -(hot_months - 1))
+    cutoff = month_start(cutoff_year, cutoff_month)
+    os.makedirs(partition_dir, exist_ok=True)
+
+    conn = database.connect(database_file)
+    oldest = conn.execute('SELECT MIN(created_at) FROM SensorData WHERE created_at < ?', (cutoff,)).fetchone()[0]
+    if oldest is None:
+        logging.debug("No closed months to partition")
+        conn.close()
+        return []
+
+    add_received_at(conn, 'main')
+    moved = []
+    for year, month in months_between(str(oldest), cutoff):
+        start = month_start(year, month)
+        end = month_start(*next_month(year, month))
+        attach(conn, year, month)
+        try:
+            conn.execute(SENSOR_DATA_SCHEMA.format(schema='part'))
+            add_received_at(conn, 'part')
+            conn.execute('CREATE INDEX IF NOT EXISTS part.idx_sensordata_sensor_time ON SensorData(SensorID, created_at)')
+            # In WAL mode a transaction spanning ATTACHed databases is not atomic across them, so
+            # the copy is committed and checked before anything is deleted. A crash in between
+            # leaves rows in both places; re-running roll copies nothing twice (same ids) and
+            # deletes only rows the partition holds.
+            with conn:
+                conn.execute(f'''INSERT OR IGNORE INTO part.SensorData ({SENSOR_DATA_COLUMNS})
+                                 SELECT {SENSOR_DATA_COLUMNS} FROM main.SensorData
+                                 WHERE created_at >= ? AND created_at < ?''', (start, end))
+            missing = conn.execute('''SELECT COUNT(*) FROM main.SensorData
+                                      WHERE created_at >= ? AND created_at < ?
+                                        AND id NOT IN (SELECT id FROM part.SensorData)''', (start, end)).fetchone()[0]
+            if missing:
+                raise RuntimeError(f"{missing} rows of {year:04d}-{month:02d} were not copied to "
+                                   f"{partition_path(year, month)}; main database left untouched")
+            with conn:
+                count = conn.execute('''DELETE FROM main.SensorData
+                                        WHERE created_at >= ? AND created_at < ?
+                                          AND id IN (SELECT id FROM part.SensorData)''', (start, end)).rowcount
+        finally:
+            detach(conn)
+        logging.debug(f"Moved {count} rows into {partition_path(year, month)}")
+        moved.append(((year, month), count))
+
+    if vacuum:
+        conn.execute('VACUUM')
+    conn.close()
+    return moved
+
+
+def overlapping_partitions(start=None, end=None):
+    """Partitions on disk holding any of [start, end); None leaves that side open."""
+    return [(year, month) for year, month in existing_partitions()
+            if (end is None or month_start(year, month) < end)
+            and (start is None or month_start(*next_month(year, month)) > start)]
+
+
+def partitions_between(oldest, newest):
+    """Partitions on disk holding any time from oldest to newest, both included."""
+    return [(year, month) for year, month in overlapping_partitions(oldest, None)
+            if month_start(year, month) <= newest]
+
+
+def query_sources(conn, sql, params, start=None, end=None):
+    """Run sql against the SensorData of every partition overlapping [start, end), then the main one.
+
+    sql names the table as {table}; the rows of all sources are returned one source after
+    the other (oldest partition first), so a caller that needs another order sorts them.
+    """
+    rows = []
+    for year, month in overlapping_partitions(start, end):
+        attach(conn, year, month)
+        try:
+            rows.extend(conn.execute(sql.format(table='part.SensorData'), params).fetchall())
+        finally:
+            detach(conn)
+    rows.extend(conn.execute(sql.format(table='main.SensorData'), params).fetchall())
+    return rows
+
+
+def query_range(sensor_id, start=None, end=None, columns='*', max_rows=-1, on_connect=None, offset=0):
+    """Rows for one sensor with start <= created_at < end (None = unbounded), oldest first.
+
+    Only the partitions overlapping the range are attached, one at a time, and the
+    main database is read last for the hot months. At most max_rows rows are read
+    (-1 = no limit) after skipping the first `offset`; on_connect(conn) lets the caller
+    set up the connection first.
+    """
+    # Read-only, like the API's read connections: a query never takes the write lock
+    conn = database.connect(Path(database_file).resolve().as_uri() + '?mode=ro', uri=True)
+    conn.row_factory = sqlite3.Row
+    if on_connect is not None:
+        on_connect(conn)
+    where = 'SensorID = ?'
+    params = [sensor_id]
+    if start is not None:
+        where += ' AND created_at >= ?'
+        params.append(start)
+    if end is not None:
+        where += ' AND created_at < ?'
+        params.append(end)
+    rows = []
+    try:
+        for source in overlapping_partitions(start, end) + [None]:
+            if 0 <= max_rows <= len(rows):
+                break
+            if source is not None:
+                attach(conn, *source)
+            table = 'main.SensorData' if source is None else 'part.SensorData'
+            try:
+                if offset:
+                    # Skip whole sources by their count instead of reading their rows
+                    count = conn.execute(f'SELECT COUNT(*) FROM {table} WHERE {where}', params).fetchone()[0]
+                    if count <= offset:
+                        offset -= count
+                        continue
+                rows.extend(dict(row) for row in conn.execute(
+                    f'''SELECT {columns} FROM {table} WHERE {where}
+                        ORDER BY created_at LIMIT ? OFFSET ?''',
+                    (*params, max_rows - len(rows) if max_rows >= 0 else -1, offset)))
+                offset = 0
+            finally:
+                if source is not None:
+                    detach(conn)
+    finally:
+        conn.close()
+    return rows
+
+
+def apply_retention(now=None, archive_parquet=False):
+    """Compact partitions older than retention_months into hourly rollups and remove them."""
+    now = now or datetime.utcnow()
+    horizon = add_months(now.year, now.month, -retention_months)
+
+    conn = database.connect(database_file)
+    create_rollup_table(conn.cursor())
+    compacted = []
+    for year, month in existing_partitions():
+        if (year, month) >= horizon:
+            break
+        path = partition_path(year, month)
+        if archive_parquet:
+            write_parquet_archive(path, year, month)
+
+        attach(conn, year, month)
+        try:
+            with conn:
+                conn.execute('''
+                    INSERT OR REPLACE INTO SensorDataRollup
+                    SELECT SensorID, strftime('%Y-%m-%d %H:00:00', created_at) AS hour, MAX(riverID), COUNT(*),
+                           AVG(temperature), MIN(temperature), MAX(temperature),
+                           AVG(percent_dissolved_oxygen), MIN(percent_dissolved_oxygen), MAX(percent_dissolved_oxygen),
+                           AVG(mg_per_l_dissolved_oxygen), MIN(mg_per_l_dissolved_oxygen), MAX(mg_per_l_dissolved_oxygen)
+                    FROM part.SensorData
+                    GROUP BY SensorID, hour
+                ''')
+        finally:
+            detach(conn)
+        os.remove(path)
+        logging.debug(f"Compacted {path} into SensorDataRollup")
+        compacted.append((year, month))
+    conn.close()
+    return compacted
+
+
+def write_parquet_archive(path, year, month):
+    """Keep the raw rows of a partition as a zstd-compressed Parquet file (needs pandas + pyarrow)."""
+    import pandas as pd
+
+    archive_dir = os.path.join(partition_dir, 'archive')
+    os.makedirs(archive_dir, exist_ok=True)
+    part = database.connect(path)
+    try:
+        df = pd.read_sql_query('SELECT * FROM SensorData ORDER BY SensorID, created_at', part)
+    finally:
+        part.close()
+    target = os.path.join(archive_dir, f"SensorData_{year:04d}_{month:02d}.parquet")
+    df.to_parquet(target, compression='zstd', index=False)
+    logging.debug(f"Archived {len(df)} rows to {target}")
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description='Monthly SensorData partitions and retention')
+    parser.add_argument('command', choices=['roll', 'retain'])
+    parser.add_argument('--parquet', action='store_true', help='also archive raw rows to Parquet before compacting')
+    parser.add_argument('--no-vacuum', action='store_true', help='skip VACUUM of the main database after rolling')
+    args = parser.parse_args()
+
+    if args.command == 'roll':
+        print(roll_partitions(vacuum=not args.no_vacuum))
+    else:
+        print(apply_retention(archive_parquet=args.parquet))
@@ -0,0 +1,152 @@
+# placements.py
+# Where each sensor was, and when - the SQLite counterpart of the Oracle SensorPlace table.
+# Every move closes the sensor's open placement (date_to = time of the move) and opens a new
+# one, so readings can be matched with the river and location they were taken at instead of
+# wherever the sensor is today.
+#
+# PlacementIndex holds all placements in sorted NumPy arrays keyed by (sensor, date_from);
+# locate() answers "where was sensor X at time t" for a whole batch of readings with one
+# searchsorted, so the join happens at read time without a per-row subquery.
+
+import logging
+import threading
+import numpy as np
+
+# The first placement of a sensor is open from here, so readings imported from before the
+# sensor was registered still find a place
+PLACEMENT_EPOCH = '1970-01-01 00:00:00'
+SENSOR_SHIFT = 40  # key = sensor code << 40 | epoch seconds
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def create_sensor_place_table(cursor):
+    """sensorPlace table, seeded with each registered sensor's current placement."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS sensorPlace (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    sensorID INTEGER NOT NULL,
+                    riverID INTEGER,
+                    location TEXT,
+                    lat TEXT,
+                    long TEXT,
+                    date_from TIMESTAMP NOT NULL,
+                    date_to TIMESTAMP,
+                    notes TEXT,
+                    moved_by TEXT,
+                    FOREIGN KEY (sensorID) REFERENCES sensorInfo(sensorID),
+                    FOREIGN KEY (riverID) REFERENCES riverData(riverID)
+                )''')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sensorplace_sensor ON sensorPlace(sensorID, date_from)')
+    cursor.execute('''INSERT INTO sensorPlace (sensorID, riverID, location, lat, long, date_from)
+                      SELECT sensorID, riverID, location, lat, long, ? FROM sensorInfo
+                      WHERE sensorID NOT IN (SELECT sensorID FROM sensorPlace)''', (PLACEMENT_EPOCH,))
+    if cursor.rowcount:
+        logging.debug(f"Seeded {cursor.rowcount} sensor placements from sensorInfo")
+
+
+def record_placement(cursor, sensorID, riverID, location, lat, long, moved_at, notes=None, moved_by=None):
+    """Open a new placement if the sensor's river or position changed; returns True on a move.
+
+    A sensor without any placement yet gets one open from PLACEMENT_EPOCH.
+    """
+    moved_at = moved_at.strftime('%Y-%m-%d %H:%M:%S') if hasattr(moved_at, 'strftime') else moved_at
+    # Compared in SQL so column affinity treats riverID '3' and 3 (or lat 51.5 and '51.5') alike
+    current = cursor.execute('''SELECT id, riverID IS ? AND location IS ? AND lat IS ? AND long IS ? FROM sensorPlace
+                                WHERE sensorID = ? AND date_to IS NULL''',
+                             (riverID, location, lat, long, sensorID)).fetchone()
+    if current is not None:
+        if current[1]:
+            return False
+        cursor.execute('UPDATE sensorPlace SET date_to = ? WHERE id = ?', (moved_at, current[0]))
+    else:
+        moved_at = PLACEMENT_EPOCH
+    cursor.execute('''INSERT INTO sensorPlace (sensorID, riverID, location, lat, long, date_from, notes, moved_by)
+                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                   (sensorID, riverID, location, lat, long, moved_at, notes, moved_by))
+    logging.debug(f"Sensor {sensorID} placed on river {riverID} at {lat},{long} from {moved_at}")
+    return True
+
+
+def to_seconds(times):
+    return np.asarray(times, dtype='datetime64[s]').astype(np.int64)
+
+
+class PlacementIndex:
+    """All placements as sorted arrays, searchable by (sensor, time) in bulk."""
+
+    def __init__(self, conn):
+        rows = conn.execute('''SELECT sensorPlace.id, sensorPlace.sensorID, sensorInfo.sensorName,
+                                      sensorPlace.riverID, riverData.riverName, sensorPlace.location,
+                                      sensorPlace.lat || ',' || sensorPlace.long, sensorPlace.date_from, sensorPlace.date_to
+                               FROM sensorPlace
+                               JOIN sensorInfo ON sensorInfo.sensorID = sensorPlace.sensorID
+                               LEFT JOIN riverData ON riverData.riverID = sensorPlace.riverID
+                               ORDER BY sensorPlace.sensorID, sensorPlace.date_from''').fetchall()
+        self.signature = self.current_signature(conn)
+
+        # SensorData.SensorID is the sensorName for MQTT readings and the sensorID for API imports
+        self.codes = {}
+        for row in rows:
+            code = self.codes.setdefault(str(row[1]), len(self.codes))
+            self.codes.setdefault(row[2], code)
+
+        columns = list(zip(*rows)) if rows else [()] * 9
+        sensor_codes = np.array([self.codes[str(s)] for s in columns[1]], dtype=np.int64)
+        self.starts = to_seconds(columns[7])
+        self.ends = to_seconds([t if t is not None else '9999-12-31' for t in columns[8]])
+        self.keys = (sensor_codes << SENSOR_SHIFT) | self.starts
+        self.sensor_codes = sensor_codes
+        self.riverIDs = np.array(columns[3], dtype=object)
+        self.riverNames = np.array(columns[4], dtype=object)
+        self.locations = np.array(columns[5], dtype=object)
+        self.latlongs = np.array(columns[6], dtype=object)
+
+    @staticmethod
+    def current_signature(conn):
+        # Every move inserts a row, so the newest id tells whether the index is stale
+        return conn.execute('SELECT COUNT(*), MAX(id) FROM sensorPlace').fetchone()
+
+    def lookup(self, sensor_ids, times):
+        """Row positions of the placement in force for each (sensor, time); -1 where there is none."""
+        codes = np.array([self.codes.get(str(s), -1) for s in sensor_ids], dtype=np.int64)
+        seconds = to_seconds(times)
+        if len(self.keys) == 0:
+            return np.full(len(codes), -1, dtype=np.int64)
+        pos = np.searchsorted(self.keys, (np.maximum(codes, 0) << SENSOR_SHIFT) | seconds, side='right') - 1
+        pos_c = np.maximum(pos, 0)
+        found = (codes >= 0) & (pos >= 0) & (self.sensor_codes[pos_c] == codes) & (seconds < self.ends[pos_c])
+        return np.where(found, pos, -1)
+
+    def locate(self, sensor_ids, times):
+        """(riverID, riverName, location, latlong) arrays for a batch of readings, None where unplaced."""
+        pos = self.lookup(sensor_ids, times)
+        found = pos >= 0
+        out = []
+        for column in (self.riverIDs, self.riverNames, self.locations, self.latlongs):
+            values = np.full(len(pos), None, dtype=object)
+            values[found] = column[pos[found]]
+            out.append(values)
+        return tuple(out)
+
+    def place_rows(self, rows):
+        """Overwrite riverID, river and latlong of SensorData dicts with their placement at created_at."""
+        if not rows:
+            return rows
+        found = self.lookup([r['SensorID'] for r in rows], [r['created_at'] for r in rows])
+        for row, pos in zip(rows, found.tolist()):
+            if pos >= 0:
+                row['riverID'] = self.riverIDs[pos]
+                row['river'] = self.riverNames[pos]
+                row['latlong'] = self.latlongs[pos]
+        return rows
+
+
+def get_placement_index(conn):
+    """The process-wide index, rebuilt when sensorPlace has changed since it was loaded."""
+    global _index
+    with _index_lock:
+        if _index is None or _index.signature != PlacementIndex.current_signature(conn):
+            _index = PlacementIndex(conn)
+            logging.debug(f"Loaded {len(_index.keys)} sensor placements")
+        return _index
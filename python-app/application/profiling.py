@@ -0,0 +1,249 @@
+# profiling.py
+# Opt-in statistical profiling for the API and the ingest process.
+#
+# One background thread (started on first use) samples Python stacks with
+# sys._current_frames() every SAMPLE_INTERVAL and folds them into "collapsed stack" counts,
+# the text format flamegraph.pl and speedscope read. It samples:
+#   - a single request, when it carries a valid X-Profile token (see make_token)
+#   - any request still running after profile_slow_seconds (constant.py); the rest of
+#     the request is sampled and saved with its total duration
+#   - every thread of the process for a time window (start_window), used by the
+#     /admin/profile route for the API and, through the recent buffer listener, for DataFeed.py
+# With nothing to sample the thread only wakes every IDLE_POLL; a request that is not
+# profiled costs a dict insert and removal.
+#
+# Each profile is <profile_dir>/<name>.folded plus <name>.json (what, when, how long);
+# the newest MAX_PROFILES are kept.
+#
+# $python profiling.py token [--minutes 10]
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import datetime, timezone
+from flask import g, request
+
+PROFILE_HEADER = 'X-Profile'
+SAMPLE_INTERVAL = 0.005
+IDLE_POLL = 0.05
+MAX_PROFILES = 200
+MAX_WINDOW_SECONDS = 300
+NAME_PATTERN = re.compile(r'^[0-9T]+-(request|slow|window)-[A-Za-z0-9_.-]+$')
+
+
+def make_token(secret, minutes=10):
+    """'<expiry>.<hmac>' for the X-Profile header and the admin routes."""
+    expires = int(time.time() + minutes * 60)
+    signature = hmac.new(secret.encode(), str(expires).encode(), hashlib.sha256).hexdigest()
+    return f"{expires}.{signature}"
+
+
+def valid_token(token, secret):
+    if not token or not secret:
+        return False
+    expires, _, signature = token.partition('.')
+    if not expires.isdigit() or int(expires) < time.time():
+        return False
+    expected = hmac.new(secret.encode(), expires.encode(), hashlib.sha256).hexdigest()
+    return hmac.compare_digest(signature, expected)
+
+
+def frame_name(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def fold(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame.f_code))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class Trace:
+    __slots__ = ('reason', 'label', 'thread_id', 'started', 'start', 'sample_from', 'counts')
+
+    def __init__(self, reason, label, thread_id=None, delay=0.0):
+        self.reason = reason
+        self.label = label
+        self.thread_id = thread_id  # None = every thread
+        self.started = datetime.now(timezone.utc)
+        self.start = time.monotonic()
+        self.sample_from = self.start + delay
+        self.counts = Counter()
+
+
+class Sampler:
+    def __init__(self):
+        self.traces = {}
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def watch(self, trace):
+        with self.lock:
+            self.traces[id(trace)] = trace
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name='profiler')
+                self.thread.start()
+        self.wake.set()
+
+    def unwatch(self, trace):
+        with self.lock:
+            self.traces.pop(id(trace), None)
+
+    def run(self):
+        me = threading.get_ident()
+        while True:
+            now = time.monotonic()
+            with self.lock:
+                due = [trace for trace in self.traces.values() if now >= trace.sample_from]
+            if due:
+                frames = sys._current_frames()
+                names = None
+                for trace in due:
+                    if trace.thread_id is not None:
+                        frame = frames.get(trace.thread_id)
+                        if frame is not None:
+                            trace.counts[fold(frame)] += 1
+                        continue
+                    if names is None:
+                        names = {t.ident: t.name for t in threading.enumerate()}
+                    for thread_id, frame in frames.items():
+                        if thread_id != me:
+                            trace.counts[names.get(thread_id, 'thread') + ';' + fold(frame)] += 1
+                del frames
+            # watch() wakes an idle thread, so a new request does not wait out IDLE_POLL
+            self.wake.wait(SAMPLE_INTERVAL if due else IDLE_POLL)
+            self.wake.clear()
+
+
+SAMPLER = Sampler()
+
+
+def save_profile(profile_dir, trace):
+    """Write the trace's folded stacks and metadata; returns the profile name."""
+    os.makedirs(profile_dir, exist_ok=True)
+    label = re.sub(r'[^A-Za-z0-9_.-]', '_', trace.label or 'unknown')[:60]
+    name = f"{trace.started.strftime('%Y%m%dT%H%M%S%f')}-{trace.reason}-{label}"
+    with open(os.path.join(profile_dir, name + '.folded'), 'w') as f:
+        for stack, count in trace.counts.most_common():
+            f.write(f"{stack} {count}\n")
+    meta = {'name': name, 'reason': trace.reason, 'label': trace.label,
+            'started_at': trace.started.replace(tzinfo=None).isoformat(' '),
+            'duration_seconds': round(time.monotonic() - trace.start, 3),
+            'samples': sum(trace.counts.values()), 'interval_seconds': SAMPLE_INTERVAL}
+    with open(os.path.join(profile_dir, name + '.json'), 'w') as f:
+        json.dump(meta, f)
+    prune_profiles(profile_dir)
+    logging.debug(f"Saved profile {name} ({meta['samples']} samples)")
+    return name
+
+
+def prune_profiles(profile_dir):
+    names = sorted(f[:-5] for f in os.listdir(profile_dir) if f.endswith('.json'))
+    for name in names[:-MAX_PROFILES]:
+        for ext in ('.json', '.folded'):
+            try:
+                os.remove(os.path.join(profile_dir, name + ext))
+            except FileNotFoundError:
+                pass
+
+
+def list_profiles(profile_dir):
+    """Metadata of the saved profiles, newest first."""
+    if not os.path.isdir(profile_dir):
+        return []
+    profiles = []
+    for f in sorted(os.listdir(profile_dir), reverse=True):
+        if f.endswith('.json'):
+            try:
+                with open(os.path.join(profile_dir, f)) as fh:
+                    profiles.append(json.load(fh))
+            except (OSError, ValueError):
+                continue
+    return profiles
+
+
+def profile_path(profile_dir, name):
+    """Path of a profile's folded stacks, or None for an unknown or malformed name."""
+    if not NAME_PATTERN.match(name):
+        return None
+    path = os.path.join(profile_dir, name + '.folded')
+    return path if os.path.exists(path) else None
+
+
+def start_window(profile_dir, seconds, label):
+    """Sample every thread of this process for `seconds` in the background; returns at once."""
+    seconds = min(float(seconds), MAX_WINDOW_SECONDS)
+    if seconds <= 0:
+        raise ValueError('seconds must be positive')
+    trace = Trace('window', label)
+    SAMPLER.watch(trace)
+
+    def finish():
+        SAMPLER.unwatch(trace)
+        try:
+            save_profile(profile_dir, trace)
+        except Exception as e:
+            logging.error(f"Error saving profile: {e}")
+
+    timer = threading.Timer(seconds, finish)
+    timer.daemon = True
+    timer.start()
+    return seconds
+
+
+def init_profiling(app, profile_dir, secret=None, slow_seconds=None):
+    """Profile requests carrying a valid X-Profile token, and any request slower than slow_seconds."""
+
+    def begin():
+        if request.path.startswith('/admin/'):
+            return
+        token = request.headers.get(PROFILE_HEADER)
+        if token is not None and valid_token(token, secret):
+            g.trace = Trace('request', request.endpoint, threading.get_ident())
+        elif slow_seconds is not None:
+            g.trace = Trace('slow', request.endpoint, threading.get_ident(), delay=slow_seconds)
+        else:
+            return
+        SAMPLER.watch(g.trace)
+
+    def end(exc=None):
+        trace = g.pop('trace', None)
+        if trace is None:
+            return
+        SAMPLER.unwatch(trace)
+        if trace.reason == 'slow':
+            if not trace.counts:
+                return
+            logging.warning(f"Slow request {request.path}: {time.monotonic() - trace.start:.2f}s, profile saved")
+        try:
+            save_profile(profile_dir, trace)
+        except Exception as e:
+            logging.error(f"Error saving profile: {e}")
+
+    app.before_request(begin)
+    app.teardown_request(end)
+
+
+if __name__ == '__main__':
+    from constant import profile_secret
+
+    parser = argparse.ArgumentParser(description='Profiling helpers')
+    sub = parser.add_subparsers(dest='command', required=True)
+    token = sub.add_parser('token', help='print an X-Profile token')
+    token.add_argument('--minutes', type=float, default=10)
+    args = parser.parse_args()
+
+    if not profile_secret:
+        raise SystemExit('Set profile_secret in constant.py first')
+    print(make_token(profile_secret, args.minutes))
@@ -0,0 +1,251 @@
+# recent_buffer.py
+# The last few hours of MQTT readings, kept in memory by the ingest process (DataFeed.py).
+# Each sensor has a fixed-size NumPy ring of (created_at, updated_at, id, message_counter,
+# temperature, %DO, mg/L DO) rows that Client.save_to_db appends to after each commit.
+# The ring is warmed from SensorData at start-up, so it covers everything stored since
+# recent_hours ago; a window starting before that (or before the oldest reading a ring
+# has overwritten) is not covered and the caller reads the database instead.
+#
+# The API reaches the buffer through a multiprocessing.connection listener on
+# recent_address; fetch_recent() returns None whenever the buffer cannot answer.
+# The same listener starts profiling windows of the ingest process (profile_ingest)
+# and reports its SQL statistics (ingest_sql_stats).
+# Requests and answers are JSON over send_bytes/recv_bytes, never pickles, so neither
+# side runs code sent by the other; the listener is off unless recent_address is set,
+# and refuses to start with the template's authkey.
+
+import json
+import logging
+import threading
+import time
+from datetime import datetime, timezone
+from multiprocessing.connection import Client as ConnectionClient, Listener
+import numpy as np
+import database
+from profiling import start_window
+
+COLUMNS = ('created_at', 'updated_at', 'id', 'message_counter',
+           'temperature', 'percent_dissolved_oxygen', 'mg_per_l_dissolved_oxygen')
+READINGS_PER_HOUR_CAPACITY = 60  # room for one reading a minute
+TEMPLATE_AUTHKEY = b'change-me'
+MAX_MESSAGE_BYTES = 64 * 1024 * 1024
+
+
+def to_epoch(value):
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=value.tzinfo or timezone.utc).timestamp()
+    return np.datetime64(str(value).replace('+00:00', ''), 'us').astype(np.int64) / 1e6
+
+
+def epoch_to_text(seconds):
+    """Same text SQLite stores for a naive UTC datetime (isoformat with a space)."""
+    return datetime.fromtimestamp(seconds, timezone.utc).replace(tzinfo=None).isoformat(' ')
+
+
+class SensorRing:
+    __slots__ = ('rows', 'next', 'size', 'evicted_until', 'riverID', 'river', 'latlong')
+
+    def __init__(self, capacity):
+        self.rows = np.empty((capacity, len(COLUMNS)))
+        self.next = 0
+        self.size = 0
+        self.evicted_until = -np.inf  # created_at of the newest reading overwritten so far
+        self.riverID = self.river = self.latlong = None
+
+    def append(self, row):
+        capacity = len(self.rows)
+        if self.size == capacity:
+            self.evicted_until = max(self.evicted_until, self.rows[self.next, 0])
+        else:
+            self.size += 1
+        self.rows[self.next] = row
+        self.next = (self.next + 1) % capacity
+
+    def window(self, start, end):
+        rows = self.rows[:self.size]
+        selected = rows[(rows[:, 0] >= start) & (rows[:, 0] < end)]
+        return selected[np.argsort(selected[:, 0], kind='stable')]
+
+
+class RecentReadings:
+    def __init__(self, hours):
+        self.hours = hours
+        self.capacity = int(hours * READINGS_PER_HOUR_CAPACITY)
+        self.sensors = {}
+        self.covered_from = np.inf
+        self.lock = threading.Lock()
+
+    def add(self, sensor_name, riverID, river, latlong, created_at, updated_at, data_id, message_counter,
+            temperature, per_do, ml_do):
+        row = (to_epoch(created_at), to_epoch(updated_at), data_id, message_counter, temperature, per_do, ml_do)
+        row = tuple(np.nan if x is None else x for x in row)
+        with self.lock:
+            ring = self.sensors.get(sensor_name)
+            if ring is None:
+                ring = self.sensors[sensor_name] = SensorRing(self.capacity)
+            ring.riverID, ring.river, ring.latlong = riverID, river, latlong
+            ring.append(row)
+
+    def warm(self, conn):
+        """Load the last `hours` of readings of the active MQTT sensors from SensorData."""
+        since = time.time() - self.hours * 3600
+        rows = conn.execute('''SELECT SensorID, riverID, river, latlong, created_at, updated_at, id, message_counter,
+                                       temperature, percent_dissolved_oxygen, mg_per_l_dissolved_oxygen
+                                FROM SensorData
+                                WHERE created_at >= ? AND SensorID IN (SELECT sensorName FROM sensorInfo WHERE status = 'active')
+                                ORDER BY id''', (epoch_to_text(since),)).fetchall()
+        for row in rows:
+            self.add(*row)
+        # Registered sensors that sent nothing lately are still covered: they have no readings
+        for (sensor_name,) in conn.execute("SELECT sensorName FROM sensorInfo WHERE status = 'active'"):
+            with self.lock:
+                self.sensors.setdefault(sensor_name, SensorRing(self.capacity))
+        self.covered_from = since
+        logging.debug(f"Recent buffer warmed with {len(rows)} readings of {len(self.sensors)} sensors")
+
+    def window(self, sensor_name, start, end):
+        """Readings of one sensor in [start, end) as (meta, rows), or None if the buffer does not cover it."""
+        with self.lock:
+            ring = self.sensors.get(sensor_name)
+            if ring is None or start < max(self.covered_from, ring.evicted_until):
+                return None
+            return (ring.riverID, ring.river, ring.latlong), ring.window(start, end)
+
+    def invalidate(self, sensor_name, until):
+        """Readings up to `until` were stored behind the buffer's back (bulk upload): stop serving windows
+        that start before it, the database has them."""
+        with self.lock:
+            ring = self.sensors.get(sensor_name)
+            if ring is not None:
+                ring.evicted_until = max(ring.evicted_until, until)
+
+    def stats(self):
+        with self.lock:
+            return {'covered_from': epoch_to_text(self.covered_from) if np.isfinite(self.covered_from) else None,
+                    'sensors': len(self.sensors),
+                    'readings': sum(ring.size for ring in self.sensors.values())}
+
+
+def send_json(conn, message):
+    conn.send_bytes(json.dumps(message).encode('utf-8'))
+
+
+def recv_json(conn):
+    return json.loads(conn.recv_bytes(MAX_MESSAGE_BYTES))
+
+
+def request_ingest(address, authkey, message):
+    """Send one request to the ingest process and return its answer; raises if it cannot be reached."""
+    if authkey == TEMPLATE_AUTHKEY:
+        raise ValueError('recent_authkey is still the template value')
+    with ConnectionClient(address, authkey=authkey) as conn:
+        send_json(conn, message)
+        return recv_json(conn)
+
+
+def serve(recent, address, authkey, profile_dir=None):
+    """Answer ['window', sensor, start, end], ['stats'], ['invalidate', sensor, until], ['profile', seconds]
+    and ['sql', sort, limit] requests in a background thread."""
+    if not authkey or authkey == TEMPLATE_AUTHKEY:
+        raise ValueError('set recent_authkey in constant.py to a secret before enabling recent_address')
+    listener = Listener(address, authkey=authkey)
+
+    def handle(conn):
+        with conn:
+            try:
+                while True:
+                    request = recv_json(conn)
+                    if request[0] == 'window':
+                        window = recent.window(*request[1:])
+                        send_json(conn, None if window is None else [list(window[0]), window[1].tolist()])
+                    elif request[0] == 'stats':
+                        send_json(conn, recent.stats())
+                    elif request[0] == 'invalidate':
+                        send_json(conn, recent.invalidate(*request[1:]))
+                    elif request[0] == 'profile' and profile_dir:
+                        send_json(conn, start_window(profile_dir, request[1], 'ingest'))
+                    elif request[0] == 'sql':
+                        send_json(conn, sql_stats(*request[1:]))
+                    else:
+                        send_json(conn, None)
+            except EOFError:
+                pass
+            except Exception as e:
+                logging.error(f"Recent buffer request failed: {e}")
+
+    def accept():
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                logging.error(f"Recent buffer connection refused: {e}")
+                continue
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True, name='recent-buffer').start()
+    logging.debug(f"Recent buffer listening on {address}")
+    return listener
+
+
+def sql_stats(sort, limit):
+    if sort == 'reset':
+        database.STATS.reset()
+        return {'status': 'success'}
+    try:
+        return database.STATS.snapshot(sort, limit)
+    except ValueError as e:
+        return str(e)
+
+
+def fetch_recent(address, authkey, sensor_id, start, end):
+    """SensorData-shaped rows for [start, end) from the ingest process, or None to read the database."""
+    if not address:
+        return None
+    try:
+        answer = request_ingest(address, authkey, ['window', sensor_id, to_epoch(start), to_epoch(end)])
+    except Exception as e:
+        # Ingest not running, restarting or misconfigured: the database still has everything
+        logging.debug(f"Recent buffer unavailable: {e}")
+        return None
+    if answer is None:
+        return None
+
+    (riverID, river, latlong), rows = answer
+    value = lambda x: None if x != x else x  # NaN was NULL in the database
+    return [{'id': int(r[2]), 'SensorID': sensor_id, 'created_at': epoch_to_text(r[0]), 'updated_at': epoch_to_text(r[1]),
+             'riverID': riverID, 'river': river, 'latlong': latlong,
+             'message_counter': None if r[3] != r[3] else int(r[3]),
+             'temperature': value(r[4]), 'percent_dissolved_oxygen': value(r[5]), 'mg_per_l_dissolved_oxygen': value(r[6])}
+            for r in rows]
+
+
+def invalidate_recent(address, authkey, sensor_id, until):
+    """Tell the ingest process that readings of sensor_id up to `until` were stored without it."""
+    if not address:
+        return
+    try:
+        request_ingest(address, authkey, ['invalidate', sensor_id, to_epoch(until)])
+    except Exception as e:
+        logging.debug(f"Recent buffer unavailable: {e}")
+
+
+def profile_ingest(address, authkey, seconds):
+    """Have the ingest process profile itself for `seconds`; None if it cannot be reached."""
+    if not address:
+        return None
+    try:
+        return request_ingest(address, authkey, ['profile', seconds])
+    except Exception as e:
+        logging.debug(f"Ingest process unavailable: {e}")
+        return None
+
+
+def ingest_sql_stats(address, authkey, sort='total', limit=50):
+    """The ingest process's database.STATS snapshot ('reset' clears it), an error message, or None."""
+    if not address:
+        return None
+    try:
+        return request_ingest(address, authkey, ['sql', sort, limit])
+    except Exception as e:
+        logging.debug(f"Ingest process unavailable: {e}")
+        return None
@@ -0,0 +1,206 @@
+# reports.py
+# Headless daily/weekly reports: one chart per sensor, one per river and a summary table,
+# rendered with matplotlib's Agg backend so they run on a server without a display.
+# Charts are drawn from hourly aggregates (SensorData grouped by hour, plus SensorDataRollup
+# for archived months), rendered on a process pool, and skipped when the SHA-256 of their
+# inputs matches the one recorded in the report directory's manifest. Rendering stops
+# being scheduled once the wall-clock budget is spent; whatever is left is reported.
+#
+# $python reports.py --period daily --date 2024-01-15 --format png --budget 600
+
+import argparse
+import csv
+import hashlib
+import json
+import logging
+import os
+import database
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timedelta
+from partitions import query_sources
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+
+# Bump when the chart layout changes so cached reports are redrawn
+REPORT_VERSION = 1
+PERIOD_DAYS = {'daily': 1, 'weekly': 7}
+METRICS = (
+    ('temperature', 'Temperature (°C)'),
+    ('percent_dissolved_oxygen', 'Dissolved Oxygen (%)'),
+    ('mg_per_l_dissolved_oxygen', 'Dissolved Oxygen (mg/L)'),
+)
+
+
+def fetch_hourly(conn, start, end):
+    """Hourly count/avg/min/max per sensor from live data and archived rollups."""
+    aggregates = ', '.join(f'AVG({m}), MIN({m}), MAX({m})' for m, _ in METRICS)
+    rollup = ', '.join(f'avg_{m}, min_{m}, max_{m}' for m, _ in METRICS)
+    # Raw readings from the rolled monthly partitions and the hot window, then the rollups
+    # of compacted months; an hour never straddles two sources
+    rows = query_sources(conn, f'''
+        SELECT SensorID, MAX(riverID), strftime('%Y-%m-%d %H:00:00', created_at) AS hour, COUNT(*), {aggregates}
+        FROM {{table}} WHERE created_at >= ? AND created_at < ?
+        GROUP BY SensorID, hour
+    ''', (start, end), start, end)
+    rows.extend(conn.execute(f'''
+        SELECT SensorID, riverID, hour, readings, {rollup}
+        FROM SensorDataRollup WHERE hour >= ? AND hour < ?
+    ''', (start, end)).fetchall())
+    rows.sort(key=lambda row: (row[0], row[2]))
+
+    sensors = {}
+    for row in rows:
+        entry = sensors.setdefault(row[0], {'SensorID': row[0], 'riverID': row[1], 'hours': []})
+        entry['hours'].append(list(row[2:]))
+    return sensors
+
+
+def content_hash(task):
+    payload = json.dumps({k: v for k, v in task.items() if k != 'output'}, sort_keys=True, default=str)
+    return hashlib.sha256(f"{REPORT_VERSION}:{payload}".encode('utf-8')).hexdigest()
+
+
+def render_chart(task):
+    """Draw one report chart (runs in a worker process). Returns the output path."""
+    fig, axes = plt.subplots(len(METRICS), 1, figsize=(11, 8), sharex=True)
+    for series in task['series']:
+        hours = [datetime.fromisoformat(h[0]) for h in series['hours']]
+        for i, (metric, label) in enumerate(METRICS):
+            avg = [h[2 + 3 * i] for h in series['hours']]
+            low = [h[3 + 3 * i] for h in series['hours']]
+            high = [h[4 + 3 * i] for h in series['hours']]
+            line, = axes[i].plot(hours, avg, label=series['label'], linewidth=1.2)
+            if len(task['series']) == 1:
+                axes[i].fill_between(hours, low, high, color=line.get_color(), alpha=0.2, linewidth=0)
+            axes[i].set_ylabel(label)
+    axes[0].set_title(task['title'])
+    if len(task['series']) > 1:
+        axes[0].legend(loc='upper right', fontsize='small')
+    fig.autofmt_xdate()
+    fig.tight_layout()
+    fig.savefig(task['output'])
+    plt.close(fig)
+    return task['output']
+
+
+def write_summary(path, sensors):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['SensorID', 'riverID', 'readings'] +
+                        [f'{stat}_{m}' for m, _ in METRICS for stat in ('min', 'avg', 'max')])
+        for sensor in sorted(sensors.values(), key=lambda s: str(s['SensorID'])):
+            hours = sensor['hours']
+            readings = sum(h[1] for h in hours)
+            stats = []
+            for i in range(len(METRICS)):
+                avg_values = [(h[2 + 3 * i], h[1]) for h in hours if h[2 + 3 * i] is not None]
+                mins = [h[3 + 3 * i] for h in hours if h[3 + 3 * i] is not None]
+                maxs = [h[4 + 3 * i] for h in hours if h[4 + 3 * i] is not None]
+                weight = sum(n for _, n in avg_values)
+                stats += [round(min(mins), 3) if mins else '',
+                          round(sum(v * n for v, n in avg_values) / weight, 3) if weight else '',
+                          round(max(maxs), 3) if maxs else '']
+            writer.writerow([sensor['SensorID'], sensor['riverID'], readings] + stats)
+
+
+def build_tasks(sensors, out_dir, fmt, label):
+    tasks = []
+    for sensor in sensors.values():
+        tasks.append({
+            'title': f"Sensor {sensor['SensorID']} - {label}",
+            'series': [{'label': str(sensor['SensorID']), 'hours': sensor['hours']}],
+            'output': os.path.join(out_dir, f"sensor_{sensor['SensorID']}.{fmt}"),
+        })
+    rivers = {}
+    for sensor in sensors.values():
+        rivers.setdefault(sensor['riverID'], []).append(sensor)
+    for riverID, members in rivers.items():
+        tasks.append({
+            'title': f"River {riverID} - {label}",
+            'series': [{'label': str(s['SensorID']), 'hours': s['hours']}
+                       for s in sorted(members, key=lambda s: str(s['SensorID']))],
+            'output': os.path.join(out_dir, f"river_{riverID}.{fmt}"),
+        })
+    return tasks
+
+
+def generate_reports(db_path, report_root, period, day, fmt='png', budget_seconds=None, workers=None):
+    """Render one period's reports; returns counts of rendered, cached and skipped charts."""
+    deadline = time.monotonic() + budget_seconds if budget_seconds else None
+    end = datetime.strptime(day, '%Y-%m-%d') + timedelta(days=1)
+    start = end - timedelta(days=PERIOD_DAYS[period])
+    label = f"{period} report {start:%Y-%m-%d}" + (f" to {end - timedelta(days=1):%Y-%m-%d}" if period != 'daily' else '')
+
+    conn = database.connect(db_path)
+    try:
+        sensors = fetch_hourly(conn, start.strftime('%Y-%m-%d %H:%M:%S'), end.strftime('%Y-%m-%d %H:%M:%S'))
+    finally:
+        conn.close()
+
+    out_dir = os.path.join(report_root, period, day)
+    os.makedirs(out_dir, exist_ok=True)
+    write_summary(os.path.join(out_dir, 'summary.csv'), sensors)
+
+    manifest_path = os.path.join(out_dir, 'manifest.json')
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+
+    todo, cached = [], 0
+    for task in build_tasks(sensors, out_dir, fmt, label):
+        digest = content_hash(task)
+        name = os.path.basename(task['output'])
+        if manifest.get(name) == digest and os.path.exists(task['output']):
+            cached += 1
+        else:
+            todo.append((name, digest, task))
+
+    rendered, failed = 0, 0
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        # Only a couple of charts per worker are queued at a time, so once the budget is
+        # spent nothing new starts; charts already drawing are allowed to finish
+        while todo or pending:
+            while todo and len(pending) < 2 * workers and (deadline is None or time.monotonic() < deadline):
+                name, digest, task = todo.pop(0)
+                pending[pool.submit(render_chart, task)] = (name, digest)
+            if not pending:
+                break
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, digest = pending.pop(future)
+                try:
+                    future.result()
+                    manifest[name] = digest
+                    rendered += 1
+                except Exception as e:
+                    logging.error(f"Error rendering {name}: {e}")
+                    failed += 1
+    skipped = len(todo)
+
+    with open(manifest_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+
+    logging.info(f"{period} {day}: {rendered} rendered, {cached} unchanged, {failed} failed, {skipped} over budget")
+    return {'rendered': rendered, 'cached': cached, 'failed': failed, 'skipped': skipped}
+
+
+if __name__ == '__main__':
+    from constant import database_file, report_dir
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Render daily/weekly sensor and river reports')
+    parser.add_argument('--period', choices=sorted(PERIOD_DAYS), default='daily')
+    parser.add_argument('--date', default=(datetime.utcnow() - timedelta(days=1)).strftime('%Y-%m-%d'),
+                        help='last day covered by the report (default: yesterday)')
+    parser.add_argument('--format', choices=['png', 'svg'], default='png')
+    parser.add_argument('--budget', type=float, default=None, help='wall-clock budget in seconds')
+    parser.add_argument('--workers', type=int, default=None)
+    args = parser.parse_args()
+
+    print(generate_reports(database_file, report_dir, args.period, args.date, args.format, args.budget, args.workers))
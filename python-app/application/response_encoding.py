@@ -0,0 +1,119 @@
+# response_encoding.py
+# Smaller responses for the history routes: negotiated gzip/brotli compression
+# and an optional columnar "compact" JSON layout for SensorData rows.
+
+import gzip
+import logging
+from datetime import datetime, timezone
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, gzip is always available
+    brotli = None
+
+# Responses smaller than this are sent as they are; compressing them costs more than it saves
+COMPRESS_MIN_BYTES = 1024
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/geo+json', 'text/html', 'text/css', 'text/javascript', 'application/javascript')
+
+# Decimal places the sensors actually report; anything beyond is noise on the wire
+SENSOR_PRECISION = {
+    'temperature': 2,
+    'percent_dissolved_oxygen': 1,
+    'mg_per_l_dissolved_oxygen': 2,
+}
+
+
+def accepted_encoding(accept_encoding):
+    """Pick 'br' or 'gzip' from an Accept-Encoding header, or None."""
+    offered = {}
+    for part in accept_encoding.split(','):
+        name, _, params = part.strip().partition(';')
+        q = 1.0
+        if params.strip().startswith('q='):
+            try:
+                q = float(params.strip()[2:])
+            except ValueError:
+                q = 0.0
+        offered[name.strip().lower()] = q
+    if brotli is not None and offered.get('br', 0) > 0:
+        return 'br'
+    if offered.get('gzip', 0) > 0:
+        return 'gzip'
+    return None
+
+
+def compress_response(response):
+    """after_request hook: compress large text/JSON bodies for clients that accept it."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    body = response.get_data()
+    if len(body) < COMPRESS_MIN_BYTES:
+        return response
+
+    encoding = accepted_encoding(request.headers.get('Accept-Encoding', ''))
+    if encoding == 'br':
+        compressed = brotli.compress(body, quality=5)
+    elif encoding == 'gzip':
+        compressed = gzip.compress(body, compresslevel=6)
+    else:
+        return response
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    logging.debug(f"Compressed {request.path} with {encoding}: {len(body)} -> {len(compressed)} bytes")
+    return response
+
+
+def init_compression(app):
+    app.after_request(compress_response)
+
+
+def to_epoch_seconds(timestamp):
+    """SQLite TIMESTAMP text (stored as UTC) to integer epoch seconds."""
+    if isinstance(timestamp, datetime):
+        dt = timestamp
+    else:
+        dt = datetime.fromisoformat(str(timestamp))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
+
+
+def compact_rows(rows):
+    """Encode a list of SensorData dicts column by column.
+
+    Columns whose value never changes (SensorID, river, latlong for one sensor)
+    are sent once under 'constants'. Readings are rounded to SENSOR_PRECISION and
+    created_at becomes epoch seconds: the first value, then deltas from the previous row.
+    """
+    if not rows:
+        return {'format': 'compact', 'count': 0, 'constants': {}, 'columns': {}}
+
+    columns = {}
+    constants = {}
+    for name in rows[0].keys():
+        values = [row[name] for row in rows]
+        if name in ('created_at', 'updated_at'):
+            epochs = [to_epoch_seconds(v) for v in values]
+            columns[name] = [epochs[0]] + [b - a for a, b in zip(epochs, epochs[1:])]
+            continue
+        if name in SENSOR_PRECISION:
+            digits = SENSOR_PRECISION[name]
+            values = [round(v, digits) if v is not None else None for v in values]
+        if all(v == values[0] for v in values):
+            constants[name] = values[0]
+        else:
+            columns[name] = values
+
+    return {
+        'format': 'compact',
+        'count': len(rows),
+        'time_encoding': 'epoch-delta',
+        'constants': constants,
+        'columns': columns,
+    }
@@ -0,0 +1,220 @@
+# river_analytics.py
+# Upstream/downstream lag between sensors on the same river.
+# Each river's sensors are aligned onto one grid (alignment.py), cut into sliding windows,
+# and every pair is cross-correlated through the FFT: c = irfft(F_b * conj(F_a)).
+# The peak within +-max_lag gives the propagation lag (positive = b sees changes after a,
+# i.e. b is downstream). A window is flagged divergent when the pair stops moving together
+# (peak correlation below DIVERGENCE_CORRELATION) or their offset jumps away from its usual
+# level - the signature of something happening between the two sensors.
+#
+# Spectra are computed once per sensor and window and shared by all of its pairs; spectra of
+# closed windows are cached in memory for later requests.
+#
+# $python river_analytics.py --from 2024-01-01 --to 2024-02-01   (all rivers, process pool)
+
+import argparse
+import logging
+import database
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+import numpy as np
+from alignment import align, epoch_to_text
+
+DIVERGENCE_CORRELATION = 0.5
+OFFSET_MAD_LIMIT = 4.0
+MIN_VALID_FRACTION = 0.8
+SPECTRUM_CACHE_SIZE = 50000
+
+_spectrum_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def create_river_lag_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS riverPairLag (
+                    riverID INTEGER NOT NULL,
+                    sensor_a TEXT NOT NULL,
+                    sensor_b TEXT NOT NULL,
+                    metric TEXT NOT NULL,
+                    window_start TIMESTAMP NOT NULL,
+                    lag_seconds INTEGER,
+                    correlation REAL,
+                    offset REAL,
+                    divergent INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (riverID, sensor_a, sensor_b, metric, window_start)
+                )''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_riverpairlag_divergent ON riverPairLag(divergent, window_start)')
+
+
+def window_spectra(sensor, metric, series, offsets, window_starts, window, nfft, step, cacheable):
+    """rfft of each normalised window of one sensor's aligned series.
+
+    Returns (spectra, means, valid); windows with too many gaps or no variation are not valid.
+    Closed windows are served from, and added to, the spectrum cache.
+    """
+    spectra = np.zeros((len(offsets), nfft // 2 + 1), dtype=complex)
+    means = np.full(len(offsets), np.nan)
+    valid = np.zeros(len(offsets), dtype=bool)
+
+    todo = []
+    with _cache_lock:
+        for k in range(len(offsets)):
+            key = (sensor, metric, int(window_starts[k]), window, step, nfft)
+            hit = _spectrum_cache.get(key) if cacheable[k] else None
+            if hit is None:
+                todo.append(k)
+            else:
+                _spectrum_cache.move_to_end(key)
+                spectra[k], means[k], valid[k] = hit
+    if not todo:
+        return spectra, means, valid
+
+    todo = np.array(todo)
+    segments = np.lib.stride_tricks.sliding_window_view(series, window)[offsets[todo]]
+    present = ~np.isnan(segments)
+    enough = present.mean(axis=1) >= MIN_VALID_FRACTION
+    counts = present.sum(axis=1)
+    seg_means = np.where(counts > 0, np.where(present, segments, 0).sum(axis=1) / np.maximum(counts, 1), np.nan)
+    # Gaps are filled with the window mean, which adds nothing to the correlation
+    centred = np.where(present, segments - seg_means[:, None], 0.0)
+    std = centred.std(axis=1)
+    usable = enough & (std > 0)
+    normalised = centred / np.where(usable, std, 1)[:, None]
+    normalised[~usable] = 0.0
+    computed = np.fft.rfft(normalised, n=nfft, axis=1)
+
+    spectra[todo] = computed
+    means[todo] = seg_means
+    valid[todo] = usable
+    with _cache_lock:
+        for row, k in enumerate(todo):
+            if cacheable[k]:
+                key = (sensor, metric, int(window_starts[k]), window, step, nfft)
+                _spectrum_cache[key] = (computed[row], seg_means[row], usable[row])
+        while len(_spectrum_cache) > SPECTRUM_CACHE_SIZE:
+            _spectrum_cache.popitem(last=False)
+    return spectra, means, valid
+
+
+def analyse_river(db_path, riverID, sensor_ids, metric, start, end, step=900,
+                  window_hours=24, hop_hours=6, max_lag_hours=6, on_connect=None):
+    """Lag, correlation and divergence per sensor pair and window for one river.
+
+    on_connect(conn) lets the caller set up the connection the readings are read with,
+    e.g. the API's query time budget.
+    """
+    conn = database.connect(db_path)
+    try:
+        if on_connect is not None:
+            on_connect(conn)
+        grid, matrix = align(conn, sensor_ids, [metric], start, end, step, 'linear')
+    finally:
+        conn.close()
+
+    window = int(window_hours * 3600 // step)
+    hop = max(1, int(hop_hours * 3600 // step))
+    max_lag = min(int(max_lag_hours * 3600 // step), window - 1)
+    if len(grid) < window or len(sensor_ids) < 2:
+        return {'riverID': riverID, 'metric': metric, 'pairs': []}
+
+    nfft = 1 << int(np.ceil(np.log2(2 * window)))
+    offsets = np.arange(0, len(grid) - window + 1, hop)
+    window_starts = grid[offsets]
+    now = int(datetime.now(timezone.utc).timestamp())
+    cacheable = window_starts + window * step < now - 2 * 3600
+
+    spectra, means, valid = [], [], []
+    for i, sensor in enumerate(sensor_ids):
+        s, m, v = window_spectra(sensor, metric, matrix[:, i], offsets, window_starts,
+                                 window, nfft, step, cacheable)
+        spectra.append(s)
+        means.append(m)
+        valid.append(v)
+
+    lag_index = np.concatenate([np.arange(0, max_lag + 1), np.arange(nfft - max_lag, nfft)])
+    lag_steps = np.concatenate([np.arange(0, max_lag + 1), np.arange(-max_lag, 0)])
+    starts_text = [t.replace('T', ' ') for t in epoch_to_text(window_starts).tolist()]
+
+    pairs = []
+    for a in range(len(sensor_ids)):
+        for b in range(a + 1, len(sensor_ids)):
+            both = valid[a] & valid[b]
+            corr = np.fft.irfft(spectra[b] * np.conj(spectra[a]), n=nfft, axis=1)[:, lag_index] / window
+            peak = np.argmax(corr, axis=1)
+            peak_corr = corr[np.arange(len(peak)), peak]
+            lags = lag_steps[peak] * step
+
+            offset = means[b] - means[a]
+            typical = np.nanmedian(offset[both]) if both.any() else np.nan
+            mad = np.nanmedian(np.abs(offset[both] - typical)) if both.any() else np.nan
+            offset_jump = np.abs(offset - typical) > OFFSET_MAD_LIMIT * max(mad, 1e-9)
+            divergent = both & ((peak_corr < DIVERGENCE_CORRELATION) | offset_jump)
+
+            windows = [
+                {'window_start': starts_text[k], 'lag_seconds': int(lags[k]),
+                 'correlation': round(float(peak_corr[k]), 4), 'offset': round(float(offset[k]), 4),
+                 'divergent': bool(divergent[k])}
+                for k in range(len(window_starts)) if both[k]
+            ]
+            pairs.append({
+                'sensor_a': sensor_ids[a],
+                'sensor_b': sensor_ids[b],
+                'lag_seconds': int(np.median(lags[both])) if both.any() else None,
+                'correlation': round(float(np.median(peak_corr[both])), 4) if both.any() else None,
+                'divergent_windows': int(divergent.sum()),
+                'windows': windows,
+            })
+    return {'riverID': riverID, 'metric': metric, 'pairs': pairs}
+
+
+def store_results(conn, result):
+    for pair in result['pairs']:
+        conn.executemany('''INSERT OR REPLACE INTO riverPairLag
+                            (riverID, sensor_a, sensor_b, metric, window_start, lag_seconds, correlation, offset, divergent)
+                            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+                         [(result['riverID'], pair['sensor_a'], pair['sensor_b'], result['metric'], w['window_start'],
+                           w['lag_seconds'], w['correlation'], w['offset'], int(w['divergent']))
+                          for w in pair['windows']])
+
+
+def analyse_fleet(db_path, start, end, metrics=('percent_dissolved_oxygen', 'temperature'), workers=None, **options):
+    """Analyse every river with two or more active sensors on a process pool and store the results."""
+    conn = database.connect(db_path)
+    rivers = {}
+    for riverID, sensorName in conn.execute(
+            "SELECT riverID, sensorName FROM sensorInfo WHERE status = 'active' ORDER BY riverID, sensorName"):
+        rivers.setdefault(riverID, []).append(sensorName)
+    tasks = [(riverID, sensors, metric) for riverID, sensors in rivers.items() if len(sensors) > 1
+             for metric in metrics]
+
+    create_river_lag_table(conn.cursor())
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(analyse_river, db_path, riverID, sensors, metric, start, end, **options)
+                   for riverID, sensors, metric in tasks]
+        for future in futures:
+            result = future.result()
+            store_results(conn, result)
+            flagged = sum(p['divergent_windows'] for p in result['pairs'])
+            logging.info(f"River {result['riverID']} {result['metric']}: {len(result['pairs'])} pairs, "
+                         f"{flagged} divergent windows")
+    conn.commit()
+    conn.close()
+    return len(tasks)
+
+
+if __name__ == '__main__':
+    from constant import database_file
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Cross-correlation lag analysis for all rivers')
+    parser.add_argument('--from', dest='start', required=True)
+    parser.add_argument('--to', dest='end', default=datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S'))
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--window-hours', type=float, default=24)
+    parser.add_argument('--max-lag-hours', type=float, default=6)
+    args = parser.parse_args()
+
+    count = analyse_fleet(database_file, args.start, args.end, workers=args.workers,
+                          window_hours=args.window_hours, max_lag_hours=args.max_lag_hours)
+    print(f"Analysed {count} river/metric combinations")
@@ -0,0 +1,183 @@
+# river_geometry.py
+# River outlines stored once per riverData.riverID and served simplified for the map zoom.
+# Douglas-Peucker with a tolerance of about one screen pixel at the requested zoom,
+# coordinates rounded to the precision that zoom can show, and the encoded result
+# cached in memory under an ETag derived from the stored geometry.
+#
+# $python river_geometry.py load <riverID> static/demo.js   (import an overpass-turbo export)
+
+import hashlib
+import json
+import logging
+import math
+import database
+import threading
+
+MIN_ZOOM = 0
+MAX_ZOOM = 18
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def create_river_geometry_table(cursor):
+    cursor.execute('''CREATE TABLE IF NOT EXISTS riverGeometry (
+                    riverID INTEGER PRIMARY KEY,
+                    geojson TEXT NOT NULL,
+                    etag TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (riverID) REFERENCES riverData(riverID)
+                )''')
+
+
+def store_geometry(conn, riverID, geojson):
+    """Save a river's GeoJSON (FeatureCollection, Feature or bare geometry)."""
+    text = json.dumps(geojson, separators=(',', ':'))
+    etag = hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+    conn.execute('''INSERT INTO riverGeometry (riverID, geojson, etag, updated_at)
+                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                    ON CONFLICT(riverID) DO UPDATE SET geojson = excluded.geojson,
+                        etag = excluded.etag, updated_at = excluded.updated_at''',
+                 (riverID, text, etag))
+    return etag
+
+
+def tolerance_for_zoom(zoom):
+    """Degrees covered by one 256px-tile pixel at this zoom level."""
+    return 360.0 / (256 * 2 ** zoom)
+
+
+def simplify_line(points, tolerance):
+    """Douglas-Peucker on a list of [lon, lat] points (iterative, keeps both ends)."""
+    if len(points) < 3:
+        return points
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    tolerance_sq = tolerance * tolerance
+    while stack:
+        first, last = stack.pop()
+        x1, y1 = points[first][0], points[first][1]
+        x2, y2 = points[last][0], points[last][1]
+        dx, dy = x2 - x1, y2 - y1
+        length_sq = dx * dx + dy * dy
+        max_dist_sq, index = 0.0, first
+        for i in range(first + 1, last):
+            px, py = points[i][0], points[i][1]
+            if length_sq == 0:
+                dist_sq = (px - x1) ** 2 + (py - y1) ** 2
+            else:
+                cross = dx * (py - y1) - dy * (px - x1)
+                dist_sq = cross * cross / length_sq
+            if dist_sq > max_dist_sq:
+                max_dist_sq, index = dist_sq, i
+        if max_dist_sq > tolerance_sq:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [p for p, k in zip(points, keep) if k]
+
+
+def quantize_line(points, digits):
+    """Round coordinates and drop points that collapse onto their predecessor."""
+    out = []
+    for p in points:
+        q = [round(p[0], digits), round(p[1], digits)]
+        if not out or out[-1] != q:
+            out.append(q)
+    return out
+
+
+def simplify_geometry(geometry, tolerance, digits):
+    kind = geometry.get('type')
+    coords = geometry.get('coordinates')
+
+    def line(points, min_points=2):
+        simplified = quantize_line(simplify_line(points, tolerance), digits)
+        return simplified if len(simplified) >= min_points else None
+
+    if kind == 'LineString':
+        coords = line(coords)
+    elif kind == 'MultiLineString':
+        coords = [l for l in (line(part) for part in coords) if l]
+    elif kind == 'Polygon':
+        coords = [r for r in (line(ring, 4) for ring in coords) if r]
+    elif kind == 'MultiPolygon':
+        coords = [p for p in ([r for r in (line(ring, 4) for ring in poly) if r] for poly in coords) if p]
+    elif kind == 'Point':
+        coords = [round(coords[0], digits), round(coords[1], digits)]
+    elif kind == 'GeometryCollection':
+        parts = [simplify_geometry(g, tolerance, digits) for g in geometry['geometries']]
+        return {'type': kind, 'geometries': [g for g in parts if g]}
+    else:
+        return geometry
+    if not coords:
+        return None
+    return {'type': kind, 'coordinates': coords}
+
+
+def simplify_geojson(geojson, zoom):
+    tolerance = tolerance_for_zoom(zoom)
+    # Enough decimals to resolve a tenth of a pixel, never more than OSM's 7
+    digits = max(1, min(7, math.ceil(-math.log10(tolerance / 10))))
+
+    if geojson.get('type') == 'FeatureCollection':
+        features = []
+        for feature in geojson['features']:
+            geometry = simplify_geometry(feature['geometry'], tolerance, digits) if feature.get('geometry') else None
+            if geometry:
+                features.append({'type': 'Feature', 'properties': feature.get('properties', {}), 'geometry': geometry})
+        return {'type': 'FeatureCollection', 'features': features}
+    if geojson.get('type') == 'Feature':
+        return dict(geojson, geometry=simplify_geometry(geojson['geometry'], tolerance, digits))
+    return simplify_geometry(geojson, tolerance, digits)
+
+
+def clamp_zoom(zoom):
+    return max(MIN_ZOOM, min(MAX_ZOOM, int(zoom)))
+
+
+def get_encoded_geometry(conn, riverID, zoom):
+    """(etag, encoded JSON bytes) for a river at a zoom level, or None if no geometry is stored."""
+    zoom = clamp_zoom(zoom)
+    row = conn.execute('SELECT etag FROM riverGeometry WHERE riverID = ?', (riverID,)).fetchone()
+    if row is None:
+        return None
+    etag = f"{row[0]}-z{zoom}"
+
+    with _cache_lock:
+        cached = _cache.get((riverID, zoom))
+    if cached and cached[0] == etag:
+        return cached
+
+    source = conn.execute('SELECT geojson FROM riverGeometry WHERE riverID = ?', (riverID,)).fetchone()[0]
+    encoded = json.dumps(simplify_geojson(json.loads(source), zoom), separators=(',', ':')).encode('utf-8')
+    logging.debug(f"River {riverID} geometry at zoom {zoom}: {len(source)} -> {len(encoded)} bytes")
+
+    with _cache_lock:
+        _cache[(riverID, zoom)] = (etag, encoded)
+    return etag, encoded
+
+
+def load_overpass_export(path):
+    """Read a GeoJSON file, including the `var name = {...}` JavaScript wrappers in static/."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    return json.loads(text[text.index('{'):text.rindex('}') + 1])
+
+
+if __name__ == '__main__':
+    import sys
+    from constant import database_file
+
+    logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+    if len(sys.argv) != 4 or sys.argv[1] != 'load':
+        print("usage: python river_geometry.py load <riverID> <geojson or .js file>")
+        sys.exit(1)
+
+    conn = database.connect(database_file)
+    create_river_geometry_table(conn.cursor())
+    etag = store_geometry(conn, int(sys.argv[2]), load_overpass_export(sys.argv[3]))
+    conn.commit()
+    conn.close()
+    print(f"Stored geometry for river {sys.argv[2]} (etag {etag})")
@@ -0,0 +1,139 @@
+# search.py
+# Search over river names, sensor names and locations with an SQLite FTS5 trigram index.
+# Every 3-character slice of a name is indexed, so any substring of 3+ characters (which
+# includes every prefix) is an index lookup. Typos are handled by matching on any of the
+# query's trigrams and ranking the candidates by how closely they match: "tems" still
+# finds "Thames" through "ems". Shorter queries fall back to a prefix LIKE.
+#
+# The index is updated by the river and sensor submit/update routes (index_river,
+# index_sensor); `python search.py rebuild` recreates it from riverData and sensorInfo.
+
+import argparse
+import logging
+import database
+from difflib import SequenceMatcher
+
+MIN_SCORE = 0.6
+CANDIDATES_PER_RESULT = 10
+KINDS = ('river', 'sensor')
+
+
+def create_search_index(cursor):
+    """searchIndex FTS5 table; filled from riverData and sensorInfo when first created."""
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'searchIndex'").fetchone()
+    cursor.execute('''CREATE VIRTUAL TABLE IF NOT EXISTS searchIndex USING fts5(
+                    kind UNINDEXED,
+                    ref UNINDEXED,
+                    riverID UNINDEXED,
+                    name,
+                    location,
+                    tokenize = 'trigram'
+                )''')
+    if not exists:
+        rebuild_search_index(cursor)
+
+
+def rebuild_search_index(cursor):
+    cursor.execute('DELETE FROM searchIndex')
+    cursor.execute('''INSERT INTO searchIndex (kind, ref, riverID, name, location)
+                      SELECT 'river', riverID, riverID, riverName, location FROM riverData''')
+    cursor.execute('''INSERT INTO searchIndex (kind, ref, riverID, name, location)
+                      SELECT 'sensor', sensorID, riverID, sensorName, location FROM sensorInfo''')
+    logging.debug('Rebuilt search index')
+
+
+def index_river(cursor, riverID):
+    cursor.execute("DELETE FROM searchIndex WHERE kind = 'river' AND ref = ?", (riverID,))
+    cursor.execute('''INSERT INTO searchIndex (kind, ref, riverID, name, location)
+                      SELECT 'river', riverID, riverID, riverName, location FROM riverData WHERE riverID = ?''',
+                   (riverID,))
+
+
+def index_sensor(cursor, sensorID):
+    cursor.execute("DELETE FROM searchIndex WHERE kind = 'sensor' AND ref = ?", (sensorID,))
+    cursor.execute('''INSERT INTO searchIndex (kind, ref, riverID, name, location)
+                      SELECT 'sensor', sensorID, riverID, sensorName, location FROM sensorInfo WHERE sensorID = ?''',
+                   (sensorID,))
+
+
+def trigram_query(text):
+    """FTS5 query matching any trigram of text."""
+    grams = {text[i:i + 3] for i in range(len(text) - 2)}
+    return ' OR '.join('"' + g.replace('"', '""') + '"' for g in sorted(grams))
+
+
+def term_score(term, value, starts):
+    """1.0 for a word prefix, slightly less for a substring, otherwise the best fuzzy match of any word."""
+    if any(value.startswith(term, i) for i in starts):
+        return 1.0
+    if term in value:
+        return 0.95
+    # Compare against the same length (plus one, for a dropped letter) from each word start
+    return max(SequenceMatcher(None, term, value[i:i + len(term) + 1]).ratio() for i in starts)
+
+
+def match_score(query, value):
+    """Mean of the query words' best matches, or the whole query when it is a prefix of value."""
+    value = (value or '').lower()
+    if value.startswith(query):
+        return 1.0
+    starts = [0] + [i + 1 for i, c in enumerate(value) if not c.isalnum()]
+    terms = query.split()
+    return sum(term_score(term, value, starts) for term in terms) / len(terms)
+
+
+def search(conn, text, kind=None, riverID=None, limit=20):
+    """Rivers and sensors whose name or location matches text, best matches first."""
+    query = ' '.join(text.lower().split())
+    if not query:
+        return []
+    filters, params = '', []
+    if kind:
+        if kind not in KINDS:
+            raise ValueError(f"kind must be one of {KINDS}")
+        filters += ' AND kind = ?'
+        params.append(kind)
+    if riverID is not None:
+        filters += ' AND riverID = ?'
+        params.append(riverID)
+
+    if len(query) >= 3:
+        rows = conn.execute(f'''SELECT kind, ref, riverID, name, location FROM searchIndex
+                                WHERE searchIndex MATCH ?{filters} ORDER BY rank LIMIT ?''',
+                            (trigram_query(query), *params, limit * CANDIDATES_PER_RESULT)).fetchall()
+    else:
+        rows = conn.execute(f'''SELECT kind, ref, riverID, name, location FROM searchIndex
+                                WHERE (name LIKE ? OR location LIKE ?){filters} LIMIT ?''',
+                            (query + '%', query + '%', *params, limit * CANDIDATES_PER_RESULT)).fetchall()
+
+    results = []
+    for kind_, ref, river, name, location in rows:
+        name_score, location_score = match_score(query, name), match_score(query, location)
+        score = max(name_score, location_score * 0.9)
+        if score >= MIN_SCORE:
+            results.append({'kind': kind_, 'id': int(ref), 'riverID': river, 'name': name,
+                            'location': location, 'score': round(score, 3)})
+    results.sort(key=lambda r: (-r['score'], r['name'] or ''))
+    return results[:limit]
+
+
+if __name__ == '__main__':
+    from constant import database_file
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='River/sensor search index')
+    sub = parser.add_subparsers(dest='command', required=True)
+    sub.add_parser('rebuild', help='recreate the index from riverData and sensorInfo')
+    find = sub.add_parser('find', help='run a search')
+    find.add_argument('text')
+    args = parser.parse_args()
+
+    conn = database.connect(database_file)
+    if args.command == 'rebuild':
+        create_search_index(conn.cursor())
+        rebuild_search_index(conn.cursor())
+        conn.commit()
+    else:
+        for result in search(conn, args.text):
+            print(result)
+    conn.close()
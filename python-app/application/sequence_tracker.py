@@ -0,0 +1,130 @@
+# sequence_tracker.py
+# Per-sensor message_counter tracking for the MQTT ingest.
+# Each sensor keeps its highest counter, the sensor time of that reading and a bitmap of
+# the REORDER_WINDOW counters below it, so a broker redelivery is recognised in O(1) and
+# dropped before touching the database. Counter jumps are recorded as gaps. A counter at
+# or below the highest one but with a later sensor time means the sensor restarted (or its
+# counter wrapped) and starts a new sequence; so does a counter far below the window.
+#
+# check() only classifies; record() marks the counter as seen and is called once the
+# reading is committed, so a reading whose insert failed is accepted when redelivered.
+# The unique (SensorID, created_at, message_counter) index remains the guarantee.
+
+import logging
+import threading
+
+REORDER_WINDOW = 256
+WINDOW_MASK = (1 << REORDER_WINDOW) - 1
+
+NEW = 'new'
+LATE = 'late'
+DUPLICATE = 'duplicate'
+RESET = 'reset'
+
+
+class SensorSequence:
+    __slots__ = ('high', 'high_time', 'seen', 'received', 'duplicates', 'late', 'gaps', 'missing', 'resets')
+
+    def __init__(self, counter, created_at):
+        self.high = counter
+        self.high_time = created_at
+        self.seen = 1  # bit i set = counter (high - i) already received
+        self.received = 1
+        self.duplicates = 0
+        self.late = 0
+        self.gaps = 0
+        self.missing = 0
+        self.resets = 0
+
+    def classify(self, counter, created_at):
+        if counter > self.high:
+            return NEW
+        if created_at is not None and self.high_time is not None and created_at > self.high_time:
+            return RESET
+        offset = self.high - counter
+        if offset < REORDER_WINDOW:
+            return DUPLICATE if self.seen & (1 << offset) else LATE
+        return RESET
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+def sensor_time(created_at):
+    """created_at as comparable text ('YYYY-MM-DD HH:MM:SS'), or None when the sensor sent no usable time."""
+    return None if created_at is None else str(created_at)
+
+
+class SequenceTracker:
+    def __init__(self):
+        self.sensors = {}
+        self.lock = threading.Lock()
+
+    def check(self, sensor_name, counter, created_at=None):
+        """Classify a reading as NEW, LATE (out of order, first time seen), DUPLICATE or RESET.
+
+        created_at is the sensor's own time of the reading (None if unknown).
+        """
+        with self.lock:
+            seq = self.sensors.get(sensor_name)
+            if seq is None:
+                return NEW
+            result = seq.classify(counter, sensor_time(created_at))
+            if result == DUPLICATE:
+                seq.duplicates += 1
+            return result
+
+    def record(self, sensor_name, counter, created_at=None):
+        """Mark a reading as stored; call after its commit."""
+        created_at = sensor_time(created_at)
+        with self.lock:
+            seq = self.sensors.get(sensor_name)
+            if seq is None:
+                self.sensors[sensor_name] = SensorSequence(counter, created_at)
+                return
+            result = seq.classify(counter, created_at)
+
+            if result == NEW:
+                jump = counter - seq.high
+                if jump > 1:
+                    seq.gaps += 1
+                    seq.missing += jump - 1
+                    logging.debug(f"Sensor {sensor_name}: counter jumped {seq.high} -> {counter}, {jump - 1} missing")
+                seq.seen = ((seq.seen << jump) | 1) & WINDOW_MASK if jump < REORDER_WINDOW else 1
+                seq.high = counter
+                seq.high_time = created_at
+                seq.received += 1
+            elif result == LATE:
+                seq.seen |= 1 << (seq.high - counter)
+                seq.received += 1
+                seq.late += 1
+                if seq.missing:
+                    seq.missing -= 1
+            elif result == RESET:
+                seq.resets += 1
+                logging.debug(f"Sensor {sensor_name}: counter reset {seq.high} -> {counter}")
+                seq.high = counter
+                seq.high_time = created_at
+                seq.seen = 1
+                seq.received += 1
+
+    def stats(self):
+        with self.lock:
+            return {name: seq.as_dict() for name, seq in self.sensors.items()}
+
+
+def create_unique_reading_index(cursor):
+    """Make (SensorID, created_at, message_counter) unique so replayed readings are ignored.
+
+    Existing duplicates are removed first (the earliest copy is kept), otherwise the index
+    cannot be created.
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_sensordata_unique_reading'").fetchone()
+    if exists:
+        return
+    cursor.execute('''DELETE FROM SensorData WHERE id NOT IN (
+                          SELECT MIN(id) FROM SensorData GROUP BY SensorID, created_at, message_counter)''')
+    if cursor.rowcount:
+        logging.debug(f"Removed {cursor.rowcount} duplicate SensorData rows")
+    cursor.execute('''CREATE UNIQUE INDEX idx_sensordata_unique_reading
+                      ON SensorData(SensorID, created_at, message_counter)''')
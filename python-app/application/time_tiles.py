@@ -0,0 +1,328 @@
+# time_tiles.py
+# Historical chart data as tiles, addressed like map tiles by (sensor, metric, level, index)
+# so a chart zooms and pans through years of readings without re-querying them.
+#
+# A level fixes the bucket width (LEVEL_BUCKET_SECONDS, 5 minutes to a week); a tile is
+# TILE_BUCKETS consecutive buckets, tile `index` starting at index * tile_seconds(level)
+# Unix seconds. Each bucket holds count/avg/min/max of one metric, from SensorData (all
+# partitions) plus SensorDataRollup for archived months (an hourly rollup counts in the
+# bucket its hour starts in). A tile of level z is exactly LEVEL_RATIO children of level
+# z - 1, so the open tile - the one still receiving readings - is merged from its finished
+# children and only its newest level 0 tile is read from SensorData.
+#
+# A tile is finished once it ended more than SETTLE_SECONDS ago. Finished tiles are
+# computed once and stored under tile_dir/<sensor>/g<generation>/<metric>/<level>/<index>.json;
+# the API serves them with an immutable Cache-Control when the URL names the sensor's
+# current generation. Writers that store readings older than that (gateway catch-up
+# batches, /bulk_ingest, import_archive.py) call note_history_change(), which bumps the
+# generation in tileGeneration: new URLs, a new cache directory, the old one removed.
+#
+# $python time_tiles.py warm SENSOR [--metric temperature]   (compute every finished tile)
+
+import argparse
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from datetime import datetime, timezone
+import numpy as np
+from partitions import existing_partitions, month_start, query_range
+from response_encoding import SENSOR_PRECISION
+
+METRICS = ('temperature', 'percent_dissolved_oxygen', 'mg_per_l_dissolved_oxygen')
+LEVEL_BUCKET_SECONDS = (300, 900, 3600, 4 * 3600, 86400, 7 * 86400)
+LEVEL_RATIO = (None,) + tuple(b // a for a, b in zip(LEVEL_BUCKET_SECONDS, LEVEL_BUCKET_SECONDS[1:]))
+TILE_BUCKETS = 256
+# Readings normally arrive within seconds; a tile this long past its end gets no more
+SETTLE_SECONDS = 3600
+# Browser cache lifetime of the open tile, which changes with every reading
+OPEN_TILE_MAX_AGE = 60
+SENSOR_PATTERN = re.compile(r'^[A-Za-z0-9_-][A-Za-z0-9_.-]*$')
+
+
+def create_tile_tables(cursor):
+    """tileGeneration: per-sensor version of the finished tiles, bumped when history changes."""
+    cursor.execute('''CREATE TABLE IF NOT EXISTS tileGeneration (
+                    SensorID TEXT PRIMARY KEY,
+                    generation INTEGER NOT NULL,
+                    changed_at TIMESTAMP
+                )''')
+
+
+def tile_seconds(level):
+    return LEVEL_BUCKET_SECONDS[level] * TILE_BUCKETS
+
+
+def tile_bounds(level, index):
+    """[start, end) of a tile in Unix seconds."""
+    span = tile_seconds(level)
+    return index * span, (index + 1) * span
+
+
+def tile_index(level, seconds):
+    return int(seconds // tile_seconds(level))
+
+
+def is_finished(level, index, now=None):
+    now = time.time() if now is None else now
+    return tile_bounds(level, index)[1] <= now - SETTLE_SECONDS
+
+
+def epoch_text(seconds):
+    """Unix seconds as SensorData's created_at text (naive UTC)."""
+    return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+def generation(conn, sensor_id):
+    row = conn.execute('SELECT generation FROM tileGeneration WHERE SensorID = ?', (sensor_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def note_history_change(cursor, sensor_id, oldest, now=None):
+    """Bump the sensor's generation if a reading at `oldest` (created_at) falls in a finished tile.
+
+    Call in the transaction that stores the readings; returns True if the generation changed.
+    """
+    now = time.time() if now is None else now
+    # Every finished tile, whatever its level, ends at or before the newest finished level 0 tile
+    settled = tile_index(0, now - SETTLE_SECONDS) * tile_seconds(0)
+    if oldest is None or str(oldest) >= epoch_text(settled):
+        return False
+    cursor.execute('''INSERT INTO tileGeneration (SensorID, generation, changed_at) VALUES (?, 1, ?)
+                      ON CONFLICT(SensorID) DO UPDATE SET generation = generation + 1, changed_at = excluded.changed_at''',
+                   (sensor_id, epoch_text(now)))
+    logging.debug(f"Sensor {sensor_id}: readings from {oldest} stored, chart tiles invalidated")
+    return True
+
+
+class Tile:
+    """One tile's buckets: reading count, sum, min and max per bucket."""
+    __slots__ = ('level', 'index', 'count', 'total', 'low', 'high')
+
+    def __init__(self, level, index, count=None, total=None, low=None, high=None):
+        self.level = level
+        self.index = index
+        self.count = np.zeros(TILE_BUCKETS) if count is None else count
+        self.total = np.zeros(TILE_BUCKETS) if total is None else total
+        self.low = np.full(TILE_BUCKETS, np.inf) if low is None else low
+        self.high = np.full(TILE_BUCKETS, -np.inf) if high is None else high
+
+    @property
+    def empty(self):
+        return not self.count.any()
+
+    def add(self, times, counts, totals, lows, highs):
+        """Accumulate readings (or rollup hours) at Unix seconds `times` into their buckets."""
+        start, _ = tile_bounds(self.level, self.index)
+        slots = ((times - start) // LEVEL_BUCKET_SECONDS[self.level]).astype(np.int64)
+        self.count += np.bincount(slots, weights=counts, minlength=TILE_BUCKETS)
+        self.total += np.bincount(slots, weights=totals, minlength=TILE_BUCKETS)
+        np.minimum.at(self.low, slots, lows)
+        np.maximum.at(self.high, slots, highs)
+
+    @classmethod
+    def merge(cls, level, index, children):
+        """A tile from its LEVEL_RATIO[level] children, oldest first."""
+        ratio = LEVEL_RATIO[level]
+        stack = lambda name: np.concatenate([getattr(c, name) for c in children]).reshape(TILE_BUCKETS, ratio)
+        return cls(level, index, stack('count').sum(axis=1), stack('total').sum(axis=1),
+                   stack('low').min(axis=1), stack('high').max(axis=1))
+
+    def to_json(self, sensor_id, metric, generation, finished):
+        start, end = tile_bounds(self.level, self.index)
+        bucket = LEVEL_BUCKET_SECONDS[self.level]
+        filled = np.nonzero(self.count)[0]
+        decimals = SENSOR_PRECISION.get(metric, 2)
+        return json.dumps({
+            'SensorID': sensor_id, 'metric': metric, 'level': self.level, 'index': self.index,
+            'generation': generation, 'finished': finished, 'start': start, 'end': end, 'bucket_seconds': bucket,
+            't': (start + filled * bucket).tolist(),
+            'count': self.count[filled].astype(np.int64).tolist(),
+            'avg': np.round(self.total[filled] / self.count[filled], decimals + 2).tolist(),
+            'min': np.round(self.low[filled], decimals).tolist(),
+            'max': np.round(self.high[filled], decimals).tolist(),
+        }, separators=(',', ':')).encode('utf-8')
+
+    @classmethod
+    def from_json(cls, body):
+        data = json.loads(body)
+        tile = cls(data['level'], data['index'])
+        slots = (np.array(data['t'], dtype=np.int64) - data['start']) // data['bucket_seconds']
+        count = np.array(data['count'], dtype=float)
+        tile.count[slots] = count
+        tile.total[slots] = np.array(data['avg'], dtype=float) * count
+        tile.low[slots] = data['min']
+        tile.high[slots] = data['max']
+        return tile
+
+
+def read_tile(conn, sensor_id, metric, level, index, on_connect=None):
+    """Aggregate a tile's range straight from SensorData and SensorDataRollup."""
+    tile = Tile(level, index)
+    start, end = tile_bounds(level, index)
+    start_text, end_text = epoch_text(start), epoch_text(end)
+    rows = query_range(sensor_id, start_text, end_text,
+                       columns=f"CAST(strftime('%s', created_at) AS INTEGER) AS t, {metric} AS v",
+                       on_connect=on_connect)
+    if rows:
+        times = np.array([row['t'] for row in rows], dtype=np.int64)
+        values = np.array([row['v'] for row in rows], dtype=float)
+        measured = ~np.isnan(values)
+        times, values = times[measured], values[measured]
+        tile.add(times, np.ones(len(values)), values, values, values)
+    hours = conn.execute(f'''SELECT CAST(strftime('%s', hour) AS INTEGER), readings, avg_{metric}, min_{metric}, max_{metric}
+                             FROM SensorDataRollup
+                             WHERE SensorID = ? AND hour >= ? AND hour < ? AND avg_{metric} IS NOT NULL''',
+                         (sensor_id, start_text, end_text)).fetchall()
+    if hours:
+        times, counts, avgs, lows, highs = (np.array(column, dtype=float) for column in zip(*hours))
+        tile.add(times, counts, avgs * counts, lows, highs)
+    return tile
+
+
+class TileCache:
+    """Finished tiles on disk, one JSON file each, per sensor generation."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, sensor_id, generation, metric, level, index):
+        return os.path.join(self.directory, sensor_id, f'g{generation}', metric, str(level), f'{index}.json')
+
+    def load(self, sensor_id, generation, metric, level, index):
+        try:
+            with open(self.path(sensor_id, generation, metric, level, index), 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def store(self, sensor_id, generation, metric, level, index, body):
+        path = self.path(sensor_id, generation, metric, level, index)
+        generation_dir = os.path.join(self.directory, sensor_id, f'g{generation}')
+        if not os.path.isdir(generation_dir):
+            self.remove_generations(sensor_id, keep=generation)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Concurrent requests may compute the same tile; whichever replace lands last wins, both are equal
+        temp = f'{path}.{os.getpid()}.tmp'
+        with open(temp, 'wb') as f:
+            f.write(body)
+        os.replace(temp, path)
+
+    def remove_generations(self, sensor_id, keep):
+        sensor_dir = os.path.join(self.directory, sensor_id)
+        if not os.path.isdir(sensor_dir):
+            return
+        for name in os.listdir(sensor_dir):
+            if name.startswith('g') and name != f'g{keep}':
+                shutil.rmtree(os.path.join(sensor_dir, name), ignore_errors=True)
+                logging.debug(f"Removed chart tiles {sensor_id}/{name}")
+
+
+def build_tile(conn, cache, sensor_id, metric, level, index, generation, now, on_connect=None):
+    """A tile from the cache, SensorData, or (when open) its children; finished tiles are cached."""
+    start, _ = tile_bounds(level, index)
+    if is_finished(level, index, now):
+        body = cache.load(sensor_id, generation, metric, level, index)
+        if body is not None:
+            return Tile.from_json(body)
+        tile = read_tile(conn, sensor_id, metric, level, index, on_connect)
+        # Empty tiles are one index lookup to recompute; not worth a file each
+        if not tile.empty:
+            cache.store(sensor_id, generation, metric, level, index,
+                        tile.to_json(sensor_id, metric, generation, True))
+        return tile
+    if start > now:
+        return Tile(level, index)
+    if level == 0:
+        return read_tile(conn, sensor_id, metric, level, index, on_connect)
+    ratio = LEVEL_RATIO[level]
+    return Tile.merge(level, index, [build_tile(conn, cache, sensor_id, metric, level - 1, index * ratio + k,
+                                                generation, now, on_connect) for k in range(ratio)])
+
+
+def validate_tile(sensor_id, metric, level, index, now=None):
+    if not SENSOR_PATTERN.match(sensor_id):
+        raise ValueError(f'invalid SensorID {sensor_id!r}')
+    if metric not in METRICS:
+        raise ValueError(f'metric must be one of {METRICS}')
+    if not 0 <= level < len(LEVEL_BUCKET_SECONDS):
+        raise ValueError(f'level must be 0-{len(LEVEL_BUCKET_SECONDS) - 1}')
+    if index > tile_index(level, time.time() if now is None else now):
+        raise ValueError('tile is in the future')
+
+
+def tile_body(conn, cache, sensor_id, metric, level, index, now=None, on_connect=None):
+    """(JSON body, finished, generation) of one tile, from the cache when finished."""
+    now = time.time() if now is None else now
+    validate_tile(sensor_id, metric, level, index, now)
+    current = generation(conn, sensor_id)
+    finished = is_finished(level, index, now)
+    if finished:
+        body = cache.load(sensor_id, current, metric, level, index)
+        if body is not None:
+            return body, True, current
+    tile = build_tile(conn, cache, sensor_id, metric, level, index, current, now, on_connect)
+    return tile.to_json(sensor_id, metric, current, finished), finished, current
+
+
+def tile_info(conn, sensor_id, on_connect=None):
+    """What a chart needs to request tiles: levels, the current generation and the data's extent."""
+    partitions = existing_partitions()
+    since = month_start(*partitions[0]) if partitions else epoch_text(0)
+    first = query_range(sensor_id, since, epoch_text(time.time() + 86400), columns='created_at', max_rows=1,
+                        on_connect=on_connect)
+    archived = conn.execute('SELECT MIN(hour) FROM SensorDataRollup WHERE SensorID = ?', (sensor_id,)).fetchone()[0]
+    candidates = [str(t) for t in (first[0]['created_at'] if first else None, archived) if t is not None]
+    latest = (conn.execute('SELECT created_at FROM latest_reading WHERE SensorID = ?', (sensor_id,)).fetchone()
+              or conn.execute('SELECT MAX(created_at) FROM SensorData WHERE SensorID = ?', (sensor_id,)).fetchone())
+    to_epoch = lambda text: int(datetime.fromisoformat(str(text)[:19]).replace(tzinfo=timezone.utc).timestamp())
+    return {
+        'SensorID': sensor_id,
+        'generation': generation(conn, sensor_id),
+        'metrics': list(METRICS),
+        'tile_buckets': TILE_BUCKETS,
+        'settle_seconds': SETTLE_SECONDS,
+        'levels': [{'level': level, 'bucket_seconds': bucket, 'tile_seconds': bucket * TILE_BUCKETS}
+                   for level, bucket in enumerate(LEVEL_BUCKET_SECONDS)],
+        'first': to_epoch(min(candidates)) if candidates else None,
+        'last': to_epoch(latest[0]) if latest and latest[0] else None,
+    }
+
+
+def warm(conn, cache, sensor_id, metrics=METRICS, now=None):
+    """Compute and cache every finished tile of a sensor, coarsest level first; returns tiles stored."""
+    now = time.time() if now is None else now
+    info = tile_info(conn, sensor_id)
+    if info['first'] is None:
+        return 0
+    stored = 0
+    for metric in metrics:
+        for level in reversed(range(len(LEVEL_BUCKET_SECONDS))):
+            for index in range(tile_index(level, info['first']), tile_index(level, now) + 1):
+                if not is_finished(level, index, now):
+                    break
+                if cache.load(sensor_id, info['generation'], metric, level, index) is None:
+                    tile = build_tile(conn, cache, sensor_id, metric, level, index, info['generation'], now)
+                    stored += not tile.empty
+    return stored
+
+
+if __name__ == '__main__':
+    import database
+    from constant import database_file, tile_dir
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Chart tiles of historical readings')
+    sub = parser.add_subparsers(dest='command', required=True)
+    warm_parser = sub.add_parser('warm', help='compute every finished tile of a sensor ahead of the first chart')
+    warm_parser.add_argument('sensor')
+    warm_parser.add_argument('--metric', choices=METRICS, action='append')
+    args = parser.parse_args()
+
+    conn = database.connect(database_file)
+    started = time.monotonic()
+    count = warm(conn, TileCache(tile_dir), args.sensor, args.metric or METRICS)
+    conn.close()
+    print(f"{count} tiles of {args.sensor} computed in {time.monotonic() - started:.1f}s")
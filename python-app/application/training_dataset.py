@@ -0,0 +1,198 @@
+# training_dataset.py
+# Columnar copy of SensorData for the ML scripts, as plain .npy files that open memory-mapped.
+#
+#   <dataset>/manifest.json              last SensorData id copied, row counts per part
+#   <dataset>/all/<column>.npy           every reading, in id order
+#   <dataset>/sensors/<name>/<column>.npy  the same columns split per sensor
+#
+# build_dataset() only reads rows with an id above the manifest's last_id, from the main
+# database and the monthly partitions (rolled rows keep their ids) merged in id order, and
+# appends them to the end of each file, then rewrites the row count in the fixed-size .npy header.
+# The manifest is replaced last, and readers slice every column to the manifest's counts,
+# so a build that stops half way is invisible to them and trimmed by the next build.
+# Column files are fsynced before the manifest that counts their rows is renamed into place,
+# and concurrent builds (several training jobs starting at once) take turns on an flock.
+# open_dataset() returns read-only memmaps: jobs share the OS page cache, nothing is copied.
+#
+# $python training_dataset.py [--dataset DIR]
+
+import argparse
+import fcntl
+import heapq
+import itertools
+import json
+import logging
+import os
+import re
+import database
+import numpy as np
+from partitions import existing_partitions, partition_path
+
+COLUMNS = {
+    'id': np.dtype('<i8'),
+    'created_at': np.dtype('<M8[s]'),
+    'temperature': np.dtype('<f8'),
+    'percent_dissolved_oxygen': np.dtype('<f8'),
+    'mg_per_l_dissolved_oxygen': np.dtype('<f8'),
+}
+HEADER_BYTES = 128  # fixed, so the row count can be rewritten in place
+CHUNK_ROWS = 200000
+MAGIC = b'\x93NUMPY\x01\x00'
+LOCK_FILE = 'build.lock'
+
+
+def default_dataset_dir(db_file):
+    return os.path.splitext(db_file)[0] + '_dataset'
+
+
+def npy_header(dtype, rows):
+    text = f"{{'descr': '{dtype.str}', 'fortran_order': False, 'shape': ({rows},), }}"
+    text = text.ljust(HEADER_BYTES - len(MAGIC) - 2 - 1) + '\n'
+    return MAGIC + len(text).to_bytes(2, 'little') + text.encode('latin1')
+
+
+def append_column(path, dtype, rows, values):
+    """Keep the first `rows` entries of a column file and append values after them."""
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(npy_header(dtype, 0))
+    with open(path, 'r+b') as f:
+        f.truncate(HEADER_BYTES + rows * dtype.itemsize)
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+        # Data first, count second: a reader never sees a count ahead of the data
+        f.flush()
+        f.seek(0)
+        f.write(npy_header(dtype, rows + len(values)))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def load_manifest(dataset_dir):
+    path = os.path.join(dataset_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {'last_id': 0, 'rows': 0, 'sensors': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_manifest(dataset_dir, manifest):
+    path = os.path.join(dataset_dir, 'manifest.json')
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def sensor_dir_name(manifest, sensor):
+    entry = manifest['sensors'].get(sensor)
+    if entry is None:
+        used = {e['dir'] for e in manifest['sensors'].values()}
+        base = re.sub(r'[^A-Za-z0-9_.-]', '_', str(sensor)) or 'sensor'
+        name, n = base, 1
+        while name in used:
+            n += 1
+            name = f"{base}_{n}"
+        entry = manifest['sensors'][sensor] = {'dir': name, 'rows': 0}
+    return entry
+
+
+def build_dataset(db_file, dataset_dir=None):
+    """Append SensorData rows added since the last build; returns (dataset_dir, rows appended).
+
+    Builds of the same dataset from several processes run one after the other: the later
+    ones find the manifest already up to date and append only what is newer.
+    """
+    dataset_dir = dataset_dir or default_dataset_dir(db_file)
+    os.makedirs(os.path.join(dataset_dir, 'all'), exist_ok=True)
+    with open(os.path.join(dataset_dir, LOCK_FILE), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            return dataset_dir, append_new_rows(db_file, dataset_dir)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def append_new_rows(db_file, dataset_dir):
+    """The body of build_dataset, run under the dataset's lock; returns the rows appended."""
+    manifest = load_manifest(dataset_dir)
+    names = list(COLUMNS)
+
+    # Rolled months keep their ids in the partition files, so the newest id can be in either
+    conns = [database.connect(db_file)] + [database.connect(partition_path(*p)) for p in existing_partitions()]
+    max_id = max(conn.execute('SELECT MAX(id) FROM SensorData').fetchone()[0] or 0 for conn in conns)
+    if max_id < manifest['last_id']:
+        # AUTOINCREMENT ids never go back, so this is a different (recreated) database
+        logging.warning(f"SensorData ends at id {max_id}, dataset at {manifest['last_id']}: rebuilding")
+        manifest = {'last_id': 0, 'rows': 0, 'sensors': {}}
+    cursors = [conn.execute(f'''SELECT SensorID, {', '.join(names)} FROM SensorData
+                                WHERE id > ? ORDER BY id''', (manifest['last_id'],)) for conn in conns]
+    merged = heapq.merge(*cursors, key=lambda row: row[1])
+    appended = 0
+    while True:
+        chunk = list(itertools.islice(merged, CHUNK_ROWS))
+        if not chunk:
+            break
+        columns = list(zip(*chunk))
+        sensors = np.array(columns[0], dtype=object).astype(str)
+        # NULL readings become NaN, NULL timestamps NaT
+        values = {name: np.array(col, dtype=COLUMNS[name]) for name, col in zip(names, columns[1:])}
+
+        for name in names:
+            append_column(os.path.join(dataset_dir, 'all', f'{name}.npy'), COLUMNS[name],
+                          manifest['rows'], values[name])
+        manifest['rows'] += len(chunk)
+
+        order = np.argsort(sensors, kind='stable')
+        unique, starts = np.unique(sensors[order], return_index=True)
+        for sensor, lo, hi in zip(unique, starts, list(starts[1:]) + [len(order)]):
+            entry = sensor_dir_name(manifest, sensor)
+            path = os.path.join(dataset_dir, 'sensors', entry['dir'])
+            os.makedirs(path, exist_ok=True)
+            rows = order[lo:hi]
+            for name in names:
+                append_column(os.path.join(path, f'{name}.npy'), COLUMNS[name], entry['rows'], values[name][rows])
+            entry['rows'] += len(rows)
+
+        manifest['last_id'] = int(values['id'][-1])
+        save_manifest(dataset_dir, manifest)
+        appended += len(chunk)
+        logging.debug(f"Dataset: appended {len(chunk)} rows up to id {manifest['last_id']}")
+    for conn in conns:
+        conn.close()
+    return appended
+
+
+def open_columns(path, rows):
+    return {name: np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r')[:rows] for name in COLUMNS}
+
+
+def open_dataset(dataset_dir, sensor=None):
+    """Read-only memmapped columns of the whole dataset, or of one sensor."""
+    manifest = load_manifest(dataset_dir)
+    if sensor is None:
+        if manifest['rows'] == 0:
+            return {name: np.empty(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        return open_columns(os.path.join(dataset_dir, 'all'), manifest['rows'])
+    entry = manifest['sensors'][sensor]
+    return open_columns(os.path.join(dataset_dir, 'sensors', entry['dir']), entry['rows'])
+
+
+def load_training_data(db_file, dataset_dir=None):
+    """Bring the dataset up to date and open it - what the ML scripts call instead of reading SensorData."""
+    dataset_dir, _ = build_dataset(db_file, dataset_dir)
+    return open_dataset(dataset_dir)
+
+
+if __name__ == '__main__':
+    from constant import database_file
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    parser = argparse.ArgumentParser(description='Append new SensorData rows to the training dataset')
+    parser.add_argument('--dataset', default=None, help='dataset directory (default: next to the database)')
+    args = parser.parse_args()
+
+    dataset_dir, appended = build_dataset(database_file, args.dataset)
+    manifest = load_manifest(dataset_dir)
+    print(f"{dataset_dir}: appended {appended} rows, {manifest['rows']} rows from {len(manifest['sensors'])} sensors")